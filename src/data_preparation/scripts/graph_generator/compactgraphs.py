@@ -0,0 +1,223 @@
+"""
+A compact binary format for chunks of extracted code graphs.
+
+Instead of one JSON object per graph, a chunk is stored as a single .npz file holding flat integer arrays for all
+of its graphs:
+ * All strings (node labels, symbol names, annotations, ...) are interned into one UTF-8 blob with offsets.
+ * Nodes are int32 ids into the string table.
+ * Edges are one int32 array of shape (E, 2) per edge type.
+ * Supernodes are an int32 table of (node id, name, annotation, line, column, kind).
+Per-graph slices of each concatenated array are given by offset arrays of length num_graphs + 1.
+
+Samples read back have the same keys as the JSON graphs, except that 'edges' maps each edge type to an (E, 2)
+int32 array instead of a {str(from): [to, ...]} dictionary. Use `get_adjacency_dict` where the latter is needed.
+
+The models import this module as data_preparation.scripts.graph_generator.compactgraphs. The extractor and the models
+both split node labels into subtokens with `split_into_subtokens`, so they split them the same way and share its cache
+within a process.
+"""
+import os
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from dpu_utils.codeutils import split_identifier_into_parts
+
+FORMAT_VERSION = 1
+FILE_SUFFIX = '.graphs.npz'
+
+# Node labels recur across the files of a corpus, so their subtokens are cached (per process) for this many of them.
+MAX_SUBTOKEN_CACHE_SIZE = 1000000
+
+
+class _StringTable:
+    def __init__(self):
+        self.__string_to_id = {}  # type: Dict[str, int]
+        self.__strings = []  # type: List[str]
+
+    def get_id(self, s: Optional[str]) -> int:
+        if s is None:
+            return -1
+        idx = self.__string_to_id.get(s)
+        if idx is None:
+            idx = len(self.__strings)
+            self.__string_to_id[s] = idx
+            self.__strings.append(s)
+        return idx
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        encoded = [s.encode('utf-8', errors='surrogatepass') for s in self.__strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return {
+            'strings_blob': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'strings_offsets': offsets,
+        }
+
+
+def _offsets(lengths: List[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def save_compact_graph_chunk(graphs: List[Dict[str, Any]], path: str) -> None:
+    """Save a list of graphs, as produced by AstGraphGenerator.build(), to a compact chunk file at path."""
+    strings = _StringTable()
+    edge_type_names = sorted({e for g in graphs for e in g['edges']})
+
+    node_label_ids, num_nodes = [], []
+    token_sequence, token_sequence_lengths = [], []
+    edges = {e: [] for e in edge_type_names}
+    edge_counts = {e: [] for e in edge_type_names}
+    supernodes, num_supernodes = [], []
+    filename_ids = []
+
+    for graph in graphs:
+        node_label_ids.extend(strings.get_id(label) for label in graph['nodes'])
+        num_nodes.append(len(graph['nodes']))
+
+        token_sequence.extend(graph['token-sequence'])
+        token_sequence_lengths.append(len(graph['token-sequence']))
+
+        for edge_type in edge_type_names:
+            graph_edges = graph['edges'].get(edge_type, {})
+            if isinstance(graph_edges, np.ndarray):
+                # Graphs read with load_compact_graph_chunk
+                edges[edge_type].extend(map(tuple, graph_edges.tolist()))
+                edge_counts[edge_type].append(len(graph_edges))
+                continue
+            num_edges = 0
+            for from_idx, to_idxs in graph_edges.items():
+                from_idx = int(from_idx)
+                edges[edge_type].extend((from_idx, to_idx) for to_idx in to_idxs)
+                num_edges += len(to_idxs)
+            edge_counts[edge_type].append(num_edges)
+
+        for node_idx, supernode_data in graph['supernodes'].items():
+            line, col = supernode_data['location']
+            supernodes.append((int(node_idx), strings.get_id(supernode_data['name']),
+                               strings.get_id(supernode_data['annotation']), line, col,
+                               strings.get_id(supernode_data['type'])))
+        num_supernodes.append(len(graph['supernodes']))
+
+        filename_ids.append(strings.get_id(graph.get('filename')))
+
+    arrays = {
+        'format_version': np.array(FORMAT_VERSION, dtype=np.int32),
+        'node_label_ids': np.array(node_label_ids, dtype=np.int32),
+        'node_offsets': _offsets(num_nodes),
+        'token_sequence': np.array(token_sequence, dtype=np.int32),
+        'token_sequence_offsets': _offsets(token_sequence_lengths),
+        'edge_type_names': np.array([strings.get_id(e) for e in edge_type_names], dtype=np.int32),
+        'supernodes': np.array(supernodes, dtype=np.int32).reshape(-1, 6),
+        'supernode_offsets': _offsets(num_supernodes),
+        'filename_ids': np.array(filename_ids, dtype=np.int32),
+    }
+    # Only now are all strings (including the edge type names) interned.
+    arrays.update(strings.to_arrays())
+    for i, edge_type in enumerate(edge_type_names):
+        arrays['edges_%i' % i] = np.array(edges[edge_type], dtype=np.int32).reshape(-1, 2)
+        arrays['edge_offsets_%i' % i] = _offsets(edge_counts[edge_type])
+
+    # Write through a file object, since np.savez would append ".npz" to a path not ending with it.
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_compact_graph_chunk(path: str) -> Iterator[Dict[str, Any]]:
+    """Iterate over the graphs stored in the compact chunk file at path."""
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {k: data[k] for k in data.files}
+
+    if int(arrays['format_version']) != FORMAT_VERSION:
+        raise ValueError('Unsupported compact graph format version %s in %s' % (int(arrays['format_version']), path))
+
+    blob = arrays['strings_blob'].tobytes()
+    string_offsets = arrays['strings_offsets']
+    strings = [blob[string_offsets[i]:string_offsets[i + 1]].decode('utf-8', errors='surrogatepass')
+               for i in range(len(string_offsets) - 1)]
+
+    def get_string(idx: int) -> Optional[str]:
+        return strings[idx] if idx >= 0 else None
+
+    edge_type_names = [strings[i] for i in arrays['edge_type_names']]
+    node_offsets = arrays['node_offsets']
+    token_sequence_offsets = arrays['token_sequence_offsets']
+    supernode_offsets = arrays['supernode_offsets']
+
+    for graph_idx in range(len(node_offsets) - 1):
+        label_ids = arrays['node_label_ids'][node_offsets[graph_idx]:node_offsets[graph_idx + 1]]
+        edges = {}
+        for i, edge_type in enumerate(edge_type_names):
+            edge_offsets = arrays['edge_offsets_%i' % i]
+            edges[edge_type] = arrays['edges_%i' % i][edge_offsets[graph_idx]:edge_offsets[graph_idx + 1]]
+
+        supernodes = {}
+        for node_idx, name_id, annotation_id, line, col, type_id in \
+                arrays['supernodes'][supernode_offsets[graph_idx]:supernode_offsets[graph_idx + 1]].tolist():
+            supernodes[str(node_idx)] = {
+                'name': get_string(name_id),
+                'annotation': get_string(annotation_id),
+                'location': [line, col],
+                'type': get_string(type_id)
+            }
+
+        graph = {
+            'nodes': [strings[i] for i in label_ids.tolist()],
+            'edges': edges,
+            'token-sequence': arrays['token_sequence'][token_sequence_offsets[graph_idx]:token_sequence_offsets[graph_idx + 1]].tolist(),
+            'supernodes': supernodes,
+        }
+        filename = get_string(int(arrays['filename_ids'][graph_idx]))
+        if filename is not None:
+            graph['filename'] = filename
+        yield graph
+
+
+def get_adjacency_dict(edges: Union[np.ndarray, Dict[str, List[int]]]) -> Dict[str, List[int]]:
+    """Return edges of a single type in the JSON form {str(from): [to, ...]}, whatever the format they were read from."""
+    if not isinstance(edges, np.ndarray):
+        return edges
+    adjacency = {}  # type: Dict[str, List[int]]
+    for from_idx, to_idx in edges.tolist():
+        adjacency.setdefault(str(from_idx), []).append(to_idx)
+    return adjacency
+
+
+@lru_cache(maxsize=MAX_SUBTOKEN_CACHE_SIZE)
+def split_into_subtokens(label: str) -> Tuple[str, ...]:
+    return tuple(split_identifier_into_parts(label))
+
+
+class CompactGraphChunkWriter:
+    """Like dpu_utils' ChunkWriter, but writing chunks in the compact graph format."""
+    def __init__(self, out_folder: str, file_prefix: str, max_chunk_size: int):
+        self.__out_folder = out_folder
+        self.__file_prefix = file_prefix
+        self.__max_chunk_size = max_chunk_size
+        self.__current_chunk = []  # type: List[Dict[str, Any]]
+        self.__num_files_written = 0
+        os.makedirs(out_folder, exist_ok=True)
+
+    def __enter__(self) -> 'CompactGraphChunkWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def add(self, graph: Dict[str, Any]) -> None:
+        self.__current_chunk.append(graph)
+        if len(self.__current_chunk) >= self.__max_chunk_size:
+            self.__flush()
+
+    def __flush(self) -> None:
+        if len(self.__current_chunk) == 0:
+            return
+        out_file = os.path.join(self.__out_folder, '%s%03d%s' % (self.__file_prefix, self.__num_files_written, FILE_SUFFIX))
+        save_compact_graph_chunk(self.__current_chunk, out_file)
+        self.__current_chunk = []
+        self.__num_files_written += 1
+
+    def close(self) -> None:
+        self.__flush()
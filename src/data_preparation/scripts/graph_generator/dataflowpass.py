@@ -1,7 +1,6 @@
-from collections import defaultdict
 from itertools import chain
 from symtable import SymbolTable
-from typing import Any, Dict, Optional, Set, Union, List
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, Optional, Tuple, Union, List
 
 
 from typed_ast.ast3 import Mod, Compare, Lambda, arg, Global, Nonlocal, arguments, Name, comprehension, \
@@ -13,16 +12,108 @@ from typed_ast.ast3 import NodeVisitor, AST, FunctionDef, AsyncFunctionDef, Retu
 from .graphgenutils import EdgeType
 
 
+class LastUses:
+    """
+    The nodes that last used each symbol, as a persistent map. snapshot() and merge() cost in proportion to the
+    symbols that changed since the last common snapshot, instead of to all symbols: snapshots freeze the current
+    changes into an immutable layer shared by both copies, and lookups go through the (bounded) stack of layers.
+    """
+    MAX_NUM_LAYERS = 16
+    _EMPTY = frozenset()
+
+    class _Layer:
+        __slots__ = ('parent', 'changes', 'depth')
+
+        def __init__(self, parent: Optional['LastUses._Layer'], changes: Dict[Any, FrozenSet[Any]]):
+            self.parent = parent
+            self.changes = changes
+            self.depth = 0 if parent is None else parent.depth + 1
+
+    def __init__(self, layer: Optional['LastUses._Layer'] = None):
+        self.__layer = layer
+        self.__changes: Dict[Any, FrozenSet[Any]] = {}
+
+    def __getitem__(self, symbol) -> FrozenSet[Any]:
+        nodes = self.__changes.get(symbol)
+        if nodes is not None:
+            return nodes
+        layer = self.__layer
+        while layer is not None:
+            nodes = layer.changes.get(symbol)
+            if nodes is not None:
+                return nodes
+            layer = layer.parent
+        return self._EMPTY
+
+    def __setitem__(self, symbol, nodes: FrozenSet[Any]) -> None:
+        self.__changes[symbol] = nodes
+
+    def is_empty(self) -> bool:
+        return self.__layer is None and len(self.__changes) == 0
+
+    def items(self) -> Iterator[Tuple[Any, FrozenSet[Any]]]:
+        seen = set(self.__changes)
+        yield from self.__changes.items()
+        layer = self.__layer
+        while layer is not None:
+            for symbol, nodes in layer.changes.items():
+                if symbol not in seen:
+                    seen.add(symbol)
+                    yield symbol, nodes
+            layer = layer.parent
+
+    def snapshot(self) -> 'LastUses':
+        """An independent copy. Changes to either are not visible in the other."""
+        if len(self.__changes) > 0:
+            self.__layer = LastUses._Layer(self.__layer, self.__changes)
+            self.__changes = {}
+            if self.__layer.depth >= self.MAX_NUM_LAYERS:
+                self.__layer = LastUses._Layer(None, dict(self.items()))
+        return LastUses(self.__layer)
+
+    def __changed_symbols_since(self, ancestor: Optional['LastUses._Layer']) -> Iterable[Any]:
+        yield from self.__changes
+        layer = self.__layer
+        while layer is not ancestor:
+            yield from layer.changes
+            layer = layer.parent
+
+    @staticmethod
+    def merge(last_uses1: 'LastUses', last_uses2: 'LastUses') -> 'LastUses':
+        """The union of the last uses of each symbol."""
+        if last_uses1.is_empty():
+            return last_uses2.snapshot()
+        if last_uses2.is_empty():
+            return last_uses1.snapshot()
+
+        # Only the symbols changed since the innermost shared layer differ:
+        layers1 = set()
+        layer = last_uses1.__layer
+        while layer is not None:
+            layers1.add(layer)
+            layer = layer.parent
+        common_layer = last_uses2.__layer
+        while common_layer is not None and common_layer not in layers1:
+            common_layer = common_layer.parent
+
+        merged = LastUses(common_layer)
+        for symbol in chain(last_uses1.__changed_symbols_since(common_layer),
+                            last_uses2.__changed_symbols_since(common_layer)):
+            if symbol not in merged.__changes:
+                merged.__changes[symbol] = last_uses1[symbol] | last_uses2[symbol]
+        return merged
+
+
 class DataflowPass(NodeVisitor):
     def __init__(self, ast_graph_generator):
         self.__graph_generator = ast_graph_generator
 
         # Last Use
-        self.__last_use: Dict[Any, Set[Any]] = defaultdict(set)
+        self.__last_use = LastUses()
 
-        self.__break_uses: Dict[Any, Set[Any]] = defaultdict(set)
-        self.__continue_uses: Dict[Any, Set[Any]] = defaultdict(set)
-        self.__return_uses: Dict[Any, Set[Any]] = defaultdict(set)
+        self.__break_uses = LastUses()
+        self.__continue_uses = LastUses()
+        self.__return_uses = LastUses()
 
     def __visit_variable_like(self, name: Union[str, AST], parent_node: Optional[AST]):
         if isinstance(name, Name):
@@ -34,20 +125,13 @@ class DataflowPass(NodeVisitor):
         else:
             # We need to find the relevant node in the graph
             assert parent_node is not None
-            candidate_children = self.__graph_generator._get_edge_targets(parent_node, EdgeType.CHILD)
-            for child in candidate_children:
-                if str(child) == name:
-                    node = child
-                    break
-            else:
-                assert False
+            node = self.__graph_generator._get_token_child(parent_node, name)
+            assert node is not None
 
         # Find relevant symbol (OCCURRENCE_OF)
-        candidate_symbols = self.__graph_generator._get_edge_targets(node, EdgeType.OCCURRENCE_OF)
-        if len(candidate_symbols) == 0:
+        symbol = self.__graph_generator._get_occurrence_symbol(node)
+        if symbol is None:
             return
-        assert len(candidate_symbols) == 1
-        symbol = next(iter(candidate_symbols))
         self.__record_next_use(symbol, node)
 
 
@@ -65,17 +149,13 @@ class DataflowPass(NodeVisitor):
 
     def __visit_function(self, node: Union[FunctionDef, AsyncFunctionDef], is_async: bool):
         outer_return_uses = self.__return_uses
-        self.__return_uses = defaultdict(set)
+        self.__return_uses = LastUses()
 
-        before_function_uses = self.__clone_last_uses()
         self.visit(node.args)
         self.__visit_statement_block(node.body)
 
-        # Merge used variables in a dummy return value *only* if they have been accessed within the function.
+        # Merge used variables in a dummy return value
         self.__last_use = self.__merge_uses(self.__last_use, self.__return_uses)
-        for symbol, last_uses in self.__last_use.items():
-            if before_function_uses[symbol] == last_uses:
-                continue
 
         self.__return_uses = outer_return_uses
 
@@ -86,21 +166,15 @@ class DataflowPass(NodeVisitor):
     def __record_next_use(self, symbol, node) -> None:
         for last_node_used in self.__last_use[symbol]:
             self.__graph_generator._add_edge(last_node_used, node, EdgeType.NEXT_USE)
-        self.__last_use[symbol] = {node}
+        self.__last_use[symbol] = frozenset((node,))
 
-    def __merge_uses(self, use_set1: Dict[Any, Set[Any]], use_set2: Dict[Any, Set[Any]]) -> Dict[Any, Set[Any]]:
-        merged = defaultdict(set)
-        for symbol, last_used_nodes in chain(use_set1.items(), use_set2.items()):
-            merged[symbol] |= last_used_nodes
-        return merged
+    def __merge_uses(self, use_set1: LastUses, use_set2: LastUses) -> LastUses:
+        return LastUses.merge(use_set1, use_set2)
 
-    def __clone_last_uses(self) -> Dict[Any, Set[Any]]:
-        cloned = defaultdict(set)
-        for symbol, last_used_nodes in self.__last_use.items():
-            cloned[symbol] = set(last_used_nodes)
-        return cloned
+    def __clone_last_uses(self) -> LastUses:
+        return self.__last_use.snapshot()
 
-    def __loop_back_after(self, last_uses_at_end_of_loop: Dict[Any, Set[Any]], last_uses_just_before_looping_point: Dict[Any, Set[Any]]) -> None:
+    def __loop_back_after(self, last_uses_at_end_of_loop: LastUses, last_uses_just_before_looping_point: LastUses) -> None:
         for symbol, last_use_before_looping_point in last_uses_just_before_looping_point.items():
             first_use_after_looping_point = set(chain(*(self.__graph_generator._get_edge_targets(node, EdgeType.NEXT_USE) for node in last_use_before_looping_point)))
 
@@ -110,11 +184,11 @@ class DataflowPass(NodeVisitor):
 
     def visit_Break(self, node: Break):
         self.__break_uses = self.__merge_uses(self.__break_uses, self.__last_use)
-        self.__last_use = defaultdict(set)
+        self.__last_use = LastUses()
 
     def visit_Continue(self, node: Continue):
         self.__continue_uses = self.__merge_uses(self.__last_use, self.__continue_uses)
-        self.__last_use = defaultdict(set)
+        self.__last_use = LastUses()
 
     def visit_For(self, node: For):
         self.__visit_for(node, False)
@@ -182,7 +256,7 @@ class DataflowPass(NodeVisitor):
 
     def __visit_return_like(self):
         self.__return_uses = self.__merge_uses(self.__return_uses, self.__last_use)
-        self.__last_use = defaultdict(set)
+        self.__last_use = LastUses()
 
     def visit_Try(self, node: Try):
         # Heuristic: each handler is an if-like statement
@@ -7,11 +7,20 @@ Main file for data preprocessing. Walk recursively through the source folder's f
 
 Options:
     -h --help              Show this screen.
+    --num-workers NUM      Extract repositories in NUM worker processes. The output does not depend on NUM.
+                           If not given, the corpus is walked serially in a single process.
+    --cache-dir DIR        Cache extracted graphs in DIR, keyed by file contents. Unchanged files are not re-parsed
+                           when extracting the corpus again.
+    --output-format FMT    Write the graphs as "jsonl" (gzipped JSON lines) or "npz" (compact integer arrays, see
+                           compactgraphs.py) [default: jsonl].
     --debug                Debugging mode.
 """
 import bdb
-from typing import Tuple, List, Optional, Set, Iterator
-from dpu_utils.utils import save_jsonl_gz, run_and_debug, ChunkWriter
+import multiprocessing
+import shutil
+from collections import defaultdict
+from typing import Tuple, List, Optional, Set, Iterator, Dict, Any, NamedTuple
+from dpu_utils.utils import save_jsonl_gz, load_jsonl_gz, run_and_debug, ChunkWriter
 import traceback
 import os
 import json
@@ -20,9 +29,11 @@ from glob import iglob
 from docopt import docopt
 import time
 
+from .compactgraphs import CompactGraphChunkWriter
+from .extractioncache import ExtractionCache, TypeLatticeRecorder
 from .graphgenerator import AstGraphGenerator
 from .type_lattice_generator import TypeLatticeGenerator
-from .typeparsing import FaultyAnnotation
+from .typeparsing import FaultyAnnotation, TypeAnnotationNode
 
 
 class Monitoring:
@@ -45,6 +56,13 @@ class Monitoring:
     def enter_repo(self, repo_name: str) -> None:
         self.current_repo = repo_name
 
+    def merge(self, other: 'Monitoring') -> None:
+        self.count += other.count
+        self.errors.extend(other.errors)
+        self.empty_files.extend(other.empty_files)
+        self.file = other.file
+        self.current_repo = other.current_repo
+
 
 def build_graph(source_code, monitoring: Monitoring, type_lattice: TypeLatticeGenerator) -> Tuple[Optional[List], Optional[List]]:
     """
@@ -64,29 +82,160 @@ def build_graph(source_code, monitoring: Monitoring, type_lattice: TypeLatticeGe
 
 
 
-def explore_files(root_dir: str, duplicates_to_remove: Set[str], monitoring: Monitoring, type_lattice: TypeLatticeGenerator) -> Iterator[Tuple]:
+def get_repository(file_path: str, root_dir: str) -> str:
+    return file_path.replace(root_dir, '').split('/')[0]
+
+
+def extract_file(file_path: str, root_dir: str, monitoring: Monitoring, type_lattice: TypeLatticeGenerator,
+                 cache: Optional[ExtractionCache]=None) -> Optional[Dict[str, Any]]:
+    with open(file_path, encoding="utf-8", errors='ignore') as f:
+        monitoring.increment_count()
+        monitoring.enter_file(file_path)
+        source_code = f.read()
+
+    if cache is None:
+        graph = build_graph(source_code, monitoring, type_lattice)
+    else:
+        cache_key = cache.key_for(source_code, type_lattice)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            graph, lattice_calls = cached
+            TypeLatticeRecorder.replay(lattice_calls, type_lattice)
+        else:
+            recorder = TypeLatticeRecorder(type_lattice)
+            graph = build_graph(source_code, monitoring, recorder)
+            if graph is not None:
+                cache.put(cache_key, graph, recorder.calls)
+
+    if graph is None or len(graph['supernodes']) == 0:
+        return None
+    graph['filename'] = file_path[len(root_dir):]
+    return graph
+
+
+def group_files_by_repository(root_dir: str, duplicates_to_remove: Set[str]) -> List[Tuple[str, List[str]]]:
     """
-    Walks through the root_dir and process each file.
+    Collect the files to process for each repository, sorted by repository and file name.
     """
+    files_per_repo = defaultdict(list)  # type: Dict[str, List[str]]
     for file_path in iglob(os.path.join(root_dir, '**', '*.py'), recursive=True):
         if file_path in duplicates_to_remove:
             print('Ignoring duplicate %s' % file_path)
             continue
-        print(file_path)
         if not os.path.isfile(file_path):
             continue
-        with open(file_path, encoding="utf-8", errors='ignore') as f:
-            monitoring.increment_count()
-            monitoring.enter_file(file_path)
-            repo = file_path.replace(root_dir, '').split('/')[0]
-            if monitoring.current_repo != repo:
-                monitoring.enter_repo(repo)
-                type_lattice.build_graph()
-            graph = build_graph(f.read(), monitoring, type_lattice)
-            if graph is None or len(graph['supernodes']) == 0:
-                continue
-            graph['filename'] = file_path[len(root_dir):]
+        files_per_repo[get_repository(file_path, root_dir)].append(file_path)
+    return sorted((repo, sorted(file_paths)) for repo, file_paths in files_per_repo.items())
+
+
+class RepositoryExtractionJob(NamedTuple):
+    job_idx: int
+    repo: str
+    file_paths: List[str]
+    root_dir: str
+    shard_folder: str
+    typing_rules_path: str
+    cache_dir: Optional[str]
+
+
+class RepositoryExtractionResult(NamedTuple):
+    shard_paths: List[str]
+    monitoring: Monitoring
+    types: List[TypeAnnotationNode]
+    is_a_relationships: List[Tuple[TypeAnnotationNode, TypeAnnotationNode]]
+
+
+def extract_repository_graphs(repo_files: List[str], root_dir: str, monitoring: Monitoring,
+                              type_lattice: TypeLatticeGenerator, cache: Optional[ExtractionCache]=None) -> Iterator[Dict[str, Any]]:
+    """
+    Extract the graphs of the files of a single repository, in order, and then build its type lattice.
+    """
+    for file_path in repo_files:
+        graph = extract_file(file_path, root_dir, monitoring, type_lattice, cache)
+        if graph is not None:
             yield graph
+    type_lattice.build_graph()
+
+
+def extract_repository(job: RepositoryExtractionJob) -> RepositoryExtractionResult:
+    """
+    Extract the graphs of a single repository into a shard of its own, using a fresh type lattice.
+
+    Since nothing is shared across repositories, the result of each job does not depend on which worker runs it
+    or on which repositories that worker has seen before.
+    """
+    monitoring = Monitoring()
+    monitoring.enter_repo(job.repo)
+    type_lattice = TypeLatticeGenerator(job.typing_rules_path)
+    cache = ExtractionCache(job.cache_dir, job.typing_rules_path) if job.cache_dir is not None else None
+
+    out_folder = os.path.join(job.shard_folder, '%06i' % job.job_idx)
+    os.makedirs(out_folder, exist_ok=True)
+    with ChunkWriter(out_folder=out_folder, file_prefix='graphs', max_chunk_size=5000, file_suffix='.jsonl.gz') as writer:
+        for graph in extract_repository_graphs(job.file_paths, job.root_dir, monitoring, type_lattice, cache):
+            writer.add(graph)
+    # Exceptions are not necessarily picklable, keep only their description.
+    monitoring.errors = [[file_path, repr(err), trace] for file_path, err, trace in monitoring.errors]
+
+    types, is_a_relationships = type_lattice.export_project_types()
+    return RepositoryExtractionResult(
+        shard_paths=sorted(iglob(os.path.join(out_folder, '*.jsonl.gz'))),
+        monitoring=monitoring,
+        types=types,
+        is_a_relationships=is_a_relationships
+    )
+
+
+def explore_repositories(root_dir: str, duplicates_to_remove: Set[str], monitoring: Monitoring,
+                         type_lattice: TypeLatticeGenerator, typing_rules_path: str,
+                         cache_dir: Optional[str]=None) -> Iterator[Dict[str, Any]]:
+    """
+    Walk through the repositories in root_dir in a single process. Like explore_repositories_in_parallel(), each
+    repository is extracted with a fresh type lattice that is then merged into type_lattice, so that both produce the
+    same output.
+    """
+    cache = ExtractionCache(cache_dir, typing_rules_path) if cache_dir is not None else None
+    for repo, file_paths in group_files_by_repository(root_dir, duplicates_to_remove):
+        repo_monitoring = Monitoring()
+        repo_monitoring.enter_repo(repo)
+        monitoring.enter_repo(repo)
+        repo_type_lattice = TypeLatticeGenerator(typing_rules_path)
+        try:
+            for graph in extract_repository_graphs(file_paths, root_dir, repo_monitoring, repo_type_lattice, cache):
+                yield graph
+        finally:
+            monitoring.merge(repo_monitoring)
+        print('Done with %s (%s files)' % (repo, len(file_paths)))
+        type_lattice.merge_project_types(*repo_type_lattice.export_project_types())
+
+
+def explore_repositories_in_parallel(root_dir: str, duplicates_to_remove: Set[str], monitoring: Monitoring,
+                                     type_lattice: TypeLatticeGenerator, typing_rules_path: str, save_folder: str,
+                                     num_workers: int, cache_dir: Optional[str]=None) -> Iterator[Dict[str, Any]]:
+    """
+    Fan out whole repositories to worker processes. Workers stream their graphs into per-repository shards, which
+    are read back (and removed) in repository order. The per-repository lattices are merged into type_lattice in the
+    same order, so that the output is identical for any number of workers.
+    """
+    shard_folder = os.path.join(save_folder, '_shards')
+    jobs = [RepositoryExtractionJob(job_idx, repo, file_paths, root_dir, shard_folder, typing_rules_path, cache_dir)
+            for job_idx, (repo, file_paths) in enumerate(group_files_by_repository(root_dir, duplicates_to_remove))]
+    print('Extracting %s repositories using %s workers...' % (len(jobs), num_workers))
+
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    try:
+        results = pool.imap(extract_repository, jobs) if pool is not None else map(extract_repository, jobs)
+        for job, result in zip(jobs, results):
+            print('Done with %s (%s files)' % (job.repo, len(job.file_paths)))
+            monitoring.merge(result.monitoring)
+            type_lattice.merge_project_types(result.types, result.is_a_relationships)
+            for shard_path in result.shard_paths:
+                yield from load_jsonl_gz(shard_path)
+                os.remove(shard_path)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        shutil.rmtree(shard_folder, ignore_errors=True)
 
 
 def main(arguments):
@@ -105,12 +254,23 @@ def main(arguments):
                 all_to_remove.update(duplicate_cluster[1:])
 
         # Extract graphs
-        outputs = explore_files(walk_dir, all_to_remove,
-                                monitoring, type_lattice)
+        cache_dir = arguments.get('--cache-dir')
+        if arguments.get('--num-workers') is not None:
+            outputs = explore_repositories_in_parallel(walk_dir, all_to_remove, monitoring, type_lattice,
+                                                       arguments['TYPING_RULES'], arguments['SAVE_FOLDER'],
+                                                       int(arguments['--num-workers']), cache_dir)
+        else:
+            outputs = explore_repositories(walk_dir, all_to_remove, monitoring, type_lattice,
+                                           arguments['TYPING_RULES'], cache_dir)
 
         # Save results
-        with ChunkWriter(out_folder=arguments['SAVE_FOLDER'], file_prefix='all-graphs',
-                         max_chunk_size=5000, file_suffix='.jsonl.gz') as writer:
+        if arguments['--output-format'] == 'npz':
+            writer = CompactGraphChunkWriter(out_folder=arguments['SAVE_FOLDER'], file_prefix='all-graphs',
+                                             max_chunk_size=5000)
+        else:
+            writer = ChunkWriter(out_folder=arguments['SAVE_FOLDER'], file_prefix='all-graphs',
+                                 max_chunk_size=5000, file_suffix='.jsonl.gz')
+        with writer:
             for graph in outputs:
                 writer.add(graph)
     except bdb.BdbQuit:
@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import os
+import pickle
+import tempfile
+from glob import iglob
+from typing import Any, Dict, List, Optional, Tuple
+
+from .type_lattice_generator import TypeLatticeGenerator
+from .typeparsing import TypeAnnotationNode
+
+
+class TypeLatticeRecorder:
+    """
+    Wraps a TypeLatticeGenerator for the duration of a single file, recording all calls that modify the lattice.
+    The recorded calls can be replayed on a lattice, with the same effect as building the file's graph again.
+    """
+    def __init__(self, type_lattice: TypeLatticeGenerator):
+        self.__type_lattice = type_lattice
+        self.calls = []  # type: List[Tuple[str, Tuple]]
+
+    def add_type(self, annotation: TypeAnnotationNode, imported_symbols: Dict[TypeAnnotationNode, TypeAnnotationNode]):
+        # imported_symbols keeps changing while visiting the file, store the current view.
+        self.calls.append(('add_type', (annotation, dict(imported_symbols))))
+        self.__type_lattice.add_type(annotation, imported_symbols)
+
+    def add_class(self, class_name: str, parents: List[TypeAnnotationNode]) -> None:
+        self.calls.append(('add_class', (class_name, list(parents))))
+        self.__type_lattice.add_class(class_name, parents)
+
+    def add_type_alias(self, new_annotation: TypeAnnotationNode, ref_annotation: TypeAnnotationNode) -> None:
+        self.calls.append(('add_type_alias', (new_annotation, ref_annotation)))
+        self.__type_lattice.add_type_alias(new_annotation, ref_annotation)
+
+    def canonicalize_annotation(self, annotation: TypeAnnotationNode,
+                                local_aliases: Dict[TypeAnnotationNode, TypeAnnotationNode]) -> Optional[TypeAnnotationNode]:
+        return self.__type_lattice.canonicalize_annotation(annotation, local_aliases)
+
+    @staticmethod
+    def replay(calls: List[Tuple[str, Tuple]], type_lattice: TypeLatticeGenerator) -> None:
+        for method_name, args in calls:
+            getattr(type_lattice, method_name)(*args)
+
+
+class ExtractionCache:
+    """
+    An on-disk cache of extracted graphs, keyed by the contents of the source file.
+
+    Entries also store the modifications that the file made to the type lattice, so that a cache hit leaves the
+    lattice in the same state as extracting the file. The key also covers the extractor code, the typing rules and
+    the project-specific aliases in effect (which are used to canonicalize annotations), so that any change of these
+    invalidates the entries.
+    """
+    def __init__(self, cache_dir: str, typing_rules_path: str):
+        self.__cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__extractor_version = self.__compute_extractor_version(typing_rules_path)
+        self.num_hits = 0
+        self.num_misses = 0
+
+    @staticmethod
+    def __compute_extractor_version(typing_rules_path: str) -> bytes:
+        extractor_hash = hashlib.sha256()
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        for source_file in sorted(iglob(os.path.join(source_dir, '**', '*.py'), recursive=True)):
+            extractor_hash.update(os.path.relpath(source_file, source_dir).encode())
+            with open(source_file, 'rb') as f:
+                extractor_hash.update(f.read())
+        with open(typing_rules_path, 'rb') as f:
+            extractor_hash.update(f.read())
+        return extractor_hash.digest()
+
+    def key_for(self, source_code: str, type_lattice: TypeLatticeGenerator) -> str:
+        key = hashlib.sha256(self.__extractor_version)
+        aliases = sorted((repr(k), repr(v)) for k, v in type_lattice.project_specific_aliases.items())
+        key.update(repr(aliases).encode())
+        key.update(source_code.encode('utf-8', errors='surrogatepass'))
+        return key.hexdigest()
+
+    def __path_for(self, key: str) -> str:
+        return os.path.join(self.__cache_dir, key[:2], key + '.pkl.gz')
+
+    def get(self, key: str) -> Optional[Tuple[Dict[str, Any], List[Tuple[str, Tuple]]]]:
+        """Return the graph and recorded lattice calls stored for key, if any."""
+        path = self.__path_for(key)
+        if not os.path.exists(path):
+            self.num_misses += 1
+            return None
+        try:
+            with gzip.open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            # A corrupt entry is just a miss, it will be overwritten.
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        return entry['graph'], entry['lattice_calls']
+
+    def put(self, key: str, graph: Dict[str, Any], lattice_calls: List[Tuple[str, Tuple]]) -> None:
+        path = self.__path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write atomically, since several worker processes may share the cache.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw_f, gzip.GzipFile(fileobj=raw_f, mode='wb') as f:
+                pickle.dump({'graph': graph, 'lattice_calls': lattice_calls}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
@@ -1,11 +1,9 @@
-import keyword
 import logging
-import re
+from array import array
 from collections import defaultdict, Counter
 from symtable import symtable, Symbol
-from typing import Any, Dict, Optional, Set, Union, List, FrozenSet
+from typing import Any, Dict, Optional, Set, Tuple, Union, List, FrozenSet
 
-from dpu_utils.codeutils import split_identifier_into_parts
 from dpu_utils.utils import run_and_debug
 from typed_ast.ast3 import Add, Sub, Mult, Div, FloorDiv, Mod, LShift, RShift, BitOr, BitAnd, BitXor, Pow, MatMult, \
     ExtSlice, Index, Compare, Await, Lambda, arg, Global, Nonlocal, arguments, Name, comprehension, alias, \
@@ -18,7 +16,8 @@ from typed_ast.ast3 import NodeVisitor, parse, AST, FunctionDef, AsyncFunctionDe
     IfExp, Call
 
 from .dataflowpass import DataflowPass
-from .graphgenutils import EdgeType, TokenNode, StrSymbol, SymbolInformation
+from .graphgenutils import EdgeType, TokenNode, StrSymbol, SymbolInformation, get_identifier_subtokens
+from .symboltableindex import SymbolTableIndex
 from .type_lattice_generator import TypeLatticeGenerator
 from .typeparsing import parse_type_annotation_node, parse_type_comment, TypeAnnotationNode
 
@@ -31,10 +30,18 @@ class AstGraphGenerator(NodeVisitor):
 
         self.__symbol_to_supernode_id: Dict[Symbol, int] = {}
 
-        self.__edges: Dict[EdgeType, Dict[int, Set[int]]] = {e: defaultdict(set) for e in EdgeType}
+        # Edges are appended to one pair of (from, to) arrays per edge type, and de-duplicated when the graph is built.
+        # Only the edge types that are queried while building the graph are (also) kept as adjacency sets.
+        self.__edge_buffers: Dict[EdgeType, Tuple[array, array]] = {e: (array('i'), array('i')) for e in EdgeType
+                                                                     if e not in self.QUERIED_EDGE_TYPES}
+        self.__queried_edges: Dict[EdgeType, Dict[int, Set[int]]] = {e: defaultdict(set) for e in self.QUERIED_EDGE_TYPES}
+        # Indices of the CHILD edges to token nodes (by label) and of the OCCURRENCE_OF edges, for the dataflow pass
+        self.__token_children_by_label: Dict[int, Dict[str, TokenNode]] = defaultdict(dict)
+        self.__occurrence_symbol_idx: Dict[int, int] = {}
 
         self.__ast = parse(source)
         self.__scope_symtable = [ symtable(source, 'file.py', 'exec') ]
+        self.__symtable_index = SymbolTableIndex(self.__scope_symtable[0])
         self.__symtable_usage_count = Counter()
 
         self.__imported_symbols = {}  # type: Dict[TypeAnnotationNode, TypeAnnotationNode]
@@ -102,10 +109,11 @@ class AstGraphGenerator(NodeVisitor):
         USub: '-'
     }
 
-    IDENTIFER_REGEX = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
-
     BUILT_IN_METHODS_TO_KEEP = frozenset({"__getitem__", "__setitem__", "__enter__", "__call__"})
 
+    # Edge types whose targets can be retrieved with _get_edge_targets
+    QUERIED_EDGE_TYPES = frozenset({EdgeType.NEXT_USE})
+
     # endregion
 
     def build(self):
@@ -144,7 +152,7 @@ class AstGraphGenerator(NodeVisitor):
 
         return {
             'nodes': [self.node_to_label(n) for n in self.__id_to_node],
-            'edges': {e.name: {f: list(t) for f, t in v.items() if len(t) > 0} for e, v in self.__edges.items() if len(v) > 0},
+            'edges': {e.name: v for e, v in self.__get_edges().items() if len(v) > 0},
             'token-sequence': [self.__node_to_id[t] for t in self.__backbone_sequence],
             'supernodes': {self.__node_to_id[node]: parse_symbol_info(symbol_info)
                            for node, symbol_info in self.__variable_like_symbols.items()
@@ -152,29 +160,21 @@ class AstGraphGenerator(NodeVisitor):
         }
 
     def __add_subtoken_of_edges(self):
-        def is_identifier_node(n):
-            if not isinstance(n, str) and not isinstance(n, TokenNode):
-                return False
-            if not self.IDENTIFER_REGEX.fullmatch(str(n)):
-                return False
-            if keyword.iskeyword(str(n)):
-                return False
-            if n == self.INDENT or n == self.DEDENT or n == self.NLINE:
-                return False
-            return True
-
-        all_identifier_like_nodes: Set[TokenNode] = {n for n in self.__node_to_id if is_identifier_node(n)}
-        subtoken_nodes: Dict[str, TokenNode] = {}
-
-        for node in all_identifier_like_nodes:
-            for subtoken in split_identifier_into_parts(str(node)):
-                if subtoken == '_':
-                    continue
-                subtoken_dummy_node = subtoken_nodes.get(subtoken)
-                if subtoken_dummy_node is None:
-                    subtoken_dummy_node = TokenNode(subtoken)
-                    subtoken_nodes[subtoken] = subtoken_dummy_node
-                self._add_edge(subtoken_dummy_node, node, EdgeType.SUBTOKEN_OF)
+        # Collected first, since the subtoken nodes are added to the graph below:
+        token_nodes = [(node, node_idx) for node, node_idx in self.__node_to_id.items()
+                       if isinstance(node, (str, TokenNode))]
+        subtoken_node_idxs: Dict[str, int] = {}
+
+        # Appended to the edge buffer directly, as all node ids are known (duplicates are removed in build()):
+        from_node_idxs, to_node_idxs = self.__edge_buffers[EdgeType.SUBTOKEN_OF]
+        for node, node_idx in token_nodes:
+            for subtoken in get_identifier_subtokens(str(node)):
+                subtoken_node_idx = subtoken_node_idxs.get(subtoken)
+                if subtoken_node_idx is None:
+                    subtoken_node_idx = self.__node_id(TokenNode(subtoken))
+                    subtoken_node_idxs[subtoken] = subtoken_node_idx
+                from_node_idxs.append(subtoken_node_idx)
+                to_node_idxs.append(node_idx)
 
     def __node_id(self, node: Union[AST, TokenNode]) -> int:
         assert not isinstance(node, int), 'Node should be an object not its int id'
@@ -192,11 +192,49 @@ class AstGraphGenerator(NodeVisitor):
     def _add_edge(self, from_node: Union[AST, TokenNode], to_node: Union[AST, TokenNode], edge_type: EdgeType) -> None:
         from_node_idx = self.__node_id(from_node)
         to_node_idx = self.__node_id(to_node)
-        self.__edges[edge_type][from_node_idx].add(to_node_idx)
+        if edge_type in self.QUERIED_EDGE_TYPES:
+            self.__queried_edges[edge_type][from_node_idx].add(to_node_idx)
+        else:
+            from_node_idxs, to_node_idxs = self.__edge_buffers[edge_type]
+            from_node_idxs.append(from_node_idx)
+            to_node_idxs.append(to_node_idx)
+        if edge_type == EdgeType.CHILD and isinstance(to_node, TokenNode):
+            self.__token_children_by_label[from_node_idx].setdefault(to_node.token, to_node)
+        elif edge_type == EdgeType.OCCURRENCE_OF:
+            symbol_idx = self.__occurrence_symbol_idx.setdefault(from_node_idx, to_node_idx)
+            assert symbol_idx == to_node_idx, 'A node can be the occurrence of only one symbol'
 
     def _get_edge_targets(self, from_node, edge_type: EdgeType) -> FrozenSet:
+        assert edge_type in self.QUERIED_EDGE_TYPES, f'Targets of {edge_type} edges are not indexed'
         from_node_idx = self.__node_id(from_node)
-        return frozenset(self._get_node(n) for n in self.__edges[edge_type][from_node_idx])
+        return frozenset(self._get_node(n) for n in self.__queried_edges[edge_type].get(from_node_idx, ()))
+
+    def __get_edges(self) -> Dict[EdgeType, Dict[int, List[int]]]:
+        """The de-duplicated edges of each type, as adjacency lists."""
+        edges = {}  # type: Dict[EdgeType, Dict[int, List[int]]]
+        for edge_type in EdgeType:
+            if edge_type in self.QUERIED_EDGE_TYPES:
+                edges[edge_type] = {f: list(t) for f, t in self.__queried_edges[edge_type].items() if len(t) > 0}
+                continue
+            adjacency = {}  # type: Dict[int, Dict[int, None]]
+            for from_node_idx, to_node_idx in zip(*self.__edge_buffers[edge_type]):
+                adjacency.setdefault(from_node_idx, {})[to_node_idx] = None
+            edges[edge_type] = {f: list(t) for f, t in adjacency.items()}
+        return edges
+
+    def _get_token_child(self, parent_node: Union[AST, TokenNode], label: str) -> Optional[TokenNode]:
+        """The (first added) token node with the given label that is a CHILD of parent_node, if any."""
+        parent_node_idx = self.__node_to_id.get(parent_node)
+        if parent_node_idx is None:
+            return None
+        return self.__token_children_by_label.get(parent_node_idx, {}).get(label)
+
+    def _get_occurrence_symbol(self, node: Union[AST, TokenNode]) -> Optional[Any]:
+        """The symbol that node is an OCCURRENCE_OF, if any."""
+        symbol_idx = self.__occurrence_symbol_idx.get(self.__node_to_id.get(node))
+        if symbol_idx is None:
+            return None
+        return self._get_node(symbol_idx)
 
     def visit(self, node: AST):
         """Visit a node adding the Child edge."""
@@ -284,16 +322,9 @@ class AstGraphGenerator(NodeVisitor):
             if self.__scope_symtable[-1].get_type() == 'class' and name.startswith('__') and not name.endswith('__'):
                 name = '_' + self.__scope_symtable[-1].get_name() + name
 
-            current_idx = len(self.__scope_symtable) - 1
-            while current_idx >= 0:
-                try:
-                    symbol = self.__scope_symtable[current_idx].lookup(name)
-                    break
-                except KeyError:
-                    current_idx -= 1
-            else:
+            symbol = self.__symtable_index.resolve(self.__scope_symtable, name)
+            if symbol is None:
                 logging.warning(f'Symbol "{name}"@{lineno}:{col_offset} Not Found!')
-                symbol = None
         elif isinstance(name, Attribute):
             node = name
             # Heuristic: create symbols only for attributes of the form X.Y and X.Y.Z
@@ -342,30 +373,27 @@ class AstGraphGenerator(NodeVisitor):
         When there are several alike elements at the same level (e.g., multiple lambdas) it's hard to choose between
         them and we need some tweaks: we pick the one which was used less times, among them -- the first one.
         """
-        occurrences = []
-        for child_symtable in self.__scope_symtable[-1].get_children():
-            if child_symtable.get_type() == symtable_type and child_symtable.get_name() == name:
-                occurrences.append(child_symtable)
-
+        occurrences = self.__symtable_index.get_children(self.__scope_symtable[-1], symtable_type, name)
         if len(occurrences) == 0:
             raise ValueError(f'Symbol Table for {name} of type {symtable_type} at {lineno} not found')
 
+        # Pick all the closest symtables in the right direction
         should_reverse = name in ['listcomp', 'dictcomp', 'setcomp', 'genexpr']
-        occurrences.sort(key=lambda table: table.get_lineno(), reverse=should_reverse)
-
-        closest_matching = []
-        for child_symtable in occurrences:
-            if lineno is not None and (
-                    (not should_reverse and child_symtable.get_lineno() >= lineno) or
-                    (should_reverse and child_symtable.get_lineno() <= lineno)
-            ):
-                # Pick all the closest symtables in the right direction
-                if len(closest_matching) == 0 or closest_matching[0].get_lineno() == child_symtable.get_lineno():
-                    closest_matching.append(child_symtable)
+        if lineno is None:
+            closest_matching = []
+        else:
+            closest_matching = self.__symtable_index.get_closest_children(self.__scope_symtable[-1], symtable_type,
+                                                                          name, lineno, search_backwards=should_reverse)
 
         if len(closest_matching) == 0:
-            self.__scope_symtable.append(occurrences[-1])
-            self.__symtable_usage_count[occurrences[-1].get_id()] += 1
+            # The last one in the search direction (of the tables on the same line, the last one):
+            fallback_table = occurrences[-1]
+            if should_reverse:
+                fallback_table = self.__symtable_index.get_closest_children(
+                    self.__scope_symtable[-1], symtable_type, name, occurrences[0].get_lineno(),
+                    search_backwards=True)[-1]
+            self.__scope_symtable.append(fallback_table)
+            self.__symtable_usage_count[fallback_table.get_id()] += 1
         else:
             # If there are multiple matching symtables (e.g., [lambda x: x, lambda: lambda x: x]), select the one that
             # was used less times, since the order is right.
@@ -1012,7 +1040,8 @@ class AstGraphGenerator(NodeVisitor):
     def to_dot(self, filename: str, initial_comment: str='', draw_only_edge_types: Optional[Set[EdgeType]]=None) -> None:
         nodes_to_be_drawn = set()
 
-        for edge_type, edges in self.__edges.items():
+        all_edges = self.__get_edges()
+        for edge_type, edges in all_edges.items():
             if draw_only_edge_types is not None and edge_type not in draw_only_edge_types:
                 continue
             for from_idx, to_idxs in edges.items():
@@ -1035,7 +1064,7 @@ class AstGraphGenerator(NodeVisitor):
                     node_lbl += f":L{node.lineno}:{node.col_offset if hasattr(node, 'col_offset') else -1}"
                 f.write(f'\t node{node_idx}[shape="rectangle", label="{node_lbl}"];\n')
 
-            for edge_type, edges in self.__edges.items():
+            for edge_type, edges in all_edges.items():
                 if draw_only_edge_types is not None and edge_type not in draw_only_edge_types:
                     continue
                 for from_idx, to_idxs in edges.items():
@@ -1,9 +1,14 @@
+import keyword
+import re
 import typing
 from enum import Enum, auto
-from typing import Optional, NamedTuple, List, Dict
+from typing import Optional, NamedTuple, List, Dict, Tuple
 
+from .compactgraphs import split_into_subtokens
 from .typeparsing import TypeAnnotationNode
 
+IDENTIFIER_REGEX = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+
 
 class EdgeType(Enum):
     CHILD = auto()
@@ -18,6 +23,8 @@ class EdgeType(Enum):
 
 class TokenNode:
     """A wrapper around token nodes, such that an object-identity is used for comparing nodes."""
+    __slots__ = ('token', 'lineno', 'col_offset')
+
     def __init__(self, token: str, lineno: Optional[int]=None, col_offset: Optional[int]=None):
         assert isinstance(token, str)
         self.token = token
@@ -29,6 +36,8 @@ class TokenNode:
 
 
 class StrSymbol:
+    __slots__ = ('name',)
+
     def __init__(self, name: str):
         self.name = name
 
@@ -52,4 +61,11 @@ class SymbolInformation(NamedTuple):
 
     @classmethod
     def create(cls, name: str, symbol_type: str) -> 'SymbolInformation':
-        return SymbolInformation(name, [], {}, symbol_type)
\ No newline at end of file
+        return SymbolInformation(name, [], {}, symbol_type)
+
+
+def get_identifier_subtokens(label: str) -> Tuple[str, ...]:
+    """The subtokens of label (without "_"), or none if label is not an identifier (e.g., a keyword or literal)."""
+    if not IDENTIFIER_REGEX.fullmatch(label) or keyword.iskeyword(label):
+        return ()
+    return tuple(subtoken for subtoken in split_into_subtokens(label) if subtoken != '_')
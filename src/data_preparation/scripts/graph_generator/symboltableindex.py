@@ -0,0 +1,67 @@
+from bisect import bisect_left, bisect_right
+from symtable import SymbolTable, Symbol
+from typing import Dict, KeysView, List, Optional, Tuple
+
+
+class SymbolTableIndex:
+    """
+    An index of all symbol tables of a module, built once per file, to find the child table of a scope and to resolve
+    names in nested scopes without scanning the symbol tables again and again.
+
+    Each scope is represented by a single SymbolTable object, so that a scope yields the same Symbol objects however
+    often it is entered.
+    """
+    def __init__(self, module_table: SymbolTable):
+        # (table id, child type, child name) -> (children sorted by line number, their line numbers)
+        self.__children: Dict[Tuple[int, str, str], Tuple[List[SymbolTable], List[int]]] = {}
+        self.__identifiers: Dict[int, KeysView[str]] = {}
+        # (id of the innermost table, name) -> the symbol the name resolves to, if any
+        self.__resolved_symbols: Dict[Tuple[int, str], Optional[Symbol]] = {}
+
+        tables_to_index = [module_table]
+        while len(tables_to_index) > 0:
+            table = tables_to_index.pop()
+            self.__identifiers[table.get_id()] = table.get_identifiers()
+            children_by_kind: Dict[Tuple[str, str], List[SymbolTable]] = {}
+            for child_table in table.get_children():
+                children_by_kind.setdefault((child_table.get_type(), child_table.get_name()), []).append(child_table)
+                tables_to_index.append(child_table)
+            for (child_type, child_name), children in children_by_kind.items():
+                children.sort(key=lambda t: t.get_lineno())
+                self.__children[(table.get_id(), child_type, child_name)] = \
+                    children, [t.get_lineno() for t in children]
+
+    def get_children(self, table: SymbolTable, child_type: str, child_name: str) -> List[SymbolTable]:
+        """The child tables of table with the given type and name, sorted by line number."""
+        return self.__children.get((table.get_id(), child_type, child_name), ([], []))[0]
+
+    def get_closest_children(self, table: SymbolTable, child_type: str, child_name: str, lineno: int,
+                             search_backwards: bool) -> List[SymbolTable]:
+        """
+        The child tables of table with the given type and name that are closest to lineno, at or after it (or at or
+        before it, if search_backwards). All of them are on the same line.
+        """
+        children, linenos = self.__children.get((table.get_id(), child_type, child_name), ([], []))
+        if search_backwards:
+            end = bisect_right(linenos, lineno)
+            if end == 0:
+                return []
+            return children[bisect_left(linenos, linenos[end - 1]):end]
+        start = bisect_left(linenos, lineno)
+        if start == len(linenos):
+            return []
+        return children[start:bisect_right(linenos, linenos[start])]
+
+    def resolve(self, scope_stack: List[SymbolTable], name: str) -> Optional[Symbol]:
+        """Look up name in the innermost scope of scope_stack that defines it."""
+        key = (scope_stack[-1].get_id(), name)
+        # The scopes below the innermost one are always its enclosing scopes, so the key determines the result:
+        if key in self.__resolved_symbols:
+            return self.__resolved_symbols[key]
+        symbol = None
+        for table in reversed(scope_stack):
+            if name in self.__identifiers[table.get_id()]:
+                symbol = table.lookup(name)
+                break
+        self.__resolved_symbols[key] = symbol
+        return symbol
@@ -56,6 +56,10 @@ class TypeLatticeGenerator():
 
         self.__compute_non_generic_types()
 
+        # What the typing rules alone define. Anything beyond this is project-specific.
+        self.__num_rule_types = len(self.__ids_to_nodes)
+        self.__rule_is_a_edges = frozenset((from_idx, to_idx) for from_idx, to_idxs in self.is_a_edges.items() for to_idx in to_idxs)
+
         self.__type_erasure = EraseOnceTypeRemoval()
         self.__direct_inheritance_rewriting = DirectInheritanceRewriting(
             self.__is_a_relationships,
@@ -65,6 +69,10 @@ class TypeLatticeGenerator():
         self.__rewrites_verbose_annotations = RewriteRuleVisitor([RemoveUnionWithAnys(), RemoveStandAlones(), RemoveRecursiveGenerics(), RemoveGenericWithAnys()])
         assert len(self.__ids_to_nodes) == len(set(repr(r) for r in self.__ids_to_nodes))
 
+    @property
+    def project_specific_aliases(self) -> Dict[TypeAnnotationNode, TypeAnnotationNode]:
+        return self.__project_specific_aliases
+
     def create_alias_replacement(self, imported_symbols: Dict[TypeAnnotationNode, TypeAnnotationNode]) -> AliasReplacementVisitor:
         return AliasReplacementVisitor(ChainMap(imported_symbols, self.__project_specific_aliases, self.__aliases))
 
@@ -224,6 +232,29 @@ class TypeLatticeGenerator():
             return None
         return annotation.accept_visitor(self.create_alias_replacement(local_aliases))
 
+    def export_project_types(self) -> Tuple[List[TypeAnnotationNode], List[Tuple[TypeAnnotationNode, TypeAnnotationNode]]]:
+        """
+        Return the types and is-a relationships that were added on top of the typing rules, in a deterministic
+        order. Used to transfer the lattice of a project built in a worker process into another lattice.
+        """
+        new_types = self.__ids_to_nodes[self.__num_rule_types:]
+        new_is_a_relationships = []
+        for from_type_idx in sorted(self.is_a_edges):
+            for to_type_idx in sorted(self.is_a_edges[from_type_idx]):
+                if (from_type_idx, to_type_idx) not in self.__rule_is_a_edges:
+                    new_is_a_relationships.append((self.__ids_to_nodes[from_type_idx], self.__ids_to_nodes[to_type_idx]))
+        return new_types, new_is_a_relationships
+
+    def merge_project_types(self, types: List[TypeAnnotationNode],
+                            is_a_relationships: List[Tuple[TypeAnnotationNode, TypeAnnotationNode]]) -> None:
+        """Merge the output of `export_project_types()` of another lattice built from the same typing rules."""
+        for type_annotation in types:
+            self.__annotation_to_id(type_annotation)
+        for from_type, to_type in is_a_relationships:
+            self.__add_is_a_relationship(from_type, to_type)
+        for type_annotation in types:
+            self.__processed.add(type_annotation)
+
     def return_json(self) -> Dict[str, Any]:
         edges = []
         for from_type_idx, to_type_idxs in self.is_a_edges.items():
@@ -16,6 +16,7 @@ class FaultyAnnotation(Exception):
     pass
 
 class TypeAnnotationNode(ABC):
+    __slots__ = ()
 
     @abstractmethod
     def size(self) -> int:
@@ -36,6 +37,8 @@ class TypeAnnotationNode(ABC):
 
 
 class SubscriptAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('value', 'slice')
+
     def __init__(self, value: TypeAnnotationNode, slice: Optional[TypeAnnotationNode]):
         self.value = value
         self.slice = slice
@@ -73,6 +76,8 @@ class SubscriptAnnotationNode(TypeAnnotationNode):
 
 
 class TupleAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('elements',)
+
     def __init__(self, elements: Iterator[TypeAnnotationNode]):
         self.elements = tuple(elements)
 
@@ -104,6 +109,8 @@ class TupleAnnotationNode(TypeAnnotationNode):
 
 
 class NameAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('identifier',)
+
     def __init__(self, identifier: str):
         self.identifier = identifier
 
@@ -131,6 +138,8 @@ class NameAnnotationNode(TypeAnnotationNode):
 
 
 class ListAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('elements',)
+
     def __init__(self, elements: Iterator[TypeAnnotationNode]):
         self.elements = tuple(elements)
 
@@ -161,6 +170,8 @@ class ListAnnotationNode(TypeAnnotationNode):
 
 
 class AttributeAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('value', 'attribute')
+
     def __init__(self, value: TypeAnnotationNode, attribute: str):
         self.value = value
         assert isinstance(attribute, str), type(attribute)
@@ -192,6 +203,8 @@ class AttributeAnnotationNode(TypeAnnotationNode):
 
 
 class IndexAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('value',)
+
     def __init__(self, value: TypeAnnotationNode):
         self.value = value
 
@@ -219,6 +232,8 @@ class IndexAnnotationNode(TypeAnnotationNode):
 
 
 class ElipsisAnnotationNode(TypeAnnotationNode):
+    __slots__ = ()
+
     def __init__(self):
         pass
 
@@ -243,6 +258,8 @@ class ElipsisAnnotationNode(TypeAnnotationNode):
 
 
 class NameConstantAnnotationNode(TypeAnnotationNode):
+    __slots__ = ('value',)
+
     def __init__(self, value: Any):
         self.value = value
 
@@ -271,6 +288,8 @@ class NameConstantAnnotationNode(TypeAnnotationNode):
 
 
 class UnknownAnnotationNode(TypeAnnotationNode):
+    __slots__ = ()
+
     def __init__(self):
         import pdb; pdb.set_trace()
         pass
@@ -41,6 +41,6 @@ for repo in ./raw_repos/*; do
 readonly SRC_BASE="/usr/src/datasetbuilder/scripts/"
 export PYTHONPATH="$SRC_BASE"
 mkdir -p graph-dataset
-python3 "$SRC_BASE"graph_generator/extract_graphs.py ./raw_repos/ ./corpus_duplicates.json ./graph-dataset $SRC_BASE/../metadata/typingRules.json --debug
+python3 -m graph_generator.extract_graphs ./raw_repos/ ./corpus_duplicates.json ./graph-dataset $SRC_BASE/../metadata/typingRules.json --debug
 mkdir -p graph-dataset-split
 python3 "$SRC_BASE"utils/split.py -data-dir ./graph-dataset -out-dir ./graph-dataset-split
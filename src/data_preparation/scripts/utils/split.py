@@ -4,10 +4,14 @@ from dpu_utils.utils import ChunkWriter
 import hashlib
 import logging
 import os
+import sys
 from tqdm import tqdm
 from glob import iglob
 from typing import Set
 
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from graph_generator.compactgraphs import CompactGraphChunkWriter, load_compact_graph_chunk, FILE_SUFFIX
+
 
 def get_fold( filename: str, train_ratio: float, valid_ratio: float) -> str:
     # Copied from: https://github.com/microsoft/graph-based-code-modelling/blob/master/Models/utils/dataset_split.py#L24
@@ -24,7 +28,7 @@ def get_fold( filename: str, train_ratio: float, valid_ratio: float) -> str:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-data-dir", help="path to data directory containing .gz files")
+    parser.add_argument("-data-dir", help="path to data directory containing .jsonl.gz or .graphs.npz files")
     parser.add_argument("-out-dir", help="path to output directory")
     parser.add_argument(
         "-train-pct",
@@ -40,12 +44,20 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
+    # Keep the format of the input graphs, as written by extract_graphs.py
+    if any(True for _ in iglob(os.path.join(args.data_dir, "*" + FILE_SUFFIX))):
+        input_files = iglob(os.path.join(args.data_dir, "*" + FILE_SUFFIX))
+        load_graphs = load_compact_graph_chunk
+        make_writer = lambda fold: CompactGraphChunkWriter(os.path.join(args.out_dir, fold), file_prefix='graph-', max_chunk_size=1000)
+    else:
+        input_files = iglob(os.path.join(args.data_dir, "*.jsonl.gz"))
+        load_graphs = load_jsonl_gz
+        make_writer = lambda fold: ChunkWriter(os.path.join(args.out_dir, fold), file_prefix='graph-', max_chunk_size=1000, file_suffix='.jsonl.gz')
+
     num_train, num_valid, num_test = 0, 0, 0
-    with ChunkWriter(os.path.join(args.out_dir, 'train'), file_prefix='graph-', max_chunk_size=1000, file_suffix='.jsonl.gz') as train_w,\
-        ChunkWriter(os.path.join(args.out_dir, 'valid'), file_prefix='graph-', max_chunk_size=1000, file_suffix='.jsonl.gz') as valid_w,\
-        ChunkWriter(os.path.join(args.out_dir, 'test'), file_prefix='graph-', max_chunk_size=1000, file_suffix='.jsonl.gz') as test_w:
-        for f in tqdm(iglob(os.path.join(args.data_dir, "*.jsonl.gz"))):
-            for ex in load_jsonl_gz(f):
+    with make_writer('train') as train_w, make_writer('valid') as valid_w, make_writer('test') as test_w:
+        for f in tqdm(input_files):
+            for ex in load_graphs(f):
                 partition = get_fold(
                     ex["filename"], args.train_pct, args.valid_pct
                 )
@@ -1,13 +1,13 @@
 import logging
 from abc import abstractmethod
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
 import numpy as np
 import tensorflow as tf
 
 from .components.tokenembedder import TokenEmbedder
 from .components.sparsegnn import SparseGGNN
-from .model import Model, write_to_minibatch
+from .model import Model, write_to_minibatch, write_concatenated_to_minibatch
 
 
 class CodeGraphModel(Model):
@@ -168,6 +168,10 @@ class CodeGraphModel(Model):
 
         edges_per_type = {}
         for edge_type, edge_dict in raw_sample['edges'].items():
+            if isinstance(edge_dict, np.ndarray):
+                # Compact graphs already store edges as (E, 2) arrays.
+                edges_per_type[edge_type] = edge_dict
+                continue
             edge_list = []
             for from_idx, to_idxs in edge_dict.items():
                 from_idx = int(from_idx)
@@ -215,6 +219,7 @@ class CodeGraphModel(Model):
         super()._init_minibatch(batch_data)
 
         batch_data['cg_node_offset'] = 0
+        batch_data['cg_sample_node_offsets'] = []
 
         TokenEmbedder.init_minibatch('cg_node_label', batch_data, self.hyperparameters)
         batch_data['cg_adjacency_lists'] = [[] for _ in self.metadata['cg_edge_type_dict']]
@@ -228,14 +233,22 @@ class CodeGraphModel(Model):
 
         TokenEmbedder.extend_minibatch_by_sample('cg_node_label', batch_data, sample, self.hyperparameters)
 
-        batch_data['cg_num_incoming_edges_per_type'].extend(sample['cg_num_incoming_edges_per_type'])
-        batch_data['cg_num_outgoing_edges_per_type'].extend(sample['cg_num_outgoing_edges_per_type'])
+        # Only collect references to the sample's arrays here, they are concatenated in _finalise_minibatch:
+        batch_data['cg_num_incoming_edges_per_type'].append(sample['cg_num_incoming_edges_per_type'])
+        batch_data['cg_num_outgoing_edges_per_type'].append(sample['cg_num_outgoing_edges_per_type'])
         for edge_type in self.metadata['cg_edge_type_dict'].values():
-            batch_data['cg_adjacency_lists'][edge_type].extend(sample['cg_edges'][edge_type] + batch_data['cg_node_offset'])
+            batch_data['cg_adjacency_lists'][edge_type].append(sample['cg_edges'][edge_type])
+        batch_data['cg_sample_node_offsets'].append(batch_data['cg_node_offset'])
 
         batch_data['cg_node_offset'] += sample['num_nodes']
         return batch_data['cg_node_offset'] >= self.hyperparameters['max_num_cg_nodes_in_batch']
 
+    def _get_batch_packing_budget(self) -> Optional[int]:
+        return self.hyperparameters['max_num_cg_nodes_in_batch']
+
+    def _get_batch_packing_info(self, sample: Dict[str, Any]) -> Tuple[int, int]:
+        return sample['num_nodes'], sum(len(edges) for edges in sample['cg_edges'])
+
     @abstractmethod
     def _finalise_minibatch(self, batch_data: Dict[str, Any], is_train: bool) -> Dict[tf.Tensor, Any]:
         minibatch = super()._finalise_minibatch(batch_data, is_train)
@@ -243,10 +256,11 @@ class CodeGraphModel(Model):
         TokenEmbedder.finalise_minibatch('cg_node_label', batch_data, self.placeholders, minibatch, self.hyperparameters, is_train)
 
         if self.hyperparameters['cg_ggnn_use_edge_bias'] or self.hyperparameters['cg_ggnn_use_edge_msg_avg_aggregation']:
-            write_to_minibatch(minibatch, self.placeholders['cg_num_incoming_edges_per_type'], batch_data['cg_num_incoming_edges_per_type'])
-            write_to_minibatch(minibatch, self.placeholders['cg_num_outgoing_edges_per_type'], batch_data['cg_num_outgoing_edges_per_type'])
+            write_concatenated_to_minibatch(minibatch, self.placeholders['cg_num_incoming_edges_per_type'], batch_data['cg_num_incoming_edges_per_type'])
+            write_concatenated_to_minibatch(minibatch, self.placeholders['cg_num_outgoing_edges_per_type'], batch_data['cg_num_outgoing_edges_per_type'])
 
         for edge_type_idx, adjacency_list in enumerate(batch_data['cg_adjacency_lists']):
-            write_to_minibatch(minibatch, self.placeholders['cg_adjacency_lists'][edge_type_idx], adjacency_list)
+            write_concatenated_to_minibatch(minibatch, self.placeholders['cg_adjacency_lists'][edge_type_idx], adjacency_list,
+                                            batch_data['cg_sample_node_offsets'])
 
         return minibatch
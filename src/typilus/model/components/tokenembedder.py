@@ -1,13 +1,16 @@
 import re
+import weakref
 from collections import Counter
-from typing import Dict, Any, List
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple
 
 import numpy as np
 import tensorflow as tf
-from dpu_utils.codeutils import split_identifier_into_parts
 from dpu_utils.mlutils import Vocabulary
 
-from typilus.model.model import write_to_minibatch
+from data_preparation.scripts.graph_generator.compactgraphs import split_into_subtokens
+from typilus.model.countsketch import make_counter, merge_counters, most_common_counter
+from typilus.model.model import write_concatenated_to_minibatch
 from .component import Component
 
 ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789,;.!?:'\"/\\|_@#$%^&*~`+-=<>()[]{}"
@@ -15,6 +18,24 @@ ALPHABET_DICT = {char: idx + 2 for (idx, char) in enumerate(ALPHABET)}  # "0" is
 ALPHABET_DICT["PAD"] = 0
 ALPHABET_DICT["UNK"] = 1
 
+# Node labels repeat a lot across a corpus, so the ids of labels are memoized per vocabulary (in each process), in
+# tables of at most this many labels.
+MAX_LABEL_CACHE_SIZE = 1000000
+
+# Caches per vocabulary, then per (kind, max_num_subtokens). Keyed on the vocabulary object itself (not its id, which
+# can be reused), and dropped along with it.
+_label_id_caches = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+
+def _get_label_id_cache(kind: str, vocab: Vocabulary, max_num_subtokens: int = 0) -> Dict[str, Any]:
+    vocab_caches = _label_id_caches.get(vocab)
+    if vocab_caches is None:
+        vocab_caches = _label_id_caches[vocab] = {}
+    cache = vocab_caches.setdefault((kind, max_num_subtokens), {})
+    if len(cache) >= MAX_LABEL_CACHE_SIZE:
+        cache.clear()
+    return cache
+
 class TokenEmbedder(Component):
 
     STRING_LITERAL_REGEX = re.compile('^[fub]?["\'](.*)["\']$')
@@ -23,6 +44,7 @@ class TokenEmbedder(Component):
     FLOAT_LITERAL = '$FloatLiteral$'
 
     @staticmethod
+    @lru_cache(maxsize=MAX_LABEL_CACHE_SIZE)
     def filter_literals(token: str) -> str:
         try:
             v = int(token)
@@ -168,9 +190,9 @@ class TokenEmbedder(Component):
     def init_metadata(name: str, raw_metadata: Dict[str, Any], hyperparameters: Dict[str, Any]) -> None:
         label_embedding_style = hyperparameters[f'{name}_embedding_style'].lower()
         if label_embedding_style == 'token':
-            raw_metadata[f'{name}_counter'] = Counter()
+            raw_metadata[f'{name}_counter'] = make_counter(hyperparameters)
         elif label_embedding_style == 'subtoken':
-            raw_metadata[f'{name}_subtoken_counter'] = Counter()
+            raw_metadata[f'{name}_subtoken_counter'] = make_counter(hyperparameters)
 
     @staticmethod
     def load_metadata_from_sample(name: str, raw_sample: List[str], raw_metadata: Dict[str, Any],
@@ -178,28 +200,33 @@ class TokenEmbedder(Component):
         label_embedding_style = hyperparameters[f'{name}_embedding_style'].lower()
 
         if label_embedding_style == 'token':
-            for label_token in raw_sample:
-                raw_metadata[f'{name}_counter'][label_token] += 1
+            raw_metadata[f'{name}_counter'].update(raw_sample)
         elif label_embedding_style == 'subtoken':
-            for label_token in raw_sample:
+            # Count each distinct label once, and split it once:
+            subtoken_counter = Counter()
+            for label_token, count in Counter(raw_sample).items():
                 filtered_token = TokenEmbedder.filter_literals(label_token)
                 if filtered_token != label_token:
-                    raw_metadata[f'{name}_subtoken_counter'][label_token] += 1  # Do not subtokenize
+                    subtoken_counter[label_token] += count  # Do not subtokenize
                 else:
-                    for subtoken in split_identifier_into_parts(label_token):
-                        raw_metadata[f'{name}_subtoken_counter'][subtoken] += 1
+                    for subtoken in TokenEmbedder.split_into_subtokens(label_token):
+                        subtoken_counter[subtoken] += count
+            raw_metadata[f'{name}_subtoken_counter'].update(subtoken_counter)
+
+    @staticmethod
+    def split_into_subtokens(label: str) -> Tuple[str, ...]:
+        # Shared with the graph extractor, which splits the same labels (for SUBTOKEN_OF edges):
+        return split_into_subtokens(label)
 
     @staticmethod
     def finalise_metadata(name: str, raw_metadata_list: List[Dict[str, Any]],
                           final_metadata: Dict[str, Any], hyperparameters: Dict[str, Any]) -> None:
         label_embedding_style = hyperparameters[f'{name}_embedding_style'].lower()
 
-        merged_node_label_counter = Counter()
-        for raw_metadata in raw_metadata_list:
-            if label_embedding_style == 'token':
-                merged_node_label_counter += raw_metadata[f'{name}_counter']
-            elif label_embedding_style == 'subtoken':
-                merged_node_label_counter += raw_metadata[f'{name}_subtoken_counter']
+        counter_name = f'{name}_counter' if label_embedding_style == 'token' else f'{name}_subtoken_counter'
+        merged_node_label_counter = most_common_counter(
+            merge_counters(raw_metadata[counter_name] for raw_metadata in raw_metadata_list),
+            max_size=hyperparameters[f'{name}_vocab_size'])
 
         def add_special_literals(vocab: Vocabulary) -> None:
             vocab.add_or_get_id(TokenEmbedder.STRING_LITERAL)
@@ -228,25 +255,38 @@ class TokenEmbedder(Component):
 
         if label_embedding_style == 'token':
             # Translate node labels using the token vocabulary:
-            node_labels = np.zeros((num_nodes,), dtype=np.uint16)
-            for (node, label) in enumerate(data):
-                if metadata[f'{name}_vocab'].is_unk(label):
-                    label = TokenEmbedder.filter_literals(label)  # UNKs that are literals will be converted to special symbols.
-                node_labels[node] = metadata[f'{name}_vocab'].get_id_or_unk(label)
-            result_holder[f'{name}_token_ids'] = node_labels
+            vocab = metadata[f'{name}_vocab']
+            label_ids = _get_label_id_cache('token', vocab)
+            node_label_ids = []
+            for label in data:
+                label_id = label_ids.get(label)
+                if label_id is None:
+                    if vocab.is_unk(label):
+                        # UNKs that are literals will be converted to special symbols.
+                        label_id = vocab.get_id_or_unk(TokenEmbedder.filter_literals(label))
+                    else:
+                        label_id = vocab.get_id_or_unk(label)
+                    label_ids[label] = label_id
+                node_label_ids.append(label_id)
+            result_holder[f'{name}_token_ids'] = np.array(node_label_ids, dtype=np.uint16).reshape(num_nodes)
 
         elif label_embedding_style == 'subtoken':
             max_num_subtokens = hyperparameters[f'{name}_max_subtokens']
             node_subtokens = np.zeros((num_nodes, max_num_subtokens), dtype=np.uint16)
             node_subtoken_length = np.zeros(num_nodes, dtype=np.uint8)
+            vocab = metadata[f'{name}_subtoken_vocab']
+            label_subtoken_ids = _get_label_id_cache('subtoken', vocab, max_num_subtokens)
             for (node, label) in enumerate(data):
-                filtered_label = TokenEmbedder.filter_literals(label)
-                if filtered_label == label:
-                    subtoken_ids = metadata[f'{name}_subtoken_vocab'].get_id_or_unk_multiple(split_identifier_into_parts(label))[:max_num_subtokens]
-                elif metadata[f'{name}_subtoken_vocab'].is_unk(label):
-                    subtoken_ids = metadata[f'{name}_subtoken_vocab'].get_id_or_unk_multiple([filtered_label])
-                else:
-                    subtoken_ids = metadata[f'{name}_subtoken_vocab'].get_id_or_unk_multiple([label])
+                subtoken_ids = label_subtoken_ids.get(label)
+                if subtoken_ids is None:
+                    filtered_label = TokenEmbedder.filter_literals(label)
+                    if filtered_label == label:
+                        subtoken_ids = vocab.get_id_or_unk_multiple(TokenEmbedder.split_into_subtokens(label))[:max_num_subtokens]
+                    elif vocab.is_unk(label):
+                        subtoken_ids = vocab.get_id_or_unk_multiple([filtered_label])
+                    else:
+                        subtoken_ids = vocab.get_id_or_unk_multiple([label])
+                    label_subtoken_ids[label] = subtoken_ids
                 node_subtokens[node, :len(subtoken_ids)] = subtoken_ids
                 node_subtoken_length[node] = len(subtoken_ids)
             result_holder[f'{name}_subtoken_ids'] = node_subtokens
@@ -279,6 +319,7 @@ class TokenEmbedder(Component):
             batch_data[f'{name}_subtoken_lengths'] = []
         elif label_embedding_style == 'charcnn':
             batch_data[f'{name}_index_offset'] = 0
+            batch_data[f'{name}_sample_index_offsets'] = []
             batch_data[f'{name}_unique_chars'] = []
             batch_data[f'{name}_unique_indices'] = []
         else:
@@ -287,19 +328,20 @@ class TokenEmbedder(Component):
     @staticmethod
     def extend_minibatch_by_sample(name: str, batch_data: Dict[str, Any], sample: Dict[str, Any],
                                    hyperparameters: Dict[str, Any]) -> bool:
+        # Only collect references to the sample's arrays here, they are concatenated in finalise_minibatch:
         label_embedding_style = hyperparameters[f'{name}_embedding_style'].lower()
         if label_embedding_style == 'token':
-            batch_data[f'{name}_token_ids'].extend(sample[f'{name}_token_ids'])
+            batch_data[f'{name}_token_ids'].append(sample[f'{name}_token_ids'])
 
         elif label_embedding_style == 'subtoken':
-            batch_data[f'{name}_subtoken_ids'].extend(sample[f'{name}_subtoken_ids'])
-            batch_data[f'{name}_subtoken_lengths'].extend(sample[f'{name}_subtoken_lengths'])
+            batch_data[f'{name}_subtoken_ids'].append(sample[f'{name}_subtoken_ids'])
+            batch_data[f'{name}_subtoken_lengths'].append(sample[f'{name}_subtoken_lengths'])
 
         elif label_embedding_style == 'charcnn':
             # As we keep adding new "unique" labels, we need to shift the indices we are referring accordingly:
-            batch_data[f'{name}_unique_chars'].extend(sample[f'{name}_unique_chars'])
-            batch_data[f'{name}_unique_indices'].extend(
-                sample[f'{name}_unique_indices'] + batch_data[f'{name}_index_offset'])
+            batch_data[f'{name}_unique_chars'].append(sample[f'{name}_unique_chars'])
+            batch_data[f'{name}_unique_indices'].append(sample[f'{name}_unique_indices'])
+            batch_data[f'{name}_sample_index_offsets'].append(batch_data[f'{name}_index_offset'])
             batch_data[f'{name}_index_offset'] += len(sample[f'{name}_unique_chars'])
         else:
             raise Exception("Unknown node label embedding style '%s'!" % label_embedding_style)
@@ -311,16 +353,17 @@ class TokenEmbedder(Component):
         label_embedding_style = hyperparameters[f'{name}_embedding_style'].lower()
 
         if label_embedding_style == 'token':
-            write_to_minibatch(minibatch, placeholders[f'{name}_token_ids'], batch_data[f'{name}_token_ids'])
+            write_concatenated_to_minibatch(minibatch, placeholders[f'{name}_token_ids'], batch_data[f'{name}_token_ids'])
 
         elif label_embedding_style == 'subtoken':
-            write_to_minibatch(minibatch, placeholders[f'{name}_subtoken_ids'],
-                               batch_data[f'{name}_subtoken_ids'])
-            write_to_minibatch(minibatch, placeholders[f'{name}_num_subtokens'],
-                               batch_data[f'{name}_subtoken_lengths'])
+            write_concatenated_to_minibatch(minibatch, placeholders[f'{name}_subtoken_ids'],
+                                            batch_data[f'{name}_subtoken_ids'])
+            write_concatenated_to_minibatch(minibatch, placeholders[f'{name}_num_subtokens'],
+                                            batch_data[f'{name}_subtoken_lengths'])
 
         elif label_embedding_style == 'charcnn':
-            write_to_minibatch(minibatch, placeholders[f'{name}_unique_chars'], batch_data[f'{name}_unique_chars'])
-            write_to_minibatch(minibatch, placeholders[f'{name}_unique_indices'], batch_data[f'{name}_unique_indices'])
+            write_concatenated_to_minibatch(minibatch, placeholders[f'{name}_unique_chars'], batch_data[f'{name}_unique_chars'])
+            write_concatenated_to_minibatch(minibatch, placeholders[f'{name}_unique_indices'], batch_data[f'{name}_unique_indices'],
+                                            batch_data[f'{name}_sample_index_offsets'])
         else:
             raise Exception("Unknown node label embedding style '%s'!" % label_embedding_style)
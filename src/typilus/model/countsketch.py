@@ -0,0 +1,153 @@
+"""
+Bounded-memory counting of the most common keys (tokens, subtokens, types, ...) when building vocabularies, as an
+alternative to exact Counters for corpora with too many distinct keys.
+"""
+import heapq
+from collections import Counter
+from operator import itemgetter
+from typing import Any, Dict, Hashable, Iterable, List, Mapping, Optional, Tuple, Union
+
+
+class SpaceSavingCounter:
+    """
+    A Space-Saving sketch (Metwally et al., 2005) that tracks at most 2 * capacity keys with an estimate of their
+    counts. Estimates never undercount, and overcount by at most error_bound; keys that are not tracked occurred at
+    most error_bound times. Every key occurring more than error_bound times is tracked, so the most common keys are
+    retained as long as the capacity exceeds the number of keys that are needed.
+
+    To keep updates cheap, the tracked keys are pruned in batches: once 2 * capacity keys are tracked, all but the
+    capacity most common ones are dropped, and the largest dropped count becomes the initial count of new keys.
+
+    Sketches built on different parts of a corpus (e.g. by different workers) can be merged with merge(), with the
+    errors adding up (Agarwal et al., 2012).
+    """
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError('The capacity of a SpaceSavingCounter must be positive, but was %s.' % capacity)
+        self.__capacity = capacity
+        self.__counts = {}  # type: Dict[Hashable, int]
+        self.__error_bound = 0
+        self.__total = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.__capacity
+
+    @property
+    def error_bound(self) -> int:
+        return self.__error_bound
+
+    @property
+    def total(self) -> int:
+        """The total count of all keys added, tracked or not."""
+        return self.__total
+
+    def __len__(self) -> int:
+        return len(self.__counts)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.__counts
+
+    def __getitem__(self, key: Hashable) -> int:
+        """The (over-)estimated count of key, or 0 if it is not tracked."""
+        return self.__counts.get(key, 0)
+
+    def add(self, key: Hashable, count: int = 1) -> None:
+        counts = self.__counts
+        counts[key] = counts.get(key, self.__error_bound) + count
+        self.__total += count
+        if len(counts) >= 2 * self.__capacity:
+            self.__prune()
+
+    def update(self, keys: Union[Iterable[Hashable], Mapping[Hashable, int]]) -> None:
+        """Count keys, like Counter.update: either an iterable of keys or a mapping from keys to counts."""
+        if isinstance(keys, Mapping):
+            for key, count in keys.items():
+                self.add(key, count)
+        else:
+            for key in keys:
+                self.add(key)
+
+    def merge(self, other: 'SpaceSavingCounter') -> None:
+        """Add the counts of other (built from other data) into this sketch."""
+        counts = self.__counts
+        if other.__error_bound > 0:
+            # Keys that other does not track may have occurred up to other.error_bound times in its data:
+            for key in counts:
+                if key not in other.__counts:
+                    counts[key] += other.__error_bound
+        for key, count in other.__counts.items():
+            counts[key] = counts.get(key, self.__error_bound) + count
+        self.__error_bound += other.__error_bound
+        self.__total += other.__total
+        if len(counts) >= 2 * self.__capacity:
+            self.__prune()
+
+    def __prune(self) -> None:
+        by_count = sorted(self.__counts.items(), key=itemgetter(1), reverse=True)
+        self.__error_bound = max(self.__error_bound, by_count[self.__capacity][1])
+        self.__counts = dict(by_count[:self.__capacity])
+
+    def most_common(self, n: Optional[int] = None) -> List[Tuple[Hashable, int]]:
+        if n is None:
+            return sorted(self.__counts.items(), key=itemgetter(1), reverse=True)
+        return heapq.nlargest(n, self.__counts.items(), key=itemgetter(1))
+
+
+CountsType = Union[Counter, SpaceSavingCounter]
+
+
+def make_counter(hyperparameters: Dict[str, Any]) -> CountsType:
+    """A Counter, or a SpaceSavingCounter if the metadata_sketch_size hyperparameter is set."""
+    sketch_size = hyperparameters.get('metadata_sketch_size')
+    if sketch_size is None:
+        return Counter()
+    return SpaceSavingCounter(sketch_size)
+
+
+def merge_counters(counters: Iterable[CountsType]) -> CountsType:
+    """Merge counters created by make_counter (with the same hyperparameters)."""
+    merged = None  # type: Optional[CountsType]
+    for counter in counters:
+        if merged is None:
+            merged = Counter() if isinstance(counter, Counter) else SpaceSavingCounter(counter.capacity)
+        if isinstance(merged, Counter):
+            merged.update(counter)
+        else:
+            merged.merge(counter)
+    return merged if merged is not None else Counter()
+
+
+def most_common_counter(counter: CountsType, max_size: int) -> Counter:
+    """A Counter of (at least) the max_size most common keys of counter, e.g. for Vocabulary.create_vocabulary."""
+    if isinstance(counter, Counter):
+        return counter
+    return Counter(dict(counter.most_common(max_size)))
+
+
+def fold_sketches(accumulator: Dict[str, Any], raw_metadata: Dict[str, Any]) -> None:
+    """
+    Merge the SpaceSavingCounters in raw_metadata into the ones under the same key in accumulator, leaving empty
+    sketches in raw_metadata. Folding the raw metadata of each file into the first one as it arrives keeps the memory
+    needed for the sketches bounded, independent of the number of files.
+    """
+    for key, value in raw_metadata.items():
+        if isinstance(value, SpaceSavingCounter) and isinstance(accumulator.get(key), SpaceSavingCounter):
+            accumulator[key].merge(value)
+            raw_metadata[key] = SpaceSavingCounter(value.capacity)
+
+
+def sketch_accuracy(sketch: SpaceSavingCounter, exact_counter: Counter, top_k: int) -> Dict[str, float]:
+    """Compare the top_k most common keys of sketch and exact_counter, built from the same data."""
+    exact_top = exact_counter.most_common(top_k)
+    sketch_top_keys = set(key for key, _ in sketch.most_common(top_k))
+    num_found = sum(1 for key, _ in exact_top if key in sketch_top_keys)
+    abs_errors = [sketch[key] - count for key, count in exact_top]
+    return {
+        'num_distinct_keys': len(exact_counter),
+        'top_k': len(exact_top),
+        'recall': num_found / max(1, len(exact_top)),
+        'max_abs_error': max(abs_errors, default=0),
+        'mean_rel_error': sum(e / c for e, (_, c) in zip(abs_errors, exact_top)) / max(1, len(exact_top)),
+        'error_bound': sketch.error_bound,
+    }
@@ -0,0 +1,101 @@
+"""
+An on-disk cache of the per-sample outputs of a model (e.g. target representations or log probabilities), so that
+predicting again on unchanged code does not need to run the model.
+"""
+import hashlib
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+_ENTRY_SUFFIX = '.npz'
+
+
+def hash_raw_sample(raw_sample: Any, sample_hash: Optional['hashlib._Hash'] = None) -> 'hashlib._Hash':
+    """Hash the contents of a raw sample (as read from graph chunks) into sample_hash, or a new sha256 hash."""
+    if sample_hash is None:
+        sample_hash = hashlib.sha256()
+    if isinstance(raw_sample, dict):
+        sample_hash.update(b'{%i' % len(raw_sample))
+        for key in sorted(raw_sample, key=str):
+            hash_raw_sample(key, sample_hash)
+            hash_raw_sample(raw_sample[key], sample_hash)
+    elif isinstance(raw_sample, (list, tuple)):
+        sample_hash.update(b'[%i' % len(raw_sample))
+        for element in raw_sample:
+            hash_raw_sample(element, sample_hash)
+    elif isinstance(raw_sample, np.ndarray):
+        sample_hash.update(('a%s%s' % (raw_sample.dtype.str, raw_sample.shape)).encode())
+        sample_hash.update(np.ascontiguousarray(raw_sample).tobytes())
+    else:
+        sample_hash.update(('%s:%r' % (type(raw_sample).__name__, raw_sample)).encode('utf-8', errors='surrogatepass'))
+    return sample_hash
+
+
+class FetchCache:
+    """
+    Stores arrays per key in cache_dir, one file per entry. Once the entries take up more than max_size_bytes, the
+    least recently used ones are evicted (the modification time of entries is refreshed when they are read).
+    Several processes can share a cache directory; entries are written atomically.
+    """
+    def __init__(self, cache_dir: str, max_size_bytes: int):
+        self.__cache_dir = cache_dir
+        self.__max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.__size_bytes = sum(entry.stat().st_size for entry in self.__entries())
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def __entries(self):
+        return (entry for entry in os.scandir(self.__cache_dir) if entry.name.endswith(_ENTRY_SUFFIX))
+
+    def __path_for(self, key: str) -> str:
+        return os.path.join(self.__cache_dir, key + _ENTRY_SUFFIX)
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self.__path_for(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                values = {k: data[k] for k in data.files}
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            # Missing, evicted in the meantime, or corrupt: a corrupt entry will be overwritten.
+            self.num_misses += 1
+            return None
+        self.num_hits += 1
+        return values
+
+    def put(self, key: str, values: Dict[str, np.ndarray]) -> None:
+        path = self.__path_for(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.__cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **values)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self.__size_bytes += os.path.getsize(path)
+        if self.__size_bytes > self.__max_size_bytes:
+            self.__evict()
+
+    def __evict(self) -> None:
+        entries = []
+        for entry in self.__entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # Removed by another process
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.__size_bytes = sum(size for _, size, _ in entries)
+        # Evict down to 90% of the budget, so that eviction does not need to run on every put.
+        for _, size, path in entries:
+            if self.__size_bytes <= 0.9 * self.__max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.__size_bytes -= size
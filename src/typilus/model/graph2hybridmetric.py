@@ -129,8 +129,15 @@ class Graph2HybridMetric(CodeGraphModel):
         self.__type_metric._finalise_minibatch(batch_data, is_train, minibatch)
         return minibatch
 
-    def create_index(self, data_paths: List[RichPath]):
-        self.__type_metric.create_index(data_paths, self.metadata)
+    def create_index(self, data_paths: List[RichPath], append: bool = False, num_workers: Optional[int] = None):
+        self.__type_metric.create_index(data_paths, self.metadata, append, num_workers)
+
+    def _get_metadata_to_save(self, path: RichPath) -> Dict[str, Any]:
+        return self.__type_metric.get_metadata_to_save(path, super()._get_metadata_to_save(path))
+
+    def _restore_metadata(self, path: RichPath, saved_metadata: Dict[str, Any]) -> None:
+        super()._restore_metadata(path, saved_metadata)
+        self.__type_metric.restore_metadata(path, self.metadata)
 
 
     # ------- These are the bits that we only need for test-time:
@@ -139,5 +146,9 @@ class Graph2HybridMetric(CodeGraphModel):
                               feed_dict=sample_data_dict),
                 None)
 
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str):
-        return self.__type_metric.annotate_single(raw_sample, loaded_test_sample, provenance, self.metadata)
+    def _get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        return self.__type_metric.get_annotation_fetches()
+
+    def _annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                               fetches: Dict[str, np.ndarray]):
+        return self.__type_metric.annotate_from_fetches(raw_sample, loaded_test_sample, provenance, fetches, self.metadata)
@@ -1,15 +1,26 @@
+import hashlib
+import json
 import os
 import random
+import tempfile
 import time
+import traceback
 from abc import ABC, abstractmethod
 from collections import namedtuple, defaultdict
-from typing import List, Dict, Any, Iterable, Tuple, Optional, Union, Callable, NamedTuple, Iterator
+from typing import List, Dict, Any, Iterable, Tuple, Optional, Union, Callable, NamedTuple, Iterator, Sequence
 
 import numpy as np
 import tensorflow as tf
 from dpu_utils.utils import RichPath, MultiWorkerCallableIterator
+from dpu_utils.utils.richpath import LocalPath
 
-from .utils import run_jobs_in_parallel, partition_files_by_size, ignore_type_annotation
+from .countsketch import SpaceSavingCounter, fold_sketches, sketch_accuracy
+from data_preparation.scripts.graph_generator.compactgraphs import FILE_SUFFIX as COMPACT_GRAPHS_FILE_SUFFIX, \
+    load_compact_graph_chunk
+from .fetchcache import FetchCache, hash_raw_sample
+from .tensorisedchunks import FILE_SUFFIX as TENSORISED_CHUNK_FILE_SUFFIX, TensorisedChunk, save_tensorised_chunk
+from .utils import run_jobs_in_parallel, iterate_jobs_in_parallel, partition_files_by_size, ignore_type_annotation, \
+    map_in_background, pack_into_bins
 
 ModelTestResult = namedtuple("ModelTestResult", ["ground_truth", "all_predictions"])
 
@@ -17,14 +28,30 @@ ModelTestResult = namedtuple("ModelTestResult", ["ground_truth", "all_prediction
 NONE_TOKEN = '<NONE>'
 
 
+# Temporary files in output directories (e.g., chunks being written) start with this:
+TMP_FILE_PREFIX = '.tmp-'
+# Marker written when a partition of the input data has been tensorised, with the number of samples and time taken:
+TENSORISATION_MARKER_PATTERN = 'tensorised_partition_%04i.json.gz'
+
+# Arrays of at least this size in samples loaded by worker processes are passed back through shared memory.
+SHARED_MEMORY_MIN_SAMPLE_ARRAY_BYTES = 256 * 1024
+
+
 def get_data_files_from_directory(data_dir: RichPath, max_num_files: Optional[int]=None) -> List[RichPath]:
-    files = data_dir.get_filtered_files_in_dir('*.gz')
+    files = data_dir.get_filtered_files_in_dir('*.gz') + data_dir.get_filtered_files_in_dir('*' + COMPACT_GRAPHS_FILE_SUFFIX)
     if max_num_files is None:
         return files
     else:
         return sorted(files)[:int(max_num_files)]
 
 
+def read_raw_graph_chunk(data_chunk_path: RichPath) -> List[Dict[str, Any]]:
+    """Read a chunk of extracted graphs, stored either as JSON lines or in the compact format (see compactgraphs.py)."""
+    if data_chunk_path.path.endswith(COMPACT_GRAPHS_FILE_SUFFIX):
+        return list(load_compact_graph_chunk(data_chunk_path.to_local_path().path))
+    return data_chunk_path.read_by_file_suffix()
+
+
 def write_to_minibatch(minibatch: Dict[tf.Tensor, Any], placeholder, val) -> None:
     if type(val) is int:
       minibatch[placeholder] = val
@@ -36,17 +63,97 @@ def write_to_minibatch(minibatch: Dict[tf.Tensor, Any], placeholder, val) -> Non
         minibatch[placeholder] = np.array(val)
 
 
+def write_concatenated_to_minibatch(minibatch: Dict[tf.Tensor, Any], placeholder, sample_values: List[np.ndarray],
+                                    sample_offsets: Optional[List[int]]=None) -> None:
+    """
+    Write the concatenation (along the first axis) of per-sample arrays to the minibatch, in one copy.
+    If sample_offsets is given, sample_offsets[i] is added to all entries of sample_values[i], e.g. to shift
+    node indices of sample i by the number of nodes of the samples before it in the minibatch.
+    """
+    if len(sample_values) == 0:
+        write_to_minibatch(minibatch, placeholder, [])
+        return
+    values = np.concatenate(sample_values, axis=0)
+    if sample_offsets is not None:
+        offsets = np.repeat(np.array(sample_offsets, dtype=values.dtype), [len(v) for v in sample_values])
+        values += offsets.reshape((-1,) + (1,) * (values.ndim - 1))
+    minibatch[placeholder] = values
+
+
+def read_tensorised_chunk(data_chunk_path: RichPath) -> Sequence[Dict[str, Any]]:
+    """Read a chunk of tensorised samples, memory-mapping it if it is in the columnar format (see tensorisedchunks.py)."""
+    if data_chunk_path.path.endswith(TENSORISED_CHUNK_FILE_SUFFIX):
+        return TensorisedChunk(data_chunk_path.to_local_path().path)
+    return data_chunk_path.read_by_file_suffix()
+
+
+def _write_local_file_atomically(path: str, write_fn: Callable[[str], None]) -> None:
+    """Call write_fn on a temporary path next to path (with the same suffix, which may determine the format), and
+    move the result into place, so that readers never see a partially written file."""
+    tmp_path = os.path.join(os.path.dirname(path), '%s%s-%s' % (TMP_FILE_PREFIX, os.getpid(), os.path.basename(path)))
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_atomically(path: RichPath, data: Any) -> None:
+    """Like path.save_as_compressed_file, but never leaves partially written local files behind."""
+    if isinstance(path, LocalPath):
+        _write_local_file_atomically(path.path, lambda tmp_path: RichPath.create(tmp_path).save_as_compressed_file(data))
+    else:
+        path.save_as_compressed_file(data)  # Blobs are only visible once completely uploaded
+
+
+def write_tensorised_chunk(samples: List[Dict[str, Any]], data_chunk_path: RichPath) -> None:
+    if not data_chunk_path.path.endswith(TENSORISED_CHUNK_FILE_SUFFIX):
+        save_atomically(data_chunk_path, samples)
+    elif isinstance(data_chunk_path, LocalPath):
+        _write_local_file_atomically(data_chunk_path.path, lambda tmp_path: save_tensorised_chunk(samples, tmp_path))
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            local_path = os.path.join(tmp_dir, data_chunk_path.basename())
+            save_tensorised_chunk(samples, local_path)
+            data_chunk_path.copy_from(RichPath.create(local_path))
+
+
+def _canonicalise_for_hashing(value: Any) -> Any:
+    """Turn value into nested dicts, lists and primitive values that hash the same in every process."""
+    if isinstance(value, dict):
+        return {str(k): _canonicalise_for_hashing(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_canonicalise_for_hashing(v) for v in value]
+    elif isinstance(value, (set, frozenset)):
+        return sorted((_canonicalise_for_hashing(v) for v in value), key=repr)
+    elif isinstance(value, (np.ndarray, str, bytes, int, float, bool)) or value is None:
+        return value
+    elif hasattr(value, '__dict__'):
+        return [type(value).__name__, _canonicalise_for_hashing(vars(value))]
+    return repr(value)
+
+
+def _describe_data_file(data_file: RichPath) -> List[Any]:
+    """Identify the contents of a data file cheaply: by its path and, for local files, its size and modification time."""
+    if isinstance(data_file, LocalPath):
+        stat = os.stat(data_file.path)
+        return [data_file.path, stat.st_size, stat.st_mtime_ns]
+    return [str(data_file)]
+
+
 def read_data_chunks(data_chunk_paths: Iterable[RichPath], shuffle_chunks: bool=False, max_queue_size: int=1, num_workers: int=0) \
-        -> Iterable[List[Dict[str, Any]]]:
+        -> Iterable[Sequence[Dict[str, Any]]]:
     if shuffle_chunks:
         data_chunk_paths = list(data_chunk_paths)
         np.random.shuffle(data_chunk_paths)
     if num_workers <= 0:
         for data_chunk_path in data_chunk_paths:
-            yield data_chunk_path.read_by_file_suffix()
+            yield read_tensorised_chunk(data_chunk_path)
     else:
         def read_chunk(data_chunk_path: RichPath):
-            return data_chunk_path.read_by_file_suffix()
+            return read_tensorised_chunk(data_chunk_path)
         yield from MultiWorkerCallableIterator(argument_iterator=[(data_chunk_path,) for data_chunk_path in data_chunk_paths],
                                                worker_callable=read_chunk,
                                                max_queue_size=max_queue_size,
@@ -68,11 +175,16 @@ class Model(ABC):
                 'gradient_clip': 1,
                 'max_epochs': 500,
                 'patience': 10,
+                'minibatch_prefetch_depth': 8,  # Number of finalised minibatches prepared ahead of the session; 0 disables prefetching
+                'num_minibatch_builders': 2,
+                'metadata_sketch_size': None,  # If set, count vocabularies with bounded-memory sketches of this capacity
                }
 
     def __init__(self, hyperparameters: Dict[str, Any], run_name: Optional[str]=None, model_save_dir: Optional[str]=None, log_save_dir: Optional[str]=None):
         self.hyperparameters = hyperparameters  # type: Dict[str, Any]
         self.__metadata = {}  # type: Dict[str, Any]
+        # Identifies the inputs the metadata was computed from (see __get_metadata_fingerprint):
+        self.__metadata_fingerprint = None  # type: Optional[str]
         self.__parameters = {}  # type: Dict[str, tf.Tensor]
         self.__placeholders = {}  # type: Dict[str, tf.Tensor]
         self.__ops = {}  # type: Dict[str, tf.Tensor]
@@ -91,6 +203,8 @@ class Model(ABC):
 
         graph = tf.Graph()
         self.__sess = tf.compat.v1.Session(graph=graph, config=config)
+        self.__fetch_cache = None  # type: Optional[FetchCache]
+        self.__fingerprint = None  # type: Optional[bytes]
 
     @property
     def metadata(self):
@@ -126,13 +240,24 @@ class Model(ABC):
         data_to_save = {
                          "model_type": type(self).__name__,
                          "hyperparameters": self.hyperparameters,
-                         "metadata": self.__metadata,
+                         "metadata": self._get_metadata_to_save(path),
                          "weights": weights_to_save,
                          "run_name": self.__run_name,
                        }
 
         path.save_as_compressed_file(data_to_save)
 
+    def _get_metadata_to_save(self, path: RichPath) -> Dict[str, Any]:
+        """
+        Return the metadata to store in the model file at path. Models can override this to store large parts of
+        their metadata in separate files next to it, and restore them in _restore_metadata.
+        """
+        return self.__metadata
+
+    def _restore_metadata(self, path: RichPath, saved_metadata: Dict[str, Any]) -> None:
+        """Restore the metadata of the model from the metadata saved in the model file at path."""
+        self.__metadata.update(saved_metadata)
+
     def make_model(self, is_train: bool):
         with self.__sess.graph.as_default():
             random.seed(self.hyperparameters['seed'])
@@ -209,32 +334,76 @@ class Model(ABC):
         """
         return {}
 
-    def load_metadata(self, data_dir: RichPath, max_num_files: Optional[int]=None) -> None:
+    def load_metadata(self, data_dir: RichPath, max_num_files: Optional[int]=None,
+                      num_workers: Optional[int]=None) -> None:
         raw_metadata_list = []
 
         def metadata_parser_fn(_, file_path: RichPath) -> Iterable[Dict[str, Any]]:
             raw_metadata = {}
             type(self)._init_metadata(self.hyperparameters, raw_metadata)
-            for raw_sample in file_path.read_by_file_suffix():
+            for raw_sample in read_raw_graph_chunk(file_path):
                 type(self)._load_metadata_from_sample(self.hyperparameters, raw_sample=raw_sample, raw_metadata=raw_metadata)
             yield raw_metadata
 
         def received_result_callback(raw_metadata):
+            if len(raw_metadata_list) > 0:
+                # Merge count sketches as they arrive, so that they do not pile up:
+                fold_sketches(raw_metadata_list[0], raw_metadata)
             raw_metadata_list.append(raw_metadata)
 
         def finished_callback():
             pass
 
+        data_files = get_data_files_from_directory(data_dir, max_num_files)
         if True:   # Temporarily disable parallelization when needed, by switching this.
-            run_jobs_in_parallel(get_data_files_from_directory(data_dir, max_num_files),
+            run_jobs_in_parallel(data_files,
                                  metadata_parser_fn,
                                  received_result_callback,
-                                 finished_callback)
+                                 finished_callback,
+                                 num_workers=num_workers)
         else:
-            for file in get_data_files_from_directory(data_dir, max_num_files):
-                raw_metadata_list.extend(metadata_parser_fn(None, file))
+            for file in data_files:
+                for raw_metadata in metadata_parser_fn(None, file):
+                    received_result_callback(raw_metadata)
 
         self.__metadata = self._finalise_metadata(raw_metadata_list)
+        self.__metadata_fingerprint = hash_raw_sample(_canonicalise_for_hashing({
+            'hyperparameters': {k: v for k, v in self.hyperparameters.items() if k != 'run_id'},
+            'data_files': [_describe_data_file(data_file) for data_file in data_files],
+        })).hexdigest()
+
+        if self.hyperparameters.get('metadata_sketch_size') is not None:
+            self.__report_sketch_accuracy(data_files)
+
+    def __report_sketch_accuracy(self, data_files: List[RichPath]) -> None:
+        """
+        Compare the count sketches used for the metadata with exact counts, on a sample of the data files (of at most
+        metadata_sketch_accuracy_num_files files).
+        """
+        num_files = min(len(data_files), self.hyperparameters.get('metadata_sketch_accuracy_num_files', 10))
+        if num_files == 0:
+            return
+        exact_hyperparameters = dict(self.hyperparameters)
+        exact_hyperparameters['metadata_sketch_size'] = None
+        sketched_metadata, exact_metadata = {}, {}  # type: Dict[str, Any], Dict[str, Any]
+        type(self)._init_metadata(self.hyperparameters, sketched_metadata)
+        type(self)._init_metadata(exact_hyperparameters, exact_metadata)
+        for file_path in random.Random(self.hyperparameters.get('seed', 0)).sample(data_files, num_files):
+            for raw_sample in read_raw_graph_chunk(file_path):
+                type(self)._load_metadata_from_sample(self.hyperparameters, raw_sample=raw_sample,
+                                                      raw_metadata=sketched_metadata)
+                type(self)._load_metadata_from_sample(exact_hyperparameters, raw_sample=raw_sample,
+                                                      raw_metadata=exact_metadata)
+
+        top_k = self.hyperparameters.get('metadata_sketch_accuracy_top_k', 1000)
+        for key, sketch in sorted(sketched_metadata.items()):
+            if not isinstance(sketch, SpaceSavingCounter):
+                continue
+            accuracy = sketch_accuracy(sketch, exact_metadata[key], top_k)
+            self.train_log("Count sketch accuracy for %s on %s files: %s distinct keys, recall@%s %.4f, "
+                           "max abs. error %s, mean rel. error %.4f (error bound %s)."
+                           % (key, num_files, accuracy['num_distinct_keys'], accuracy['top_k'], accuracy['recall'],
+                              accuracy['max_abs_error'], accuracy['mean_rel_error'], accuracy['error_bound']))
 
     def load_existing_metadata(self, metadata_path: RichPath):
         saved_data = metadata_path.read_by_file_suffix()
@@ -252,6 +421,16 @@ class Model(ABC):
                 self.train_log("I: Hyperparameter %s now has value '%s' but was '%s' when tensorising data."
                                % (hyper_name, new_hyper_value, old_hyper_value))
         self.__metadata = saved_data['metadata']
+        self.__metadata_fingerprint = saved_data.get('metadata_fingerprint')
+
+    def __get_metadata_fingerprint(self) -> str:
+        """
+        Identify the metadata by the inputs it was computed from, as recomputing it from the same inputs does not
+        necessarily yield an identical object. Metadata of unknown origin is identified by its contents.
+        """
+        if self.__metadata_fingerprint is None:
+            self.__metadata_fingerprint = hash_raw_sample(_canonicalise_for_hashing(self.__metadata)).hexdigest()
+        return self.__metadata_fingerprint
 
     @staticmethod
     @abstractmethod
@@ -282,26 +461,40 @@ class Model(ABC):
                               metadata: Dict[str, Any],
                               for_test: bool,
                               add_raw_data: bool = False) \
-            -> Callable[[Any, Tuple[List[RichPath], RichPath]], Iterable[Tuple[int, int]]]:
-        def data_file_parser(_, job_description: Tuple[List[RichPath], RichPath]) -> Iterable[Tuple[int, int]]:
-            (file_paths, target_path) = job_description
+            -> Callable[[Any, Tuple[int, List[RichPath], RichPath]], Iterable[Dict[str, Any]]]:
+        """
+        The returned parser tensorises a partition of the data files into one chunk, and yields a summary of the
+        partition, with the number of samples and time taken, or the traceback if tensorisation failed.
+        """
+        def data_file_parser(_, job_description: Tuple[int, List[RichPath], RichPath]) -> Iterable[Dict[str, Any]]:
+            (partition_idx, file_paths, target_path) = job_description
+            start_time = time.time()
             num_all_samples = 0
             num_used_samples = 0
             result_data = []
-            for file_path in file_paths:
-                for raw_sample in file_path.read_by_file_suffix():
-                    sample = dict()
-                    sample['Provenance'] = raw_sample['filename']
-                    use_example = cls._load_data_from_sample(hyperparameters, metadata, raw_sample=raw_sample,
-                                                                     result_holder=sample, is_train=not for_test)
-                    if add_raw_data:
-                        sample['raw_data'] = raw_sample
-                    num_all_samples += 1
-                    if use_example:
-                        num_used_samples += 1
-                        result_data.append(sample)
-            target_path.save_as_compressed_file(result_data)
-            yield num_all_samples, num_used_samples
+            try:
+                for file_path in file_paths:
+                    for raw_sample in read_raw_graph_chunk(file_path):
+                        sample = dict()
+                        sample['Provenance'] = raw_sample['filename']
+                        use_example = cls._load_data_from_sample(hyperparameters, metadata, raw_sample=raw_sample,
+                                                                         result_holder=sample, is_train=not for_test)
+                        if add_raw_data:
+                            sample['raw_data'] = raw_sample
+                        num_all_samples += 1
+                        if use_example:
+                            num_used_samples += 1
+                            result_data.append(sample)
+                write_tensorised_chunk(result_data, target_path)
+                error = None
+            except Exception:
+                # Reported for this partition only, so that the other partitions still complete:
+                error = traceback.format_exc()
+            yield {'partition_idx': partition_idx,
+                   'num_all_samples': num_all_samples,
+                   'num_used_samples': num_used_samples,
+                   'time': time.time() - start_time,
+                   'error': error}
 
         return data_file_parser
 
@@ -311,12 +504,14 @@ class Model(ABC):
                               for_test: bool,
                               max_num_files: Optional[int]=None,
                               add_raw_data: bool=False,
-                              return_num_original_samples: bool = False) \
+                              return_num_original_samples: bool = False,
+                              num_workers: Optional[int]=None) \
             -> Union[List[RichPath], Tuple[List[RichPath], int]]:
         """
         Tensorises data in directory by sample-by-sample, generating "chunk" files of
         lists of tensorised samples that are then consumed in the split_data_into_minibatches
-        pipeline to construct minibatches.
+        pipeline to construct minibatches. Chunks are stored in the memory-mapped columnar
+        format of tensorisedchunks.py.
 
         Args:
             input_data_dir: Where to load the raw data from (should come from the extraction pipeline)
@@ -327,61 +522,130 @@ class Model(ABC):
             return_num_original_samples: Flag indicating that the return value should contain the
              number of samples we tried to load, including those that we discarded (e.g., because
              they were too big)
+            num_workers: Number of worker processes (see utils.get_num_parallel_workers for the default).
 
         Return:
             List of paths to the generated chunk files, or tuple of that list and the number
             of samples loaded (iff return_num_original_samples was set)
         """
         data_files = get_data_files_from_directory(input_data_dir, max_num_files)
+        if isinstance(output_dir, LocalPath):
+            # Left over by interrupted runs:
+            for tmp_path in output_dir.get_filtered_files_in_dir(TMP_FILE_PREFIX + '*'):
+                os.remove(tmp_path.path)
+
+        # Partitions are only reused from earlier runs if they were tensorised with the same metadata and settings,
+        # i.e., metadata computed from the same data files, or loaded from the metadata.pkl.gz of such a run.
+        fingerprint = hash_raw_sample(_canonicalise_for_hashing({
+            'hyperparameters': {k: v for k, v in self.hyperparameters.items() if k != 'run_id'},
+            'metadata': self.__get_metadata_fingerprint(),
+            'for_test': for_test,
+            'add_raw_data': add_raw_data,
+        })).hexdigest()
+        metadata_path = output_dir.join("metadata.pkl.gz")
+        save_atomically(metadata_path, {"hyperparameters": self.hyperparameters, "metadata": self.__metadata,
+                                        "metadata_fingerprint": self.__get_metadata_fingerprint()})
+
         tensorisation_argument_tuples = []
         chunk_paths = []
+        partition_summaries = {}  # type: Dict[int, Dict[str, Any]]
         for (partition_idx, raw_graph_file_partition) in enumerate(partition_files_by_size(data_files, 40 * 1024 * 1024)):
-            target_file = output_dir.join("chunk_%04i.pkl.gz" % (partition_idx,))
-            tensorisation_argument_tuples.append((raw_graph_file_partition, target_file))
+            target_file = output_dir.join("chunk_%04i%s" % (partition_idx, TENSORISED_CHUNK_FILE_SUFFIX))
             chunk_paths.append(target_file)
+            input_files = [str(p) for p in raw_graph_file_partition]
+            marker_path = output_dir.join(TENSORISATION_MARKER_PATTERN % partition_idx)
+            if marker_path.exists() and target_file.exists():
+                marker = marker_path.read_by_file_suffix()
+                if marker['fingerprint'] == fingerprint and marker['input_files'] == input_files:
+                    partition_summaries[partition_idx] = marker['summary']
+                    continue
+            tensorisation_argument_tuples.append((partition_idx, raw_graph_file_partition, target_file))
+        # Chunks (and their markers) of partitions that no longer exist, e.g. when there are fewer data files, or
+        # written in another format, would otherwise be picked up with the current chunks:
+        current_files = {path.basename() for path in chunk_paths}
+        current_files.update(TENSORISATION_MARKER_PATTERN % partition_idx for partition_idx in range(len(chunk_paths)))
+        for pattern in ('chunk_*', TENSORISATION_MARKER_PATTERN.split('%')[0] + '*'):
+            for stale_path in output_dir.get_filtered_files_in_dir(pattern):
+                if stale_path.basename() not in current_files:
+                    stale_path.delete()
+        if len(partition_summaries) > 0:
+            self.train_log("Reusing %i of %i tensorised partitions in '%s'."
+                           % (len(partition_summaries), len(chunk_paths), output_dir))
 
-        parsing_result_data = {"num_all_samples": 0, "num_used_samples": 0}
         data_file_parser_fn = type(self).make_data_file_parser(
                                                     self.hyperparameters,
                                                     self.metadata,
                                                     for_test=for_test,
                                                     add_raw_data=add_raw_data)
-
-        def received_result_callback(result):
-            (num_all_samples, num_used_samples) = result
-            parsing_result_data['num_all_samples'] += num_all_samples
-            parsing_result_data['num_used_samples'] += num_used_samples
+        failed_partitions = {}  # type: Dict[int, str]
+
+        def received_result_callback(summary):
+            partition_idx = summary.pop('partition_idx')
+            error = summary.pop('error')
+            if error is not None:
+                failed_partitions[partition_idx] = error
+                self.train_log("Tensorising partition %i failed:\n%s" % (partition_idx, error))
+                return
+            partition_summaries[partition_idx] = summary
+            # The chunk is complete at this point, so that a re-run can skip this partition:
+            save_atomically(output_dir.join(TENSORISATION_MARKER_PATTERN % partition_idx),
+                            {"fingerprint": fingerprint,
+                             "input_files": [str(p) for p in tensorisation_arguments[partition_idx][1]],
+                             "summary": summary})
 
         def finished_callback():
             pass
 
+        tensorisation_arguments = {args[0]: args for args in tensorisation_argument_tuples}
         if True:   # Disable job parallelization temporarily
             run_jobs_in_parallel(tensorisation_argument_tuples,
                                  data_file_parser_fn,
                                  received_result_callback,
-                                 finished_callback)
+                                 finished_callback,
+                                 num_workers=num_workers)
         else:
             for sample in tensorisation_argument_tuples:
-                received_result_callback(data_file_parser_fn(None, sample))
+                for summary in data_file_parser_fn(None, sample):
+                    received_result_callback(summary)
 
+        self.__log_tensorisation_summary(partition_summaries, set(tensorisation_arguments) - set(failed_partitions))
+        if len(failed_partitions) > 0:
+            raise Exception("Tensorising partitions %s of '%s' failed (see log). Re-run to retry only these."
+                            % (sorted(failed_partitions), input_data_dir))
 
         # Store the metadata we used for this as well, so that we can re-use the results:
-        metadata_path = output_dir.join("metadata.pkl.gz")
-        metadata_path.save_as_compressed_file({"hyperparameters": self.hyperparameters,
-                                               "metadata": self.__metadata,
-                                               "num_used_samples": parsing_result_data['num_used_samples'],
-                                               "num_all_samples": parsing_result_data['num_all_samples']})
+        num_used_samples = sum(summary['num_used_samples'] for summary in partition_summaries.values())
+        num_all_samples = sum(summary['num_all_samples'] for summary in partition_summaries.values())
+        save_atomically(metadata_path, {"hyperparameters": self.hyperparameters,
+                                        "metadata": self.__metadata,
+                                        "metadata_fingerprint": self.__get_metadata_fingerprint(),
+                                        "num_used_samples": num_used_samples,
+                                        "num_all_samples": num_all_samples})
 
         self.train_log("Tensorised %i (%i before filtering) samples from '%s' into '%s'."
-                       % (parsing_result_data['num_used_samples'],
-                          parsing_result_data['num_all_samples'],
+                       % (num_used_samples,
+                          num_all_samples,
                           input_data_dir,
                           output_dir))
 
         if return_num_original_samples:
-            return chunk_paths, parsing_result_data['num_all_samples']
+            return chunk_paths, num_all_samples
         return chunk_paths
 
+    def __log_tensorisation_summary(self, partition_summaries: Dict[int, Dict[str, Any]],
+                                    processed_partitions: Iterable[int], num_slowest: int = 5) -> None:
+        """Log the time taken per partition, to spot slow shards of the input data."""
+        times = sorted((partition_summaries[idx]['time'], idx) for idx in processed_partitions)
+        if len(times) == 0:
+            return
+        self.train_log("Tensorised %i partitions in %.1fs of worker time (median %.1fs, max %.1fs per partition)."
+                       % (len(times), sum(t for t, _ in times), times[len(times) // 2][0], times[-1][0]))
+        for partition_time, idx in reversed(times[-num_slowest:]):
+            summary = partition_summaries[idx]
+            self.train_log("  Partition %i: %.1fs, %i samples (%i used), %.1f samples/s."
+                           % (idx, partition_time, summary['num_all_samples'], summary['num_used_samples'],
+                              summary['num_all_samples'] / max(partition_time, 1e-6)))
+
     @abstractmethod
     def _init_minibatch(self, batch_data: Dict[str, Any]) -> None:
         """
@@ -411,6 +675,23 @@ class Model(ABC):
         """
         return {self.__placeholders['dropout_keep_rate']: self.hyperparameters['dropout_keep_rate'] if is_train else 1.0}
 
+    def _get_batch_packing_budget(self) -> Optional[int]:
+        """
+        The capacity of a minibatch, in the unit of the sizes returned by _get_batch_packing_info.
+        :return: None to fill minibatches with samples in order until _extend_minibatch_by_sample reports them as full.
+        """
+        return None
+
+    def _get_batch_packing_info(self, sample: Dict[str, Any]) -> Tuple[int, int]:
+        """
+        Sizes used to pack a sample into minibatches, if _get_batch_packing_budget is not None.
+        :param sample: The sample to pack.
+        :return: Pair of the size of the sample, which counts against the budget of the minibatch, and a secondary
+          size, which is only used to order samples of the same size. By default, each sample has size 1, so that
+          the budget is a number of samples.
+        """
+        return 1, 0
+
     def train_log(self, msg) -> None:
         if 'run_id' in self.hyperparameters:
             log_path = os.path.join(self.__log_save_dir,
@@ -428,6 +709,11 @@ class Model(ABC):
         print(msg.encode('ascii', errors='replace').decode())
 
     def __raw_batches_from_chunks_iterator(self, data_chunk_paths: List[RichPath], is_train: bool=False) -> Iterable[Tuple[Dict[str, Any], int, int]]:
+        batch_budget = self._get_batch_packing_budget()
+        if batch_budget is not None:
+            yield from self.__packed_raw_batches_from_chunks_iterator(data_chunk_paths, batch_budget, is_train)
+            return
+
         chunk_iterator = read_data_chunks(data_chunk_paths, shuffle_chunks=is_train, num_workers=5, max_queue_size=25)
         ChunkInformation = namedtuple("ChunkInformation", ["data", "sample_idx_list", "samples_used_so_far"])
         open_chunks_info = []
@@ -483,14 +769,74 @@ class Model(ABC):
             samples_used_so_far += cur_batch_data['samples_in_batch']
             yield cur_batch_data, cur_batch_data['samples_in_batch'], samples_used_so_far
 
+    def __packed_raw_batches_from_chunks_iterator(self, data_chunk_paths: List[RichPath], batch_budget: int,
+                                                  is_train: bool) -> Iterable[Tuple[Dict[str, Any], int, int]]:
+        """
+        Like __raw_batches_from_chunks_iterator, but bin-packs the samples of a window of chunks into minibatches
+        that are filled as close as possible to batch_budget without exceeding it.
+        For training, ties between samples of the same size and the order of minibatches are random; otherwise,
+        the minibatches only depend on the data.
+        """
+        chunk_iterator = read_data_chunks(data_chunk_paths, shuffle_chunks=is_train, num_workers=5, max_queue_size=25)
+        num_chunks_per_window = 25 if is_train else 1
+        # Minibatches filled less than this are not emitted but re-packed with the samples of the next window:
+        min_batch_fill_ratio = 0.9
+
+        samples_used_so_far = 0
+        carried_over_samples = []  # type: List[Dict[str, Any]]
+        chunks_exhausted = False
+        while not chunks_exhausted:
+            window_samples = carried_over_samples
+            for _ in range(num_chunks_per_window):
+                try:
+                    chunk = next(chunk_iterator)
+                except StopIteration:
+                    chunks_exhausted = True
+                    break
+                window_samples.extend(chunk[i] for i in range(len(chunk)))
+            if is_train:
+                np.random.shuffle(window_samples)
+
+            # Order samples by secondary size first, so that samples of the same size end up grouped by it:
+            packing_infos = [self._get_batch_packing_info(sample) for sample in window_samples]
+            order = sorted(range(len(window_samples)), key=lambda i: -packing_infos[i][1])
+            window_samples = [window_samples[i] for i in order]
+            bins, bin_sizes = pack_into_bins([packing_infos[i][0] for i in order], batch_budget)
+
+            carried_over_samples = []
+            batches = []
+            for bin_sample_idxs, bin_size in zip(bins, bin_sizes):
+                if not chunks_exhausted and bin_size < min_batch_fill_ratio * batch_budget:
+                    carried_over_samples.extend(window_samples[i] for i in bin_sample_idxs)
+                else:
+                    batches.append(bin_sample_idxs)
+            if is_train:
+                np.random.shuffle(batches)
+
+            for batch_sample_idxs in batches:
+                batch_data = {}  # type: Dict[str, Any]
+                self._init_minibatch(batch_data)
+                for sample_idx in batch_sample_idxs:
+                    batch_data['samples_in_batch'] += 1
+                    self._extend_minibatch_by_sample(batch_data, window_samples[sample_idx])
+                samples_used_so_far += batch_data['samples_in_batch']
+                yield batch_data, batch_data['samples_in_batch'], samples_used_so_far
+
     def _data_to_minibatches(self, data: Union[List[RichPath], Dict[str, Any]], is_train: bool=False) \
             -> Iterable[Tuple[Dict[tf.Tensor, Any], int, int]]:
         if isinstance(data, list):
-            raw_batch_iterator = self.__raw_batches_from_chunks_iterator(data, is_train=is_train)
-            for (idx, (raw_batch, samples_in_batch, samples_used_so_far)) in enumerate(raw_batch_iterator):
+            def finalise_raw_batch(raw_batch_info: Tuple[Dict[str, Any], int, int]) -> Tuple[Dict[tf.Tensor, Any], int, int]:
+                raw_batch, samples_in_batch, samples_used_so_far = raw_batch_info
                 minibatch = self._finalise_minibatch(raw_batch, is_train)
                 minibatch[self.__placeholders['batch_size']] = samples_in_batch
-                yield (minibatch, samples_in_batch, samples_used_so_far)
+                return minibatch, samples_in_batch, samples_used_so_far
+
+            # Raw batches are collected in one background thread and finalised in several others, so that
+            # the next minibatches are ready while the session is running:
+            raw_batch_iterator = self.__raw_batches_from_chunks_iterator(data, is_train=is_train)
+            yield from map_in_background(raw_batch_iterator, finalise_raw_batch,
+                                         num_workers=self.hyperparameters.get('num_minibatch_builders', 2),
+                                         max_num_prefetched=self.hyperparameters.get('minibatch_prefetch_depth', 8))
         else:
             batch_data = {}
             self._init_minibatch(batch_data)
@@ -506,11 +852,24 @@ class Model(ABC):
         epoch_loss = 0.0
         epoch_fetches = defaultdict(list)
         epoch_start = time.time()
-        data_generator = self._data_to_minibatches(data_chunk_paths, is_train=is_train)
         samples_used_so_far = 0
         printed_one_line = False
 
-        for minibatch_counter, (batch_data_dict, samples_in_batch, samples_used_so_far) in enumerate(data_generator):
+        # Measure how long we are waiting for minibatches, i.e., how long the session is stalled:
+        stall_time = 0.0
+        def timed_data_generator():
+            nonlocal stall_time
+            data_iterator = iter(self._data_to_minibatches(data_chunk_paths, is_train=is_train))
+            while True:
+                wait_start = time.time()
+                try:
+                    batch = next(data_iterator)
+                except StopIteration:
+                    return
+                stall_time += time.time() - wait_start
+                yield batch
+
+        for minibatch_counter, (batch_data_dict, samples_in_batch, samples_used_so_far) in enumerate(timed_data_generator()):
             if not quiet and (minibatch_counter % 100) == 0:
                 print("%s: Batch %5i (has %i samples). Processed %i samples. Loss so far: %.4f.   "
                       % (epoch_name, minibatch_counter, samples_in_batch,
@@ -538,8 +897,8 @@ class Model(ABC):
         if printed_one_line:
             print("\r\x1b[K", end='')
         if not quiet:
-            self.train_log("  Epoch %s took %.2fs [processed %s samples/second]"
-                       % (epoch_name, used_time, int(samples_used_so_far/used_time)))
+            self.train_log("  Epoch %s took %.2fs [processed %s samples/second, stalled %.2fs (%.1f%%) waiting for minibatches]"
+                       % (epoch_name, used_time, int(samples_used_so_far/used_time), stall_time, 100 * stall_time / used_time))
 
         if samples_used_so_far != 0:
             epoch_loss = epoch_loss / samples_used_so_far
@@ -608,29 +967,197 @@ class Model(ABC):
     ])
 
     @abstractmethod
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str) -> Iterator['Model.Annotation']:
+    def _get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        """
+        :return: The ops computed for annotating, each with one row per target of the minibatch.
+        """
+        pass
+
+    @abstractmethod
+    def _annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                               fetches: Dict[str, np.ndarray]) -> Iterator['Model.Annotation']:
+        """
+        Create the annotations of a single sample.
+        :param fetches: The values of _get_annotation_fetches(), restricted to the rows of the targets of the sample.
+        """
         pass
 
+    @staticmethod
+    def get_annotation_targets(raw_sample: Dict[str, Any], loaded_sample: Dict[str, Any]) -> List[Tuple[int, str, str, Tuple[int, int], str]]:
+        """
+        :return: (node id, original annotation, name, location, kind) of the supernodes of raw_sample that are targets
+          in the loaded sample, in the order in which the model outputs them.
+        """
+        targets = []
+        for node_idx, annotation_data in raw_sample['supernodes'].items():
+            node_idx = int(node_idx)
+            if 'ignored_supernodes' in loaded_sample and node_idx in loaded_sample['ignored_supernodes']:
+                continue
+            targets.append((node_idx, annotation_data['annotation'], annotation_data['name'], annotation_data['location'], annotation_data['type']))
+        return targets
+
     def annotate(self, test_raw_data_chunk_paths: List[RichPath]) -> Iterator['Model.Annotation']:
         """Return a list of original annotations and predicted annotations"""
-        data_chunk_iterator = (r.read_by_file_suffix() for r in test_raw_data_chunk_paths)
+        raw_samples = (raw_sample for r in test_raw_data_chunk_paths for raw_sample in read_raw_graph_chunk(r))
+        for _, annotation in self.annotate_samples(raw_samples):
+            yield annotation
+
+    def annotate_samples(self, raw_samples: Iterable[Dict[str, Any]]) -> Iterator[Tuple[int, 'Model.Annotation']]:
+        """
+        Return the original and predicted annotations of raw samples, each with the index of its sample in raw_samples.
+        """
+        for sample_idx, raw_sample, loaded_test_sample, sample_fetches in \
+                self.compute_per_sample(raw_samples, self._get_annotation_fetches()):
+            provenance = raw_sample.get('filename', '?')
+            for annotation in self._annotate_from_fetches(raw_sample, loaded_test_sample, provenance, sample_fetches):
+                yield sample_idx, annotation
+
+    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str) -> Iterator['Model.Annotation']:
+        """Return the original and predicted annotations of a single sample, loaded with load_test_samples."""
+        for _, raw_sample, loaded_test_sample, sample_fetches in \
+                self.compute_per_loaded_sample([(0, raw_sample, loaded_test_sample)], self._get_annotation_fetches()):
+            yield from self._annotate_from_fetches(raw_sample, loaded_test_sample, provenance, sample_fetches)
+
+    def load_test_samples(self, raw_samples: Iterable[Dict[str, Any]]) \
+            -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any]]]:
+        """
+        :return: (index of the sample in raw_samples, raw sample, loaded sample) for all samples that the model uses,
+            in order.
+        """
+        for sample_idx, raw_sample in enumerate(raw_samples):
+            loaded_test_sample = {}
+            use_example = self._load_data_from_sample(self.hyperparameters,
+                                                      self.metadata,
+                                                      raw_sample=raw_sample,
+                                                      result_holder=loaded_test_sample,
+                                                      is_train=False)
+            if use_example:
+                yield sample_idx, raw_sample, loaded_test_sample
+
+    def load_test_samples_in_parallel(self, data_paths: List[RichPath], num_workers: Optional[int] = None) \
+            -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any]]]:
+        """
+        Like load_test_samples for the samples in data_paths, but loading the files in worker processes. Samples are
+        returned as they are loaded (numbered in that order), so their order differs from that of the files.
+        """
+        hyperparameters, metadata = self.hyperparameters, self.metadata
+
+        def load_file(_, data_path: RichPath) -> Iterable[Tuple[Dict[str, Any], Dict[str, Any]]]:
+            for raw_sample in read_raw_graph_chunk(data_path):
+                loaded_test_sample = {}
+                if type(self)._load_data_from_sample(hyperparameters, metadata, raw_sample=raw_sample,
+                                                     result_holder=loaded_test_sample, is_train=False):
+                    yield raw_sample, loaded_test_sample
+
+        loaded_samples = iterate_jobs_in_parallel(data_paths, load_file, num_workers=num_workers,
+                                                  shared_memory_min_bytes=SHARED_MEMORY_MIN_SAMPLE_ARRAY_BYTES)
+        for sample_idx, (raw_sample, loaded_test_sample) in enumerate(loaded_samples):
+            yield sample_idx, raw_sample, loaded_test_sample
+
+    def compute_per_sample(self, raw_samples: Iterable[Dict[str, Any]], fetch_dict: Dict[str, tf.Tensor]) \
+            -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any], Dict[str, np.ndarray]]]:
+        """
+        Compute the values of fetch_dict, whose ops have one row per target of the minibatch, for raw samples.
+
+        :return: (index of the sample in raw_samples, raw sample, loaded sample, values of fetch_dict for the targets
+            of the sample) for all samples that the model uses, in order.
+        """
+        return self.compute_per_loaded_sample(self.load_test_samples(raw_samples), fetch_dict)
+
+    def compute_per_loaded_sample(self, loaded_samples: Iterable[Tuple[int, Dict[str, Any], Dict[str, Any]]],
+                                  fetch_dict: Dict[str, tf.Tensor]) \
+            -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any], Dict[str, np.ndarray]]]:
+        """
+        Compute the values of fetch_dict, whose ops have one row per target of the minibatch, for samples returned by
+        load_test_samples or load_test_samples_in_parallel.
+
+        Samples are run through the model in minibatches, packed in order (within the budget of
+        _get_batch_packing_budget(), if any), and the outputs are split up per sample again.
+
+        :return: (sample index, raw sample, loaded sample, values of fetch_dict for the targets of the sample) for all
+            samples, in order.
+        """
+        batch_budget = self._get_batch_packing_budget()
+        if self.__fetch_cache is not None:
+            cache_key_prefix = hashlib.sha256(self.__get_fingerprint())
+            cache_key_prefix.update(repr(sorted(fetch_dict)).encode())
         with self.sess.as_default():
-            sample_idx = 0
-            for raw_data_chunk in data_chunk_iterator:
-                for raw_sample in raw_data_chunk:
-                    provenance = raw_sample.get('filename', '?')
-
-                    loaded_test_sample = {}
-                    use_example = self._load_data_from_sample(self.hyperparameters,
-                                                              self.metadata,
-                                                              raw_sample=raw_sample,
-                                                              result_holder=loaded_test_sample,
-                                                              is_train=False)
-                    if not use_example:
-                        continue
-
-                    sample_idx += 1
-                    yield from self.annotate_single(raw_sample, loaded_test_sample, provenance)
+            # (sample index, raw sample, loaded sample, cache key, cached values of fetch_dict or None)
+            batch_samples = []  # type: List[Tuple[int, Dict[str, Any], Dict[str, Any], Optional[str], Optional[Dict[str, np.ndarray]]]]
+            batch_data = {}  # type: Dict[str, Any]
+            batch_size = 0
+            for sample_idx, raw_sample, loaded_test_sample in loaded_samples:
+                cache_key, cached_fetches = None, None
+                if self.__fetch_cache is not None:
+                    cache_key = hash_raw_sample(raw_sample, cache_key_prefix.copy()).hexdigest()
+                    cached_fetches = self.__fetch_cache.get(cache_key)
+                if cached_fetches is not None:
+                    if len(batch_samples) == 0:
+                        yield sample_idx, raw_sample, loaded_test_sample, cached_fetches
+                    else:
+                        # Keep the order of the samples, by yielding this one after the batch.
+                        batch_samples.append((sample_idx, raw_sample, loaded_test_sample, cache_key, cached_fetches))
+                    continue
+
+                sample_size = self._get_batch_packing_info(loaded_test_sample)[0] if batch_budget is not None else 0
+                if len(batch_samples) > 0 and batch_budget is not None and batch_size + sample_size > batch_budget:
+                    yield from self.__compute_minibatch(batch_samples, batch_data, fetch_dict)
+                    batch_samples, batch_size = [], 0
+
+                if len(batch_samples) == 0:
+                    batch_data = {}
+                    self._init_minibatch(batch_data)
+                batch_samples.append((sample_idx, raw_sample, loaded_test_sample, cache_key, None))
+                batch_data['samples_in_batch'] += 1
+                batch_size += sample_size
+                batch_finished = self._extend_minibatch_by_sample(batch_data, loaded_test_sample)
+                if batch_finished:
+                    yield from self.__compute_minibatch(batch_samples, batch_data, fetch_dict)
+                    batch_samples, batch_size = [], 0
+
+            if len(batch_samples) > 0:
+                yield from self.__compute_minibatch(batch_samples, batch_data, fetch_dict)
+
+    def __compute_minibatch(self, batch_samples: List[Tuple[int, Dict[str, Any], Dict[str, Any], Optional[str], Optional[Dict[str, np.ndarray]]]],
+                            batch_data: Dict[str, Any], fetch_dict: Dict[str, tf.Tensor]) \
+            -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any], Dict[str, np.ndarray]]]:
+        minibatch = self._finalise_minibatch(batch_data, is_train=False)
+        minibatch[self.__placeholders['batch_size']] = batch_data['samples_in_batch']
+        fetches = self.__sess.run(fetch_dict, feed_dict=minibatch)
+
+        # Scatter the outputs back to the samples, whose targets are consecutive rows:
+        target_offset = 0
+        for sample_idx, raw_sample, loaded_test_sample, cache_key, cached_fetches in batch_samples:
+            if cached_fetches is not None:
+                yield sample_idx, raw_sample, loaded_test_sample, cached_fetches
+                continue
+            num_targets = len(Model.get_annotation_targets(raw_sample, loaded_test_sample))
+            sample_fetches = {name: values[target_offset:target_offset + num_targets] for name, values in fetches.items()}
+            target_offset += num_targets
+            if cache_key is not None:
+                self.__fetch_cache.put(cache_key, sample_fetches)
+            yield sample_idx, raw_sample, loaded_test_sample, sample_fetches
+
+    def set_fetch_cache(self, fetch_cache: Optional[FetchCache]) -> None:
+        """
+        Use fetch_cache to store the per-sample results of compute_per_sample (and thus annotate), and to reuse them
+        for samples seen before. Entries are keyed by the sample and a fingerprint of the weights and hyperparameters
+        of the model, so that a cache directory can be shared by several models.
+        """
+        self.__fetch_cache = fetch_cache
+
+    def __get_fingerprint(self) -> bytes:
+        if self.__fingerprint is None:
+            fingerprint = hashlib.sha256(type(self).__name__.encode())
+            fingerprint.update(json.dumps({k: v for k, v in self.hyperparameters.items() if k != 'run_id'},
+                                          sort_keys=True, default=str).encode())
+            variables = sorted(self.__sess.graph.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES),
+                               key=lambda v: v.name)
+            for variable, value in zip(variables, self.__sess.run(variables)):
+                fingerprint.update(variable.name.encode())
+                fingerprint.update(np.ascontiguousarray(value).tobytes())
+            self.__fingerprint = fingerprint.digest()
+        return self.__fingerprint
 
     AnnotationRepresentation = NamedTuple('AnnotationRepresentation', [
         ('name', str),
@@ -642,7 +1169,7 @@ class Model(ABC):
 
     def export_representations(self, data_paths: List[RichPath]) -> Iterator['Model.AnnotationRepresentation']:
         def representation_iter():
-            data_chunk_iterator = (r.read_by_file_suffix() for r in data_paths)
+            data_chunk_iterator = (read_raw_graph_chunk(r) for r in data_paths)
             with self.sess.as_default():
                 for raw_data_chunk in data_chunk_iterator:
                     for raw_sample in raw_data_chunk:
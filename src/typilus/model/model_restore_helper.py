@@ -50,7 +50,7 @@ def restore(path: RichPath, is_train: bool, hyper_overrides: Optional[Dict[str,
                         run_name=saved_data.get('run_name'),
                         model_save_dir=model_save_dir,
                         log_save_dir=log_save_dir)   # pytype: disable=not-instantiable
-    model.metadata.update(saved_data['metadata'])
+    model._restore_metadata(path, saved_data['metadata'])
     model.make_model(is_train=is_train)
 
     variables_to_initialize = []
@@ -98,5 +98,9 @@ class Path2Annotation(PathBasedModel):
     def class_id_to_class(self, class_id: int) -> str:
         return self.__type_classification.class_id_to_class(class_id)
 
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str):
-        return self.__type_classification.annotate_single(raw_sample, loaded_test_sample, provenance)
+    def _get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        return self.__type_classification.get_annotation_fetches()
+
+    def _annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                               fetches: Dict[str, np.ndarray]):
+        return self.__type_classification.annotate_from_fetches(raw_sample, loaded_test_sample, provenance, fetches)
@@ -2,22 +2,106 @@ import logging
 import re
 from abc import abstractmethod
 from collections import defaultdict
-from itertools import product
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Set
 
 import numpy as np
 import tensorflow as tf
 from dpu_utils.mlutils import Vocabulary
 from dpu_utils.tfutils import unsorted_segment_softmax
 
+from data_preparation.scripts.graph_generator.compactgraphs import get_adjacency_dict
 from .components.tokenembedder import TokenEmbedder
 from .model import Model, write_to_minibatch
-from .samplingiter import sampling_iter
+from .samplingiter import sampling_iter, sample_increasing_pairs
 from .utils import ignore_type_annotation
 
 IDENTIFIER_REGEX = re.compile("[a-zA-Z_][a-zA-Z0-9_]*")
 
 
+class AncestorIndex:
+    """
+    Answers lowest common ancestor queries on a forest in O(1), after O(n log n) precomputation: the LCA of two nodes
+    is the shallowest node between their first occurrences in an Euler tour of their tree, which is found with a
+    sparse table of range minima over the depths along the tour.
+    """
+    def __init__(self, num_nodes: int, node_to_parent: Dict[int, int], node_to_children: Dict[int, Set[int]]):
+        self.__node_to_parent = node_to_parent
+        self.__depth = [0] * num_nodes
+        self.__root = [-1] * num_nodes
+        self.__first_occurrence = [-1] * num_nodes
+
+        tour, tour_depths = [], []
+        roots = [n for n in node_to_children if n not in node_to_parent]
+        for root in roots:
+            stack = [(root, iter(node_to_children.get(root, ())))]
+            self.__first_occurrence[root] = len(tour)
+            self.__root[root] = root
+            tour.append(root)
+            tour_depths.append(0)
+            while len(stack) > 0:
+                node, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    if len(stack) > 0:
+                        tour.append(stack[-1][0])
+                        tour_depths.append(self.__depth[stack[-1][0]])
+                    continue
+                self.__depth[child] = self.__depth[node] + 1
+                self.__root[child] = root
+                self.__first_occurrence[child] = len(tour)
+                tour.append(child)
+                tour_depths.append(self.__depth[child])
+                stack.append((child, iter(node_to_children.get(child, ()))))
+
+        self.__tour = tour
+        # sparse_table[j][i] is the position of the shallowest node in tour[i:i + 2 ** j]
+        depths = np.array(tour_depths, dtype=np.int32)
+        level = np.arange(len(tour), dtype=np.int32)
+        self.__sparse_table = [level.tolist()]
+        width = 1
+        while 2 * width <= len(tour):
+            left, right = level[:-width], level[width:]
+            level = np.where(depths[left] <= depths[right], left, right)
+            self.__sparse_table.append(level.tolist())
+            width *= 2
+
+    def depth(self, node_idx: int) -> int:
+        return self.__depth[node_idx]
+
+    def lowest_common_ancestor(self, node1_idx: int, node2_idx: int) -> Optional[int]:
+        """Return the LCA of the two nodes, or None if they are not in the same tree."""
+        if self.__root[node1_idx] < 0 or self.__root[node1_idx] != self.__root[node2_idx]:
+            return None
+        start, end = sorted((self.__first_occurrence[node1_idx], self.__first_occurrence[node2_idx]))
+        level = (end - start + 1).bit_length() - 1
+        candidate1 = self.__sparse_table[level][start]
+        candidate2 = self.__sparse_table[level][end - (1 << level) + 1]
+        tour = self.__tour
+        return tour[candidate1] if self.__depth[tour[candidate1]] <= self.__depth[tour[candidate2]] else tour[candidate2]
+
+    def get_path(self, node1_idx: int, node2_idx: int, max_path_size: int) -> Optional[List[int]]:
+        """
+        Return the nodes on the path from node1 up to the LCA and down to node2, or None if there is no such path or
+        it has more than max_path_size nodes.
+        """
+        if node1_idx == node2_idx:
+            return [node1_idx]
+        join_node = self.lowest_common_ancestor(node1_idx, node2_idx)
+        if join_node is None:
+            return None  # Rare cases where a dummy node was constructed but is not part of the AST.
+        if self.__depth[node1_idx] + self.__depth[node2_idx] - 2 * self.__depth[join_node] + 1 > max_path_size:
+            return None
+
+        path_node1_to_join_node = [node1_idx]
+        while path_node1_to_join_node[-1] != join_node:
+            path_node1_to_join_node.append(self.__node_to_parent[path_node1_to_join_node[-1]])
+        path_node2_to_join_node = [node2_idx]
+        while path_node2_to_join_node[-1] != join_node:
+            path_node2_to_join_node.append(self.__node_to_parent[path_node2_to_join_node[-1]])
+        return path_node1_to_join_node + path_node2_to_join_node[:-1][::-1]
+
+
 class PathBasedModel(Model):
 
     LOGGER = logging.getLogger('PathBasedModel')
@@ -157,7 +241,7 @@ class PathBasedModel(Model):
         all_leaf_node_ids = set(raw_sample['token-sequence'])
         all_leaf_nodes = [raw_sample['nodes'][fid] for fid in all_leaf_node_ids
                           if IDENTIFIER_REGEX.match(raw_sample['nodes'][fid])]   # type: List[str]
-        all_non_terminals = (raw_sample['nodes'][int(fid)] for fid in raw_sample['edges']['CHILD'].keys() if int(fid) not in all_leaf_node_ids)
+        all_non_terminals = (raw_sample['nodes'][int(fid)] for fid in get_adjacency_dict(raw_sample['edges']['CHILD']).keys() if int(fid) not in all_leaf_node_ids)
         TokenEmbedder.load_metadata_from_sample('leaf_label', all_leaf_nodes, raw_metadata, hyperparameters)
         raw_metadata['path_elements'].update(all_non_terminals)
 
@@ -181,9 +265,10 @@ class PathBasedModel(Model):
                                      raw_sample: Dict[str, Any], result_holder: Dict[str, Any],
                                      is_train: bool=True) -> bool:
         leaf_node_ids = set(t for t in raw_sample['token-sequence'] if IDENTIFIER_REGEX.match(raw_sample['nodes'][t]))
+        sorted_leaf_node_ids = sorted(leaf_node_ids)
 
         supernode_to_ground_nodes = defaultdict(set)   # int->set(int)
-        for from_idx, to_idxs in raw_sample['edges']['OCCURRENCE_OF'].items():
+        for from_idx, to_idxs in get_adjacency_dict(raw_sample['edges']['OCCURRENCE_OF']).items():
             from_idx = int(from_idx)
             for to_idx in to_idxs:
                 supernode_to_ground_nodes[to_idx].add(from_idx)
@@ -195,8 +280,8 @@ class PathBasedModel(Model):
             annotation = supernode_data['annotation']
             if is_train and ignore_type_annotation(annotation):
                 continue
-            all_path_leaves = ((f,t) for f, t in product(supernode_to_ground_nodes[supernode_idx], leaf_node_ids) if f<t)
-            paths_per_super_node[supernode_idx] = set(sampling_iter(all_path_leaves, hyperparameters['max_num_paths_per_variable']))
+            paths_per_super_node[supernode_idx] = set(sample_increasing_pairs(
+                supernode_to_ground_nodes[supernode_idx], sorted_leaf_node_ids, hyperparameters['max_num_paths_per_variable']))
 
         if len(paths_per_super_node) == 0:
             return False
@@ -215,7 +300,7 @@ class PathBasedModel(Model):
             return False
 
         # now just get the concrete paths
-        child_edges = {int(k): set(v) for k,v in raw_sample['edges']['CHILD'].items()}
+        child_edges = {int(k): set(v) for k,v in get_adjacency_dict(raw_sample['edges']['CHILD']).items()}
 
         node_to_parent = {}  # type: Dict[int, int]
         for from_idx, to_idxs in child_edges.items():
@@ -223,34 +308,7 @@ class PathBasedModel(Model):
                 assert to_idx not in node_to_parent, 'A node cannot have multiple parents.'
                 node_to_parent[to_idx] = from_idx
 
-        def get_all_ancestors(node_idx):
-            parents = set()
-            while node_idx is not None:
-                parents.add(node_idx)
-                node_idx = node_to_parent.get(node_idx)
-            return parents
-
-        def get_path(node1_idx, node2_idx):
-            node1_parents = get_all_ancestors(node1_idx)
-            node2_parents = get_all_ancestors(node2_idx)
-            common_ancestors = node1_parents & node2_parents
-            if len(common_ancestors) == 0:
-                return None  # Rare cases where a dummy node was constructed but is not part of the AST.
-
-            path_node1_to_join_node = [node1_idx]
-            join_node = node1_idx
-            while join_node not in common_ancestors:
-                join_node = node_to_parent[join_node]
-                path_node1_to_join_node.append(join_node)
-
-            path_node2_to_join_node = [node2_idx]
-            join_node = node2_idx
-            while join_node not in common_ancestors:
-                join_node = node_to_parent[join_node]
-                path_node2_to_join_node.append(join_node)
-
-            assert path_node1_to_join_node[-1] == path_node2_to_join_node[-1]
-            return path_node1_to_join_node + path_node2_to_join_node[:-1][::-1]
+        ancestor_index = AncestorIndex(len(raw_sample['nodes']), node_to_parent, child_edges)
 
         token_to_id = {}
         tokens = []
@@ -258,9 +316,9 @@ class PathBasedModel(Model):
         path_leaf_idxs = []
         path_to_sample_idx = []
         for sample_idx, (supernode_idx, paths_for_supernode) in enumerate(paths_per_super_node.items()):
-            paths = (get_path(*p) for p in paths_for_supernode)
+            paths = (ancestor_index.get_path(*p, max_path_size=hyperparameters['max_path_size']) for p in paths_for_supernode)
             for path in paths:
-                if path is None or len(path) > hyperparameters['max_path_size']:
+                if path is None:
                     continue
                 if path[0] in leaf_node_ids:
                     left_leaf = raw_sample['nodes'][path[0]]
@@ -1,6 +1,7 @@
 import random
-from itertools import islice
-from typing import Iterator, List, TypeVar
+from bisect import bisect_right
+from itertools import accumulate, islice
+from typing import Iterable, Iterator, List, Tuple, TypeVar
 
 T = TypeVar('T')
 
@@ -14,3 +15,23 @@ def sampling_iter(base_iter: Iterator[T], sample_size: int) -> List[T]:
             sampled_items[j] = element
 
     return sampled_items
+
+
+def sample_increasing_pairs(firsts: Iterable[int], sorted_seconds: List[int], sample_size: int) -> List[Tuple[int, int]]:
+    """
+    Uniformly sample (without replacement) up to sample_size of the pairs (f, s) with f in firsts, s in sorted_seconds
+    and f < s. The pairs are not enumerated, so this takes time linear in len(firsts) and sample_size.
+    """
+    firsts = sorted(firsts)
+    starts = [bisect_right(sorted_seconds, f) for f in firsts]
+    cumulative_counts = list(accumulate(len(sorted_seconds) - start for start in starts))
+    num_pairs = cumulative_counts[-1] if len(cumulative_counts) > 0 else 0
+    if num_pairs <= sample_size:
+        return [(f, sorted_seconds[j]) for f, start in zip(firsts, starts) for j in range(start, len(sorted_seconds))]
+
+    sampled_pairs = []
+    for pair_idx in random.sample(range(num_pairs), sample_size):
+        i = bisect_right(cumulative_counts, pair_idx)
+        offset = pair_idx - (cumulative_counts[i - 1] if i > 0 else 0)
+        sampled_pairs.append((firsts[i], sorted_seconds[starts[i] + offset]))
+    return sampled_pairs
@@ -3,6 +3,7 @@ from typing import List, Dict, Any, Tuple, Optional
 import numpy as np
 import tensorflow as tf
 
+from data_preparation.scripts.graph_generator.compactgraphs import get_adjacency_dict
 from typilus.model.components.multiheadattention import transformer_model
 from typilus.model.components.tokenembedder import TokenEmbedder
 from typilus.model.typeclassificationmodel import TypeClassificationModel
@@ -185,7 +186,7 @@ class Sequence2Annotation(Model, TypeClassificationModel):
         # Some supernodes do not have an associated token. Such nodes are attributes
         token_node_idxs = set(raw_sample['token-sequence'])
         node_idx_to_supernode_idx = {}  #  type: Dict[int, int]
-        for from_idx, to_idxs in raw_sample['edges']['OCCURRENCE_OF'].items():
+        for from_idx, to_idxs in get_adjacency_dict(raw_sample['edges']['OCCURRENCE_OF']).items():
             from_idx = int(from_idx)
             if from_idx not in token_node_idxs:
                 continue
@@ -314,5 +315,9 @@ class Sequence2Annotation(Model, TypeClassificationModel):
     def class_id_to_class(self, class_id: int) -> str:
         return self.__type_classification.class_id_to_class(class_id)
 
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str):
-        return self.__type_classification.annotate_single(raw_sample, loaded_test_sample, provenance)
+    def _get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        return self.__type_classification.get_annotation_fetches()
+
+    def _annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                               fetches: Dict[str, np.ndarray]):
+        return self.__type_classification.annotate_from_fetches(raw_sample, loaded_test_sample, provenance, fetches)
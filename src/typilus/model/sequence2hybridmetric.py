@@ -4,6 +4,7 @@ import numpy as np
 import tensorflow as tf
 from dpu_utils.utils import RichPath
 
+from data_preparation.scripts.graph_generator.compactgraphs import get_adjacency_dict
 from typilus.model.components.multiheadattention import transformer_model
 from typilus.model.components.tokenembedder import TokenEmbedder
 from typilus.model.typeclassificationmodel import TypeClassificationModel
@@ -209,12 +210,13 @@ class Sequence2HybridMetric(Model):
 
         token_node_idxs = set(raw_sample['token-sequence'])
         node_idx_to_supernode_idx = {}  #  type: Dict[int, int]
-        for from_idx, to_idxs in raw_sample['edges']['OCCURRENCE_OF'].items():
+        child_edges = get_adjacency_dict(raw_sample['edges']['CHILD'])
+        for from_idx, to_idxs in get_adjacency_dict(raw_sample['edges']['OCCURRENCE_OF']).items():
             from_idx = int(from_idx)
             if from_idx not in token_node_idxs:
                 # Some supernodes do not have an associated token. Such nodes are attributes
-                if str(from_idx) in raw_sample['edges']['CHILD']:
-                    right_token_idx = max(raw_sample['edges']['CHILD'][str(from_idx)])
+                if str(from_idx) in child_edges:
+                    right_token_idx = max(child_edges[str(from_idx)])
                     assert right_token_idx in token_node_idxs
                     from_idx = right_token_idx
                 else:
@@ -338,8 +340,15 @@ class Sequence2HybridMetric(Model):
 
         return minibatch
 
-    def create_index(self, data_paths: List[RichPath]):
-        self.__type_metric.create_index(data_paths, self.metadata)
+    def create_index(self, data_paths: List[RichPath], append: bool = False, num_workers: Optional[int] = None):
+        self.__type_metric.create_index(data_paths, self.metadata, append, num_workers)
+
+    def _get_metadata_to_save(self, path: RichPath) -> Dict[str, Any]:
+        return self.__type_metric.get_metadata_to_save(path, super()._get_metadata_to_save(path))
+
+    def _restore_metadata(self, path: RichPath, saved_metadata: Dict[str, Any]) -> None:
+        super()._restore_metadata(path, saved_metadata)
+        self.__type_metric.restore_metadata(path, self.metadata)
 
     # ------- These are the bits that we only need for test-time:
     def _encode_one_test_sample(self, sample_data_dict: Dict[tf.Tensor, Any]) -> Tuple[tf.Tensor, Optional[tf.Tensor]]:
@@ -347,5 +356,9 @@ class Sequence2HybridMetric(Model):
                               feed_dict=sample_data_dict),
                 None)
 
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str):
-        return self.__type_metric.annotate_single(raw_sample, loaded_test_sample, provenance, self.metadata)
+    def _get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        return self.__type_metric.get_annotation_fetches()
+
+    def _annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                               fetches: Dict[str, np.ndarray]):
+        return self.__type_metric.annotate_from_fetches(raw_sample, loaded_test_sample, provenance, fetches, self.metadata)
@@ -0,0 +1,132 @@
+"""
+A columnar, memory-mapped format for chunks of tensorised samples.
+
+All samples of a chunk are written into one file. For every field that is a numpy array (or a fixed-length list
+of numpy arrays) in all samples, the per-sample arrays are concatenated along their first axis into one aligned
+block, with an offset index of length num_samples + 1. All other fields (provenance strings, scalars, ...) are
+small and stored in the pickled file header.
+
+Reading a chunk only unpickles the header; array fields are memory-mapped and sliced per sample on access, so
+samples are never decompressed or unpickled, and their pages are shared with the OS page cache across epochs.
+"""
+import pickle
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+FILE_SUFFIX = '.tensors'
+
+_MAGIC = b'TYPTNSR1'
+_ALIGNMENT = 64
+
+
+def _array_layout(value: Any) -> Any:
+    """Return a hashable description of the array layout of value, or None if it is not stored columnar."""
+    if isinstance(value, np.ndarray):
+        if value.ndim == 0 or value.dtype.hasobject:
+            return None
+        return value.dtype.str, value.shape[1:]
+    if isinstance(value, list) and len(value) > 0 and all(isinstance(v, np.ndarray) for v in value):
+        layouts = tuple(_array_layout(v) for v in value)
+        if any(l is None for l in layouts):
+            return None
+        return 'list', layouts
+    return None
+
+
+def save_tensorised_chunk(samples: List[Dict[str, Any]], path: str) -> None:
+    # Find the fields that have the same array layout in all samples:
+    columnar_fields = {}  # type: Dict[str, Any]
+    if len(samples) > 0:
+        for key, value in samples[0].items():
+            layout = _array_layout(value)
+            if layout is not None and all(key in s and _array_layout(s[key]) == layout for s in samples):
+                columnar_fields[key] = layout
+
+    # Each column is one concatenated array; list fields are split into one column per list element.
+    columns = []  # type: List[Tuple[str, int, str, Tuple[int, ...]]]
+    for key, layout in sorted(columnar_fields.items()):
+        if layout[0] == 'list':
+            columns.extend((key, i, dtype, trailing_shape) for i, (dtype, trailing_shape) in enumerate(layout[1]))
+        else:
+            columns.append((key, -1, layout[0], layout[1]))
+
+    def column_values(key: str, list_idx: int) -> List[np.ndarray]:
+        if list_idx < 0:
+            return [s[key] for s in samples]
+        return [s[key][list_idx] for s in samples]
+
+    column_infos = []
+    data_offset = 0
+    for key, list_idx, dtype, trailing_shape in columns:
+        lengths = [len(v) for v in column_values(key, list_idx)]
+        sample_offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=sample_offsets[1:])
+        num_bytes = int(sample_offsets[-1]) * int(np.prod(trailing_shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        column_infos.append({
+            'key': key, 'list_idx': list_idx, 'dtype': dtype, 'trailing_shape': trailing_shape,
+            'sample_offsets': sample_offsets, 'data_offset': data_offset, 'num_bytes': num_bytes
+        })
+        data_offset += -(-num_bytes // _ALIGNMENT) * _ALIGNMENT
+
+    header = pickle.dumps({
+        'num_samples': len(samples),
+        'columns': column_infos,
+        'list_lengths': {k: len(l[1]) for k, l in columnar_fields.items() if l[0] == 'list'},
+        'other_fields': [{k: v for k, v in s.items() if k not in columnar_fields} for s in samples],
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+    data_start = -(-(len(_MAGIC) + 8 + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for column_info, (key, list_idx, dtype, _) in zip(column_infos, columns):
+            f.seek(data_start + column_info['data_offset'])
+            for value in column_values(key, list_idx):
+                f.write(np.ascontiguousarray(value, dtype=dtype).tobytes())
+        f.truncate(data_start + data_offset)
+
+
+class TensorisedChunk(Sequence[Dict[str, Any]]):
+    """Read-only view of a chunk written by save_tensorised_chunk. Samples are materialised on indexing."""
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not a tensorised chunk file.' % path)
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = pickle.loads(f.read(header_len))
+        data_start = -(-(len(_MAGIC) + 8 + header_len) // _ALIGNMENT) * _ALIGNMENT
+
+        self.__num_samples = header['num_samples']
+        self.__other_fields = header['other_fields']
+        self.__list_lengths = header['list_lengths']
+        self.__columns = []  # type: List[Tuple[str, int, np.ndarray, np.ndarray]]
+        for column_info in header['columns']:
+            shape = (int(column_info['sample_offsets'][-1]),) + tuple(column_info['trailing_shape'])
+            if column_info['num_bytes'] == 0:
+                data = np.zeros(shape, dtype=column_info['dtype'])  # mmap cannot map empty regions
+            else:
+                # Copy-on-write, so that consumers modifying samples in place do not touch the file.
+                data = np.memmap(path, dtype=column_info['dtype'], mode='c',
+                                 offset=data_start + column_info['data_offset'], shape=shape)
+            self.__columns.append((column_info['key'], column_info['list_idx'], column_info['sample_offsets'], data))
+
+    def __len__(self) -> int:
+        return self.__num_samples
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        if idx < 0:
+            idx += self.__num_samples
+        if not 0 <= idx < self.__num_samples:
+            raise IndexError(idx)
+        sample = dict(self.__other_fields[idx])
+        for key, length in self.__list_lengths.items():
+            sample[key] = [None] * length
+        for key, list_idx, sample_offsets, data in self.__columns:
+            value = data[sample_offsets[idx]:sample_offsets[idx + 1]]
+            if list_idx < 0:
+                sample[key] = value
+            else:
+                sample[key][list_idx] = value
+        return sample
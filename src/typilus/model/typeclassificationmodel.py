@@ -1,10 +1,11 @@
 from abc import ABC
-from collections import Counter
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Iterator
 
+import numpy as np
 import tensorflow as tf
 from dpu_utils.mlutils import Vocabulary
 
+from typilus.model.countsketch import make_counter, merge_counters, most_common_counter
 from typilus.model.model import write_to_minibatch, Model
 from typilus.model.utils import ignore_type_annotation
 
@@ -63,7 +64,7 @@ class TypeClassificationModel(ABC):
 
     @staticmethod
     def _init_metadata(hyperparameters: Dict[str, Any], raw_metadata: Dict[str, Any]) -> None:
-        raw_metadata['type_occurences_counter'] = Counter()
+        raw_metadata['type_occurences_counter'] = make_counter(hyperparameters)
 
     @staticmethod
     def _load_metadata_from_sample(hyperparameters: Dict[str, Any], raw_sample: Dict[str, Any],
@@ -76,13 +77,14 @@ class TypeClassificationModel(ABC):
 
     def _finalise_metadata(self, raw_metadata_list: List[Dict[str, Any]], final_metadata: Dict[str, Any]):
         # Merge counters
-        merged_type_counter = Counter()
-        for raw_metadata in raw_metadata_list:
-            merged_type_counter.update(raw_metadata["type_occurences_counter"])
+        max_vocab_size = self.__model.hyperparameters['max_type_annotation_vocab_size']
+        merged_type_counter = most_common_counter(
+            merge_counters(raw_metadata["type_occurences_counter"] for raw_metadata in raw_metadata_list),
+            max_size=max_vocab_size)
 
         final_metadata['annotation_vocab'] = Vocabulary.create_vocabulary(
             merged_type_counter,
-            max_size=self.__model.hyperparameters['max_type_annotation_vocab_size'])
+            max_size=max_vocab_size)
         return final_metadata
 
     @staticmethod
@@ -102,22 +104,16 @@ class TypeClassificationModel(ABC):
         write_to_minibatch(
             minibatch, self.__model.placeholders['typed_annotation_target_class'], batch_data['batch_target_variable_class'])
 
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str):
-        _, fetches = self.__model._run_epoch_in_batches(
-            loaded_test_sample, '(test)', is_train=False, quiet=True,
-            additional_fetch_dict={'target_log_probs': self.__model.ops['target_log_probs']}
-        )
+    def get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        return {'target_log_probs': self.__model.ops['target_log_probs']}
+
+    def annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                              fetches: Dict[str, np.ndarray]) -> Iterator['Model.Annotation']:
+        """Create the annotations of a sample from the values of get_annotation_fetches() for its targets."""
         target_log_probs = fetches['target_log_probs']
 
         # assumes that loading happens in the same order.
-        original_annotations = []
-        for node_idx, annotation_data in raw_sample['supernodes'].items():
-            node_idx = int(node_idx)
-            if 'ignored_supernodes' in loaded_test_sample and node_idx in loaded_test_sample['ignored_supernodes']:
-                continue
-
-            annotation = annotation_data['annotation']
-            original_annotations.append((node_idx, annotation, annotation_data['name'], annotation_data['location'], annotation_data['type']))
+        original_annotations = Model.get_annotation_targets(raw_sample, loaded_test_sample)
 
         assert len(original_annotations) == target_log_probs.shape[0]
 
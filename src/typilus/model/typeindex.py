@@ -0,0 +1,659 @@
+"""
+Indices over the type space of metric models, answering k-nearest-neighbour queries under the L1 distance.
+
+ * 'annoy': Annoy's forest of random projection trees. Approximate, memory-mapped when loaded.
+ * 'exact': Brute-force search with numpy, in blocks of bounded memory. Exact and memory-mapped when loaded, but the
+   cost of a query grows linearly with the size of the index.
+ * 'ivfpq': An inverted file over coarse L1 centroids, with product-quantised residuals. Approximate and compressed to
+   one byte per subspace and element. Only the lists of the num_probes closest centroids are scanned per query.
+ * 'segmented': A base index of one of the types above, which can be extended by building again after adding items.
+   Added items go into small exact delta segments, which are compacted into segments of the base type over time.
+
+Options are passed as keyword arguments to create_type_index (build and query options) and load_type_index (query
+options only).
+"""
+import json
+import os
+import shutil
+import tempfile
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import annoy
+import numpy as np
+
+# Upper bound on the size (in bytes) of the intermediate arrays of brute-force searches.
+EXACT_SEARCH_BLOCK_SIZE = 64 * 1024 * 1024
+# Added vectors may be memory-mapped, and are read in blocks of at most this many vectors when building indices.
+BUILD_BLOCK_SIZE = 65536
+
+
+def find_exact_nearest_neighbours(indexed_vectors: np.ndarray, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the ids of and L1 distances to the k nearest indexed_vectors of each query, ordered by distance."""
+    k = min(k, indexed_vectors.shape[0])
+    num_queries, num_indexed = queries.shape[0], indexed_vectors.shape[0]
+    nn_ids = np.empty((num_queries, k), dtype=np.int64)
+    nn_distances = np.empty((num_queries, k), dtype=np.float32)
+    if num_queries == 0 or k == 0:
+        return nn_ids, nn_distances
+    # Both the queries and the indexed vectors are split into blocks, so that the differences of a block of queries to
+    # a block of indexed vectors fit into EXACT_SEARCH_BLOCK_SIZE bytes. The k nearest neighbours found so far are
+    # merged with those of each block of indexed vectors.
+    vector_size = max(1, indexed_vectors.shape[1]) * indexed_vectors.itemsize
+    max_block_elements = max(1, EXACT_SEARCH_BLOCK_SIZE // vector_size)
+    query_block_size = min(num_queries, max(1, int(np.sqrt(max_block_elements))))
+    index_block_size = max(1, max_block_elements // query_block_size)
+    for query_start in range(0, num_queries, query_block_size):
+        block = queries[query_start:query_start + query_block_size]
+        block_ids = np.zeros((len(block), 0), dtype=np.int64)
+        block_distances = np.zeros((len(block), 0), dtype=np.float32)
+        for index_start in range(0, num_indexed, index_block_size):
+            indexed_block = indexed_vectors[index_start:index_start + index_block_size]
+            distances = np.abs(block[:, np.newaxis, :] - indexed_block[np.newaxis, :, :]).sum(axis=-1)  # B x M
+            ids, distances = _smallest_k(distances, min(k, len(indexed_block)))
+            merged_ids = np.concatenate([block_ids, ids + index_start], axis=1)
+            merged_distances = np.concatenate([block_distances, distances.astype(np.float32)], axis=1)
+            closest, block_distances = _smallest_k(merged_distances, min(k, merged_ids.shape[1]))
+            block_ids = np.take_along_axis(merged_ids, closest, axis=1)
+        nn_ids[query_start:query_start + len(block)] = block_ids
+        nn_distances[query_start:query_start + len(block)] = block_distances
+    return nn_ids, nn_distances
+
+
+def _smallest_k(distances: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the column indices and values of the k smallest values in each row of distances, in ascending order."""
+    if k < distances.shape[1]:
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+    order = np.argsort(candidate_distances, axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(candidate_distances, order, axis=1)
+
+
+def _pad_neighbours(nn_ids: np.ndarray, nn_distances: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if nn_ids.shape[1] >= k:
+        return nn_ids, nn_distances
+    padding = ((0, 0), (0, k - nn_ids.shape[1]))
+    return np.pad(nn_ids, padding, constant_values=-1), np.pad(nn_distances, padding, constant_values=np.inf)
+
+
+class TypeIndex(ABC):
+    """
+    A k-nearest-neighbour index over representations in type space. Vectors are added with add_items, are
+    identified by the order in which they were added, and can be queried after build().
+    """
+    FILE_SUFFIX = None  # type: str
+    # The options of load(), which only affect queries. All other options are fixed when the index is built.
+    QUERY_OPTIONS = ()  # type: Tuple[str, ...]
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def add_items(self, vectors: np.ndarray) -> None:
+        pass
+
+    @abstractmethod
+    def build(self) -> None:
+        pass
+
+    @abstractmethod
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the ids of and L1 distances to the k nearest neighbours of each query, ordered by distance. Rows with
+        fewer than k neighbours are padded with id -1 and an infinite distance.
+        """
+        pass
+
+    @abstractmethod
+    def save(self, path: str) -> None:
+        pass
+
+    @classmethod
+    @abstractmethod
+    def load(cls, path: str, dimension: int, **options) -> 'TypeIndex':
+        pass
+
+    @classmethod
+    def copy_files(cls, source_path: str, target_path: str) -> None:
+        """Copy the saved index at source_path to target_path."""
+        shutil.copyfile(source_path, target_path)
+
+    @classmethod
+    def remove_unreferenced_files(cls, path: str) -> None:
+        """Delete files that were saved for the index at path, but that it no longer uses."""
+        pass
+
+
+class AnnoyTypeIndex(TypeIndex):
+    FILE_SUFFIX = '.index.ann'
+    QUERY_OPTIONS = ('search_k',)
+
+    # Annoy indices up to this size are searched exactly (and faster) with numpy.
+    MAX_EXACT_SEARCH_INDEX_SIZE = 20000
+
+    def __init__(self, dimension: int, num_trees: int = 20, search_k: int = -1, build_on_disk: bool = True,
+                 build_dir: Optional[str] = None):
+        """
+        :param build_on_disk: Build the index in a memory-mapped temporary file (in build_dir, or the default temporary
+          directory), instead of in memory.
+        """
+        self.__index = annoy.AnnoyIndex(dimension, 'manhattan')
+        self.__num_trees = num_trees
+        self.__search_k = search_k
+        self.__build_on_disk = build_on_disk
+        self.__build_dir = build_dir
+        self.__build_path = None  # type: Optional[str]
+        self.__num_items = 0
+        self.__item_vectors = None  # type: Optional[np.ndarray]
+
+    def __len__(self) -> int:
+        return self.__num_items
+
+    def add_items(self, vectors: np.ndarray) -> None:
+        if self.__build_on_disk and self.__build_path is None:
+            file_descriptor, self.__build_path = tempfile.mkstemp(suffix=self.FILE_SUFFIX, dir=self.__build_dir)
+            os.close(file_descriptor)
+            weakref.finalize(self, os.remove, self.__build_path)
+            self.__index.on_disk_build(self.__build_path)
+        for start in range(0, len(vectors), BUILD_BLOCK_SIZE):
+            for vector in np.asarray(vectors[start:start + BUILD_BLOCK_SIZE]):
+                self.__index.add_item(self.__num_items, vector)
+                self.__num_items += 1
+
+    def build(self) -> None:
+        self.__index.build(self.__num_trees)
+        if self.__build_path is not None:
+            # Annoy does not save indices built on disk to other files, but does save loaded ones.
+            self.__index.unload()
+            self.__index.load(self.__build_path)
+
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self.__num_items <= self.MAX_EXACT_SEARCH_INDEX_SIZE:
+            if self.__item_vectors is None:
+                self.__item_vectors = np.array([self.__index.get_item_vector(i) for i in range(self.__num_items)],
+                                               dtype=np.float32).reshape(self.__num_items, -1)
+            return _pad_neighbours(*find_exact_nearest_neighbours(self.__item_vectors, queries.astype(np.float32), k), k)
+
+        # Annoy releases the GIL while searching, so queries run in parallel on a thread pool, which only lives as long
+        # as the call.
+        with ThreadPoolExecutor(max_workers=max(1, min(len(queries), os.cpu_count() or 1))) as query_pool:
+            results = list(query_pool.map(
+                lambda q: self.__index.get_nns_by_vector(q, n=k, search_k=self.__search_k, include_distances=True),
+                queries))
+        nn_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        nn_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for i, (ids, distances) in enumerate(results):
+            nn_ids[i, :len(ids)] = ids
+            nn_distances[i, :len(distances)] = distances
+        return nn_ids, nn_distances
+
+    def save(self, path: str) -> None:
+        self.__index.save(path)
+
+    @classmethod
+    def load(cls, path: str, dimension: int, search_k: int = -1, **options) -> 'AnnoyTypeIndex':
+        index = cls(dimension, search_k=search_k)
+        # Annoy memory-maps the file, so that all processes using it share its pages.
+        index.__index.load(path)
+        index.__num_items = index.__index.get_n_items()
+        return index
+
+
+class ExactTypeIndex(TypeIndex):
+    FILE_SUFFIX = '.index.npy'
+
+    def __init__(self, dimension: int):
+        self.__dimension = dimension
+        self.__added_vectors = []  # type: List[np.ndarray]
+        self.__vectors = np.zeros((0, dimension), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.__vectors.shape[0] + sum(len(v) for v in self.__added_vectors)
+
+    def add_items(self, vectors: np.ndarray) -> None:
+        self.__added_vectors.append(np.asarray(vectors, dtype=np.float32).reshape(-1, self.__dimension))
+
+    def build(self) -> None:
+        if len(self.__vectors) == 0 and len(self.__added_vectors) == 1:
+            # Used as is, so that memory-mapped vectors are not read into memory.
+            self.__vectors = self.__added_vectors[0]
+        elif len(self.__added_vectors) > 0:
+            self.__vectors = np.concatenate([self.__vectors] + self.__added_vectors)
+        self.__added_vectors = []
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.__vectors
+
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return _pad_neighbours(*find_exact_nearest_neighbours(self.__vectors, queries.astype(np.float32), k), k)
+
+    def save(self, path: str) -> None:
+        # Through a file object, since np.save would append ".npy" to a path not ending with it.
+        with open(path, 'wb') as f:
+            np.save(f, self.__vectors)
+
+    @classmethod
+    def load(cls, path: str, dimension: int, **options) -> 'ExactTypeIndex':
+        index = cls(dimension)
+        index.__vectors = np.load(path, mmap_mode='r')
+        return index
+
+
+def train_l1_centroids(vectors: np.ndarray, num_centroids: int, num_iterations: int,
+                       rng: np.random.RandomState) -> np.ndarray:
+    """k-medians clustering, i.e. k-means under the L1 distance: points are assigned to their closest centroid under
+    L1, and each centroid is moved to the coordinate-wise median of its points."""
+    num_centroids = min(num_centroids, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=num_centroids, replace=False)].copy()
+    for _ in range(num_iterations):
+        assignment = find_exact_nearest_neighbours(centroids, vectors, 1)[0][:, 0]
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(num_centroids + 1))
+        for c in range(num_centroids):
+            if bounds[c] == bounds[c + 1]:
+                # Re-seed empty clusters with a random point.
+                centroids[c] = vectors[rng.randint(len(vectors))]
+            else:
+                centroids[c] = np.median(vectors[order[bounds[c]:bounds[c + 1]]], axis=0)
+    return centroids
+
+
+class IVFPQTypeIndex(TypeIndex):
+    FILE_SUFFIX = '.index.npz'
+    QUERY_OPTIONS = ('num_probes',)
+
+    def __init__(self, dimension: int, num_lists: int = 1024, num_subspaces: int = 16, num_probes: int = 16,
+                 num_training_samples: int = 100000, num_training_iterations: int = 10, seed: int = 0):
+        self.__dimension = dimension
+        self.__num_lists = num_lists
+        self.__num_subspaces = min(num_subspaces, dimension)
+        self.__num_probes = num_probes
+        self.__num_training_samples = num_training_samples
+        self.__num_training_iterations = num_training_iterations
+        self.__seed = seed
+        self.__added_vectors = []  # type: List[np.ndarray]
+
+        self.__coarse_centroids = np.zeros((0, dimension), dtype=np.float32)
+        self.__subspace_bounds = np.zeros(0, dtype=np.int64)
+        self.__codebooks = []  # type: List[np.ndarray]  # One (<=256) x subspace dimension array per subspace
+        # Codes and ids of the elements, sorted by their list, which spans list_offsets[l]:list_offsets[l + 1]
+        self.__codes = np.zeros((0, self.__num_subspaces), dtype=np.uint8)
+        self.__ids = np.zeros(0, dtype=np.int64)
+        self.__list_offsets = np.zeros(1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.__ids) + sum(len(v) for v in self.__added_vectors)
+
+    def add_items(self, vectors: np.ndarray) -> None:
+        self.__added_vectors.append(np.asarray(vectors, dtype=np.float32).reshape(-1, self.__dimension))
+
+    def build(self) -> None:
+        if len(self.__ids) > 0:
+            raise ValueError('Product-quantised indices cannot be extended after they were built.')
+        # The added vectors may be memory-mapped, so they are only ever accessed in blocks.
+        blocks = [vectors[start:start + BUILD_BLOCK_SIZE] for vectors in self.__added_vectors
+                  for start in range(0, len(vectors), BUILD_BLOCK_SIZE)]
+        self.__added_vectors = []
+        num_vectors = sum(len(b) for b in blocks)
+        if num_vectors == 0:
+            return
+
+        rng = np.random.RandomState(self.__seed)
+        training_idxs = np.sort(rng.choice(num_vectors, size=min(num_vectors, self.__num_training_samples), replace=False))
+        block_offsets = np.concatenate([[0], np.cumsum([len(b) for b in blocks])])
+        training_vectors = np.concatenate([
+            block[training_idxs[(training_idxs >= start) & (training_idxs < end)] - start]
+            for block, start, end in zip(blocks, block_offsets[:-1], block_offsets[1:])
+        ]).astype(np.float32)
+        self.__coarse_centroids = train_l1_centroids(training_vectors, self.__num_lists,
+                                                     self.__num_training_iterations, rng)
+        training_residuals = training_vectors - self.__coarse_centroids[
+            find_exact_nearest_neighbours(self.__coarse_centroids, training_vectors, 1)[0][:, 0]]
+
+        # The L1 distance is the sum of the L1 distances in each subspace, so distances can be computed per subspace
+        # from precomputed tables, with no approximation besides the quantisation itself.
+        subspace_sizes = [len(s) for s in np.array_split(np.arange(self.__dimension), self.__num_subspaces)]
+        self.__subspace_bounds = np.concatenate([[0], np.cumsum(subspace_sizes)]).astype(np.int64)
+        self.__codebooks = [
+            train_l1_centroids(np.ascontiguousarray(training_residuals[:, start:end]), 256,
+                               self.__num_training_iterations, rng)
+            for start, end in zip(self.__subspace_bounds[:-1], self.__subspace_bounds[1:])
+        ]
+
+        list_assignments, codes = [], []
+        for block in blocks:
+            block = np.asarray(block, dtype=np.float32)
+            list_assignment = find_exact_nearest_neighbours(self.__coarse_centroids, block, 1)[0][:, 0]
+            residuals = block - self.__coarse_centroids[list_assignment]
+            codes.append(np.stack([
+                find_exact_nearest_neighbours(codebook, np.ascontiguousarray(residuals[:, start:end]), 1)[0][:, 0]
+                for codebook, start, end in zip(self.__codebooks, self.__subspace_bounds[:-1],
+                                                self.__subspace_bounds[1:])
+            ], axis=1).astype(np.uint8))
+            list_assignments.append(list_assignment.astype(np.int32))
+        list_assignment = np.concatenate(list_assignments)
+
+        self.__ids = np.argsort(list_assignment, kind='stable')
+        self.__codes = np.concatenate(codes)[self.__ids]
+        self.__list_offsets = np.zeros(len(self.__coarse_centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(list_assignment, minlength=len(self.__coarse_centroids)), out=self.__list_offsets[1:])
+
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = queries.astype(np.float32)
+        nn_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        nn_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if len(self.__ids) == 0:
+            return nn_ids, nn_distances
+
+        probed_lists = find_exact_nearest_neighbours(self.__coarse_centroids, queries, self.__num_probes)[0]
+        subspace_idxs = np.arange(len(self.__codebooks))
+        # The distance tables are computed for blocks of queries at once, bounded like the intermediate arrays of
+        # brute-force searches:
+        max_subspace_size = int(np.max(np.diff(self.__subspace_bounds)))
+        query_table_size = probed_lists.shape[1] * 256 * max(len(self.__codebooks), max_subspace_size) * 4
+        block_size = max(1, EXACT_SEARCH_BLOCK_SIZE // query_table_size)
+        for block_start in range(0, len(queries), block_size):
+            block_lists = probed_lists[block_start:block_start + block_size]
+            residuals = queries[block_start:block_start + block_size, np.newaxis, :] \
+                - self.__coarse_centroids[block_lists]  # B x P x D
+            # tables[b, p, m, c]: L1 distance of the residual of query b to probe p to centroid c of subspace m
+            tables = np.zeros(block_lists.shape + (len(self.__codebooks), 256), dtype=np.float32)
+            for m, (codebook, start, end) in enumerate(zip(self.__codebooks, self.__subspace_bounds[:-1],
+                                                           self.__subspace_bounds[1:])):
+                tables[:, :, m, :len(codebook)] = \
+                    np.abs(residuals[:, :, np.newaxis, start:end] - codebook[np.newaxis, np.newaxis, :, :]).sum(axis=-1)
+
+            for j, lists in enumerate(block_lists):
+                starts, ends = self.__list_offsets[lists], self.__list_offsets[lists + 1]
+                candidates = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+                if len(candidates) == 0:
+                    continue
+                candidate_probes = np.repeat(np.arange(len(lists)), ends - starts)
+                distances = tables[j][candidate_probes[:, np.newaxis], subspace_idxs[np.newaxis, :],
+                                      self.__codes[candidates]].sum(axis=1)
+                closest, closest_distances = _smallest_k(distances[np.newaxis, :], min(k, len(candidates)))
+                nn_ids[block_start + j, :closest.shape[1]] = self.__ids[candidates[closest[0]]]
+                nn_distances[block_start + j, :closest.shape[1]] = closest_distances[0]
+        return nn_ids, nn_distances
+
+    def save(self, path: str) -> None:
+        arrays = {
+            'coarse_centroids': self.__coarse_centroids,
+            'subspace_bounds': self.__subspace_bounds,
+            'codes': self.__codes,
+            'ids': self.__ids,
+            'list_offsets': self.__list_offsets,
+        }
+        for m, codebook in enumerate(self.__codebooks):
+            arrays['codebook_%i' % m] = codebook
+        # Through a file object, since np.savez would append ".npz" to a path not ending with it.
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path: str, dimension: int, num_probes: int = 16, **options) -> 'IVFPQTypeIndex':
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {k: data[k] for k in data.files}
+        index = cls(dimension, num_lists=len(arrays['coarse_centroids']),
+                    num_subspaces=len(arrays['subspace_bounds']) - 1, num_probes=num_probes)
+        index.__coarse_centroids = arrays['coarse_centroids']
+        index.__subspace_bounds = arrays['subspace_bounds']
+        index.__codebooks = [arrays['codebook_%i' % m] for m in range(len(arrays['subspace_bounds']) - 1)]
+        index.__codes = arrays['codes']
+        index.__ids = arrays['ids']
+        index.__list_offsets = arrays['list_offsets']
+        return index
+
+
+class SegmentedTypeIndex(TypeIndex):
+    """
+    An index made of segments that cover consecutive ranges of ids, and whose results are merged at query time.
+
+    The items added before the first build() form a base segment of type base_type, which is never rebuilt. Items
+    added later form a new exact (and cheap to build) delta segment on each build(). Once there are more than
+    max_delta_segments of them, or they hold more than compaction_ratio times as many items as the other segments, the
+    delta segments are compacted into a single segment of type base_type. Later compactions rebuild that segment with
+    the new delta segments, from its vectors, which are kept in an exact segment that is not queried. So there are at
+    most max_delta_segments + 2 segments to query. Segments are never modified, and are not written again when the
+    index is saved next to its previous version.
+
+    The index is saved as a JSON manifest listing the files of the segments, which are stored next to it, and the
+    options used to build new segments. When loaded, the query options of each segment type apply to its segments, and
+    those of base_type also to the segments built afterwards.
+    """
+    FILE_SUFFIX = '.index.seg'
+    SEGMENT_FILE_PREFIX = 'segment-'
+
+    def __init__(self, dimension: int, base_type: str = 'annoy', max_delta_segments: int = 4,
+                 compaction_ratio: float = 0.1, **base_options: Any):
+        self.__dimension = dimension
+        self.__base_type = base_type
+        self.__base_options = base_options
+        self.__max_delta_segments = max_delta_segments
+        self.__compaction_ratio = compaction_ratio
+        # (index type, segment, path of the file that the segment was loaded from or saved to, if any)
+        self.__segments = []  # type: List[Tuple[str, TypeIndex, Optional[str]]]
+        # The last num_delta_segments segments are delta segments.
+        self.__num_delta_segments = 0
+        # If not None, the segment before the delta segments is the compacted one, and these are its vectors.
+        self.__compacted_vectors = None  # type: Optional[Tuple[str, TypeIndex, Optional[str]]]
+        self.__added_vectors = []  # type: List[np.ndarray]
+
+    @staticmethod
+    def from_index(dimension: int, index_type: str, index: TypeIndex, path: Optional[str],
+                   **options: Any) -> 'SegmentedTypeIndex':
+        """Wrap an existing index, saved at path (if not None), as the base segment of a new segmented index."""
+        segmented_index = SegmentedTypeIndex(dimension, base_type=index_type, **options)
+        segmented_index.__segments.append((index_type, index, path))
+        return segmented_index
+
+    @property
+    def num_segments(self) -> int:
+        return len(self.__segments)
+
+    def __len__(self) -> int:
+        return sum(len(segment) for _, segment, _ in self.__segments) + sum(len(v) for v in self.__added_vectors)
+
+    def add_items(self, vectors: np.ndarray) -> None:
+        self.__added_vectors.append(np.asarray(vectors, dtype=np.float32).reshape(-1, self.__dimension))
+
+    def build(self) -> None:
+        added_vectors, self.__added_vectors = [v for v in self.__added_vectors if len(v) > 0], []
+        if len(added_vectors) == 0:
+            return
+        if len(self.__segments) == 0:
+            segment = create_type_index(self.__base_type, self.__dimension, **self.__base_options)
+            for vectors in added_vectors:
+                segment.add_items(vectors)
+            segment.build()
+            self.__segments.append((self.__base_type, segment, None))
+            return
+
+        delta_segment = ExactTypeIndex(self.__dimension)
+        for vectors in added_vectors:
+            delta_segment.add_items(vectors)
+        delta_segment.build()
+        self.__segments.append(('exact', delta_segment, None))
+        self.__num_delta_segments += 1
+        self.__compact_if_needed()
+
+    def __compact_if_needed(self) -> None:
+        first_delta = len(self.__segments) - self.__num_delta_segments
+        num_delta_items = sum(len(segment) for _, segment, _ in self.__segments[first_delta:])
+        num_other_items = sum(len(segment) for _, segment, _ in self.__segments[:first_delta])
+        if self.__num_delta_segments <= self.__max_delta_segments \
+                and num_delta_items <= self.__compaction_ratio * num_other_items:
+            return
+
+        first_compacted = first_delta
+        compacted_vectors = ExactTypeIndex(self.__dimension)
+        if self.__compacted_vectors is not None:
+            first_compacted -= 1
+            compacted_vectors.add_items(self.__compacted_vectors[1].vectors)
+        for _, segment, _ in self.__segments[first_delta:]:
+            compacted_vectors.add_items(segment.vectors)
+        compacted_vectors.build()
+
+        compacted_segment = create_type_index(self.__base_type, self.__dimension, **self.__base_options)
+        compacted_segment.add_items(compacted_vectors.vectors)
+        compacted_segment.build()
+        self.__segments = self.__segments[:first_compacted] + [(self.__base_type, compacted_segment, None)]
+        self.__num_delta_segments = 0
+        self.__compacted_vectors = ('exact', compacted_vectors, None)
+
+    def query(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        all_ids, all_distances = [], []
+        id_offset = 0
+        for _, segment, _ in self.__segments:
+            ids, distances = segment.query(queries, k)
+            all_ids.append(np.where(ids >= 0, ids + id_offset, -1))
+            all_distances.append(distances)
+            id_offset += len(segment)
+        if len(all_ids) == 0:
+            return np.full((len(queries), k), -1, dtype=np.int64), np.full((len(queries), k), np.inf, dtype=np.float32)
+        if len(all_ids) == 1:
+            return all_ids[0], all_distances[0]
+        merged_ids, merged_distances = np.concatenate(all_ids, axis=1), np.concatenate(all_distances, axis=1)
+        closest, closest_distances = _smallest_k(merged_distances, k)
+        return np.take_along_axis(merged_ids, closest, axis=1), closest_distances
+
+    def __save_segment(self, segment_info: Tuple[str, TypeIndex, Optional[str]], target_dir: str) \
+            -> Tuple[Tuple[str, TypeIndex, Optional[str]], Dict[str, Any]]:
+        index_type, segment, segment_path = segment_info
+        if segment_path is None or os.path.dirname(os.path.abspath(segment_path)) != target_dir:
+            # Segment files are named uniquely, so that they never need to be overwritten.
+            segment_file = '%s%s%s' % (self.SEGMENT_FILE_PREFIX, uuid.uuid4().hex,
+                                       get_type_index_class(index_type).FILE_SUFFIX)
+            new_segment_path = os.path.join(target_dir, segment_file)
+            if segment_path is None:
+                segment.save(new_segment_path)
+            else:
+                get_type_index_class(index_type).copy_files(segment_path, new_segment_path)
+            segment_path = new_segment_path
+        return (index_type, segment, segment_path), \
+            {'type': index_type, 'file': os.path.basename(segment_path), 'num_items': len(segment)}
+
+    def save(self, path: str) -> None:
+        target_dir = os.path.dirname(os.path.abspath(path))
+        manifest = {'base_type': self.__base_type, 'base_options': self.__base_options,
+                    'max_delta_segments': self.__max_delta_segments, 'compaction_ratio': self.__compaction_ratio,
+                    'num_delta_segments': self.__num_delta_segments, 'compacted_vectors': None, 'segments': []}
+        for i, segment_info in enumerate(self.__segments):
+            self.__segments[i], segment_manifest = self.__save_segment(segment_info, target_dir)
+            manifest['segments'].append(segment_manifest)
+        if self.__compacted_vectors is not None:
+            self.__compacted_vectors, manifest['compacted_vectors'] = \
+                self.__save_segment(self.__compacted_vectors, target_dir)
+        _write_manifest(path, manifest)
+        self.remove_unreferenced_files(path)
+
+    @classmethod
+    def load(cls, path: str, dimension: int, **options) -> 'SegmentedTypeIndex':
+        with open(path) as f:
+            manifest = json.load(f)
+        base_type = manifest['base_type']
+        base_options = dict(manifest.get('base_options', {}))
+        base_options.update(_get_query_options(base_type, options))
+        index = cls(dimension, base_type=base_type, max_delta_segments=manifest.get('max_delta_segments', 4),
+                    compaction_ratio=manifest.get('compaction_ratio', 0.1), **base_options)
+        source_dir = os.path.dirname(os.path.abspath(path))
+        for segment_info in manifest['segments']:
+            segment_path = os.path.join(source_dir, segment_info['file'])
+            segment = load_type_index(segment_info['type'], segment_path, dimension,
+                                      **_get_query_options(segment_info['type'], options))
+            index.__segments.append((segment_info['type'], segment, segment_path))
+        if 'num_delta_segments' in manifest:
+            index.__num_delta_segments = manifest['num_delta_segments']
+        else:
+            # Older manifests: the delta segments are the exact segments at the end (after the base segment).
+            while index.__num_delta_segments < len(index.__segments) - 1 \
+                    and index.__segments[-index.__num_delta_segments - 1][0] == 'exact':
+                index.__num_delta_segments += 1
+        if manifest.get('compacted_vectors') is not None:
+            vectors_path = os.path.join(source_dir, manifest['compacted_vectors']['file'])
+            index.__compacted_vectors = ('exact', ExactTypeIndex.load(vectors_path, dimension), vectors_path)
+        return index
+
+    @classmethod
+    def copy_files(cls, source_path: str, target_path: str) -> None:
+        with open(source_path) as f:
+            manifest = json.load(f)
+        source_dir, target_dir = os.path.dirname(os.path.abspath(source_path)), os.path.dirname(os.path.abspath(target_path))
+        if source_dir != target_dir:
+            for segment_info in _get_segment_files(manifest):
+                get_type_index_class(segment_info['type']).copy_files(os.path.join(source_dir, segment_info['file']),
+                                                                      os.path.join(target_dir, segment_info['file']))
+        _write_manifest(target_path, manifest)
+        cls.remove_unreferenced_files(target_path)
+
+    @classmethod
+    def remove_unreferenced_files(cls, path: str) -> None:
+        """
+        Delete the segment files next to the manifest at path that no manifest in its directory (including temporary
+        ones, written before being moved into place) refers to anymore, i.e., segments that were compacted away.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        referenced_files = set()
+        for file_name in os.listdir(directory):
+            if cls.FILE_SUFFIX not in file_name or file_name.startswith(cls.SEGMENT_FILE_PREFIX):
+                continue
+            try:
+                with open(os.path.join(directory, file_name)) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue  # Not a manifest, or one being written
+            if not isinstance(manifest, dict) or 'segments' not in manifest:
+                continue
+            referenced_files.update(segment_info['file'] for segment_info in _get_segment_files(manifest))
+        for file_name in os.listdir(directory):
+            if file_name.startswith(cls.SEGMENT_FILE_PREFIX) and file_name not in referenced_files:
+                os.remove(os.path.join(directory, file_name))
+
+
+def _get_segment_files(manifest: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The information on all segment files referenced by a manifest of a SegmentedTypeIndex."""
+    if manifest.get('compacted_vectors') is None:
+        return manifest['segments']
+    return manifest['segments'] + [manifest['compacted_vectors']]
+
+
+def _write_manifest(path: str, manifest: Dict[str, Any]) -> None:
+    # Written to a temporary file first, so that the manifest is replaced atomically.
+    tmp_path = path + '.tmp-%s' % uuid.uuid4().hex
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+TYPE_INDEX_CLASSES = {
+    'annoy': AnnoyTypeIndex,
+    'exact': ExactTypeIndex,
+    'ivfpq': IVFPQTypeIndex,
+    'segmented': SegmentedTypeIndex,
+}  # type: Dict[str, Type[TypeIndex]]
+
+
+def get_type_index_class(index_type: str) -> Type[TypeIndex]:
+    if index_type not in TYPE_INDEX_CLASSES:
+        raise ValueError('Unknown type index "%s". Known indices: %s' % (index_type, ', '.join(TYPE_INDEX_CLASSES)))
+    return TYPE_INDEX_CLASSES[index_type]
+
+
+def _get_query_options(index_type: str, options: Dict[str, Any]) -> Dict[str, Any]:
+    query_options = get_type_index_class(index_type).QUERY_OPTIONS
+    return {name: value for name, value in options.items() if name in query_options}
+
+
+def create_type_index(index_type: str, dimension: int, **options: Any) -> TypeIndex:
+    return get_type_index_class(index_type)(dimension, **options)
+
+
+def load_type_index(index_type: str, path: str, dimension: int, **options: Any) -> TypeIndex:
+    return get_type_index_class(index_type).load(path, dimension, **options)
@@ -1,16 +1,51 @@
 import logging
+import os
 import tempfile
-from collections import defaultdict
-from typing import Dict, Any, List
+import time
+import weakref
+from array import array
+from typing import Dict, Any, List, Iterator, Optional, Tuple
 
-import annoy
 import numpy as np
 import tensorflow as tf
 from dpu_utils.utils import RichPath
+from dpu_utils.utils.richpath import LocalPath
 
 from typilus.model.model import write_to_minibatch, Model
+from typilus.model.typeindex import TypeIndex, SegmentedTypeIndex, create_type_index, get_type_index_class, \
+    load_type_index
 from typilus.model.utils import ignore_type_annotation
 
+NUM_NEIGHBOURS = 10
+
+
+def vote_for_types(nn_type_ids: np.ndarray, nn_distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Weigh the types of the nearest neighbours of each query by their inverse squared distance.
+    Neighbours with a type id < 0 are ignored.
+
+    :return: A tuple (query_idxs, type_ids, probabilities) listing the probability of each type voted for by the
+        neighbours of a query, sorted by query_idxs.
+    """
+    weights = 1 / (nn_distances.astype(np.float64) + 1e-10) ** 2
+    weights[nn_type_ids < 0] = 0
+    weights /= np.maximum(np.sum(weights, axis=1, keepdims=True), 1e-30)
+
+    num_types = int(nn_type_ids.max()) + 1 if nn_type_ids.size > 0 else 1
+    query_idxs = np.broadcast_to(np.arange(nn_type_ids.shape[0])[:, np.newaxis], nn_type_ids.shape)
+    valid = nn_type_ids >= 0
+    keys = query_idxs[valid] * num_types + nn_type_ids[valid]
+    unique_keys, key_idxs = np.unique(keys, return_inverse=True)
+    probabilities = np.bincount(key_idxs, weights=weights[valid], minlength=len(unique_keys))
+    return unique_keys // num_types, unique_keys % num_types, probabilities
+
+
+def intern_types(types: List[str]) -> Tuple[List[str], np.ndarray]:
+    """Return the distinct types and, for each element of types, the index of its type in them."""
+    type_to_id = {}  # type: Dict[str, int]
+    type_ids = np.fromiter((type_to_id.setdefault(t, len(type_to_id)) for t in types), dtype=np.int32, count=len(types))
+    return list(type_to_id), type_ids
+
 
 class TypeMetricLearningModel:
     """
@@ -80,103 +115,202 @@ class TypeMetricLearningModel:
 
         write_to_minibatch(minibatch, self.__model.placeholders['typed_annotation_pairs_are_equal'], types_are_equal)
 
-    def create_index(self, data_paths: List[RichPath], metadata: Dict[str, Any]) -> None:
-        def representation_iter():
-            data_chunk_iterator = (r.read_by_file_suffix() for r in data_paths)
-            with self.__model.sess.as_default():
-                for raw_data_chunk in data_chunk_iterator:
-                    for raw_sample in raw_data_chunk:
-                        loaded_sample = {}
-                        use_example = self.__model._load_data_from_sample(self.__model.hyperparameters,
-                                                                          self.__model.metadata,
-                                                                          raw_sample=raw_sample,
-                                                                          result_holder=loaded_sample,
-                                                                          is_train=False)
-                        if not use_example:
-                            continue
-
-                        _, fetches = self.__model._run_epoch_in_batches(
-                            loaded_sample, '(indexing)', is_train=False, quiet=True,
-                            additional_fetch_dict={'target_representations': self.__model.ops['target_representations']}
-                        )
-                        target_representations = fetches['target_representations']
-
-                        idx = 0
-                        for node_idx, annotation_data in raw_sample['supernodes'].items():
-                            node_idx = int(node_idx)
-                            if 'ignored_supernodes' in loaded_sample and node_idx in loaded_sample['ignored_supernodes']:
-                                continue
-
-                            annotation = annotation_data['annotation']
-                            if ignore_type_annotation(annotation):
-                                idx += 1
-                                continue
-
-                            yield target_representations[idx], annotation
-                            idx += 1
-
-        index = annoy.AnnoyIndex(self.__type_representation_size, 'manhattan')
-        indexed_element_types = []
+    def create_index(self, data_paths: List[RichPath], metadata: Dict[str, Any], append: bool = False,
+                     num_workers: Optional[int] = None) -> None:
+        """
+        Index the representations of the annotated symbols in data_paths. If append is set and the model already has
+        an index, the symbols are added to it, without recomputing the representations of those already in it.
+        The samples are loaded by num_workers worker processes (see utils.get_num_parallel_workers for the default).
+        """
+        index_options = self.__model.hyperparameters.get('type_index_options', {})
+        type_to_id = {}  # type: Dict[str, int]
+        indexed_element_type_ids = array('i')
+        if append and ('index' in metadata or 'index_path' in metadata):
+            index_type = metadata.get('index_type', 'annoy')
+            index = self.__get_index(metadata)
+            if not isinstance(index, SegmentedTypeIndex):
+                index = SegmentedTypeIndex.from_index(
+                    self.__type_representation_size, index_type, index,
+                    metadata['index_path'].to_local_path().path if 'index_path' in metadata else None, **index_options)
+                index_type = 'segmented'
+            type_to_id = {t: i for i, t in enumerate(metadata['indexed_type_names'])}
+            indexed_element_type_ids.extend(metadata['indexed_element_type_ids'].tolist())
+        else:
+            index_type = self.__model.hyperparameters.get('type_index', 'annoy')
+            index = create_type_index(index_type, self.__type_representation_size, **index_options)
+        num_previously_indexed = len(indexed_element_type_ids)
+        loaded_samples = self.__model.load_test_samples_in_parallel(data_paths, num_workers)
+        # Representations are buffered on disk, and added to the index from there, so that indices that support it
+        # are built out-of-core. The buffer is deleted once it is no longer used (by the index or otherwise).
+        buffer_file_descriptor, buffer_path = tempfile.mkstemp(suffix='.representations.bin')
         print('Creating index...')
-        for i, (representation, type) in enumerate(representation_iter()):
-            index.add_item(i, representation)
-            indexed_element_types.append(type)
+        start_time = last_report_time = time.time()
+        num_samples = 0
+        try:
+            with open(buffer_file_descriptor, 'wb') as buffer:
+                for _, raw_sample, loaded_sample, fetches in self.__model.compute_per_loaded_sample(
+                        loaded_samples, {'target_representations': self.__model.ops['target_representations']}):
+                    targets = Model.get_annotation_targets(raw_sample, loaded_sample)
+                    indexed_targets = [i for i, target in enumerate(targets) if not ignore_type_annotation(target[1])]
+                    buffer.write(np.ascontiguousarray(fetches['target_representations'][indexed_targets],
+                                                      dtype=np.float32).tobytes())
+                    indexed_element_type_ids.extend(type_to_id.setdefault(targets[i][1], len(type_to_id))
+                                                    for i in indexed_targets)
+                    num_samples += 1
+                    if time.time() - last_report_time > 10:
+                        last_report_time = time.time()
+                        elapsed = last_report_time - start_time
+                        num_computed = len(indexed_element_type_ids) - num_previously_indexed
+                        print('Processed %i samples (%i samples/second), computed %i representations (%i/second).   '
+                              % (num_samples, num_samples / elapsed, num_computed, num_computed / elapsed),
+                              flush=True, end='\r')
+            elapsed = max(time.time() - start_time, 1e-9)
+            print('\r\x1b[K', end='')
+            num_indexed = len(indexed_element_type_ids) - num_previously_indexed
+            print('Computed %i representations of %i samples in %.1fs (%i samples/second).'
+                  % (num_indexed, num_samples, elapsed, num_samples / elapsed))
+        except BaseException:
+            os.remove(buffer_path)
+            raise
+
+        if num_indexed > 0:
+            representations = np.memmap(buffer_path, dtype=np.float32, mode='r',
+                                        shape=(num_indexed, self.__type_representation_size))
+            weakref.finalize(representations, os.remove, buffer_path)
+            index.add_items(representations)
+            del representations
+        else:
+            os.remove(buffer_path)
         print('Indexing...')
-        index.build(20)
-        print('Index Created.')
-
-        with tempfile.NamedTemporaryFile() as f:
-            index.save(f.name)
-            with open(f.name, 'rb') as fout:
-                metadata['index'] = fout.read()
-        metadata['indexed_element_types'] = indexed_element_types
-
-    def annotate_single(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
-                        metadata: Dict[str, Any]):
-        _, fetches = self.__model._run_epoch_in_batches(
-            loaded_test_sample, '(test)', is_train=False, quiet=True,
-            additional_fetch_dict={'target_representations': self.__model.ops['target_representations']}
-        )
-        target_representations = fetches['target_representations']
-        if target_representations.shape[0] > 10000:
-            return
+        start_time = time.time()
+        index.build()
+        print('Index Created in %.1fs.' % (time.time() - start_time))
+
+        # The index is only written to disk when the model is saved, see get_metadata_to_save.
+        metadata.pop('index_path', None)
+        metadata['index'] = index
+        metadata['index_type'] = index_type
+        metadata['indexed_type_names'] = list(type_to_id)
+        metadata['indexed_element_type_ids'] = np.array(indexed_element_type_ids, dtype=np.int32)
+        metadata.pop('indexed_element_types', None)
+
+    @staticmethod
+    def get_metadata_to_save(path: RichPath, metadata: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Return the metadata to store in the model file at path. The index is not pickled into it, but written to a
+        file next to it (named in metadata['index_file']), which is memory-mapped when the model is used.
+        """
+        metadata = dict(metadata)
+        index = metadata.pop('index', None)
+        index_path = metadata.pop('index_path', None)  # type: Optional[RichPath]
+        if index is None and index_path is None:
+            return metadata  # Not indexed yet
+        if not isinstance(path, LocalPath):
+            # Keep models stored remotely self-contained, using the format of older models.
+            if metadata.get('index_type') == 'segmented':
+                raise ValueError('Models with segmented indices can only be saved locally.')
+            if index_path is not None:
+                index = index_path.to_local_path().read_as_binary()
+            elif isinstance(index, TypeIndex):
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    index.save(os.path.join(tmp_dir, 'index'))
+                    with open(os.path.join(tmp_dir, 'index'), 'rb') as f:
+                        index = f.read()
+            metadata['index'] = index
+            return metadata
+
+        index_file = os.path.basename(path.path) + get_type_index_class(metadata.get('index_type', 'annoy')).FILE_SUFFIX
+        target_path = os.path.join(os.path.dirname(path.path), index_file)
+        # Write to a temporary file first, so that processes mapping an older version of the index are unaffected.
+        tmp_target_path = target_path + '.tmp'
+        if index_path is not None:
+            if os.path.abspath(index_path.to_local_path().path) != os.path.abspath(target_path):
+                get_type_index_class(metadata.get('index_type', 'annoy')).copy_files(index_path.to_local_path().path,
+                                                                                     tmp_target_path)
+                os.replace(tmp_target_path, target_path)
+        elif isinstance(index, TypeIndex):
+            index.save(tmp_target_path)
+            os.replace(tmp_target_path, target_path)
+        else:  # The index bytes of a model in the format of older models
+            with open(tmp_target_path, 'wb') as f:
+                f.write(index)
+            os.replace(tmp_target_path, target_path)
+        # Files of the previous version of the index (e.g. compacted segments) are only unused once it is replaced.
+        get_type_index_class(metadata.get('index_type', 'annoy')).remove_unreferenced_files(target_path)
+        metadata['index_file'] = index_file
+        return metadata
 
-        if not isinstance(metadata['index'], annoy.AnnoyIndex):
+    @staticmethod
+    def restore_metadata(path: RichPath, metadata: Dict[str, Any]) -> None:
+        """Prepare metadata read from the model file at path for use. The index itself is only loaded on first use."""
+        if 'index_file' in metadata:
+            if not isinstance(path, LocalPath):
+                raise ValueError('The index of model %s is stored in the separate file %s, which needs to be local.'
+                                 % (path, metadata['index_file']))
+            metadata['index_path'] = RichPath.create(os.path.join(os.path.dirname(path.path), metadata['index_file']))
+        if 'indexed_element_types' in metadata:
+            metadata['indexed_type_names'], metadata['indexed_element_type_ids'] = \
+                intern_types(metadata.pop('indexed_element_types'))
+
+    def __get_index(self, metadata: Dict[str, Any]) -> TypeIndex:
+        index = metadata.get('index')
+        if isinstance(index, TypeIndex):
+            return index
+        index_type = metadata.get('index_type', 'annoy')  # Older models only had Annoy indices
+        # Only the query options apply to loaded indices, the others are ignored.
+        query_options = self.__model.hyperparameters.get('type_index_options', {})
+        if index is None:
+            # Indices are memory-mapped where possible, so that all processes using the same model share their pages.
+            loaded_index = load_type_index(index_type, metadata['index_path'].to_local_path().path,
+                                           self.__type_representation_size, **query_options)
+        else:
+            # Older models (and models stored remotely) store the index bytes in their metadata.
             with tempfile.NamedTemporaryFile() as f:
-                with open(f.name, 'wb') as fout:
-                    fout.write(metadata['index'])
-                metadata['index'] = annoy.AnnoyIndex(self.__type_representation_size, 'manhattan')
-                metadata['index'].load(f.name)
+                f.write(index)
+                f.flush()
+                loaded_index = load_type_index(index_type, f.name, self.__type_representation_size, **query_options)
+        metadata['index'] = loaded_index
+        return loaded_index
 
-        # assumes that loading happens in the same order.
-        original_annotations = []
-        for node_idx, annotation_data in raw_sample['supernodes'].items():
-            node_idx = int(node_idx)
-            if 'ignored_supernodes' in loaded_test_sample and node_idx in loaded_test_sample['ignored_supernodes']:
-                continue
+    def get_annotation_fetches(self) -> Dict[str, tf.Tensor]:
+        return {'target_representations': self.__model.ops['target_representations']}
 
-            annotation = annotation_data['annotation']
+    def annotate_from_fetches(self, raw_sample: Dict[str, Any], loaded_test_sample: Dict[str, Any], provenance: str,
+                              fetches: Dict[str, np.ndarray], metadata: Dict[str, Any]) -> Iterator['Model.Annotation']:
+        """Create the annotations of a sample from the values of get_annotation_fetches() for its targets."""
+        target_representations = fetches['target_representations']
+        if target_representations.shape[0] > 10000:
+            return
 
-            original_annotations.append((node_idx, annotation, annotation_data['name'], annotation_data['location'], annotation_data['type']))
+        # assumes that loading happens in the same order.
+        original_annotations = Model.get_annotation_targets(raw_sample, loaded_test_sample)
 
         assert len(original_annotations) == target_representations.shape[0]
 
-        # This is also classification-specific due to class_id_to_class
+        # Look up the neighbours of all targets at once, and vote for their types with a single scatter-add.
+        nn_ids, nn_distances = self.__get_index(metadata).query(target_representations, NUM_NEIGHBOURS)
+        indexed_type_names = metadata['indexed_type_names']
+        indexed_element_type_ids = metadata['indexed_element_type_ids']
+        if len(indexed_element_type_ids) > 0:
+            nn_type_ids = np.where(nn_ids >= 0, indexed_element_type_ids[np.maximum(nn_ids, 0)], -1)
+        else:
+            nn_type_ids = nn_ids  # All -1
+        query_idxs, type_ids, probabilities = vote_for_types(nn_type_ids, nn_distances)
+        log_probabilities = np.log(probabilities).tolist()
+        query_starts = np.searchsorted(query_idxs, np.arange(len(original_annotations) + 1)).tolist()
+        type_ids = type_ids.tolist()
+
         for i, (node_idx, node_type, var_name, annotation_location, annotation_type) in enumerate(original_annotations):
-            representation = target_representations[i]
-            nn_idx, distance =  metadata['index'].get_nns_by_vector(representation, n=10, include_distances=True)
-            distances = 1 / (np.array(distance) + 1e-10) ** 2
-            distances /= np.sum(distances)
-            rel_types = defaultdict(int)
-            for n, p in zip(nn_idx, distances):
-                rel_types[metadata['indexed_element_types'][n]] += p
             annotation = self.__model.Annotation(
                 provenance=provenance,
                 node_id=node_idx,
                 name=var_name,
                 original_annotation=node_type,
                 annotation_type=annotation_type,
-                predicted_annotation_logprob_dist={t: np.log(v) for t, v in rel_types.items()},
+                predicted_annotation_logprob_dist={
+                    indexed_type_names[type_ids[j]]: log_probabilities[j]
+                    for j in range(query_starts[i], query_starts[i + 1])
+                },
                 location=annotation_location
             )
             yield annotation
@@ -1,6 +1,14 @@
+import bisect
 import multiprocessing
-from typing import List, Iterable, Callable, TypeVar
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, List, Iterable, Iterator, Callable, Optional, TypeVar, Tuple
 
+import numpy as np
 from dpu_utils.utils import RichPath
 
 JobType = TypeVar("JobType")
@@ -76,26 +84,145 @@ def partition_files_by_size(file_paths: List[RichPath], bytes_per_part: int) ->
     return result
 
 
-def run_jobs_in_parallel(all_jobs: List[JobType],
+def pack_into_bins(sizes: List[int], capacity: int) -> Tuple[List[List[int]], List[int]]:
+    """
+    Packs items into as few bins of the given capacity as possible, using the best-fit decreasing heuristic: items
+    are placed (in order of decreasing size) into the fullest bin that still has room for them.
+    Items with a size larger than the capacity get a bin of their own.
+    :param sizes: Sizes of the items to pack. Ties are broken by position, so shuffle items to randomise bins.
+    :return: Pair of the bins (lists of item indices) and the total size of each bin.
+    """
+    bins = []  # type: List[List[int]]
+    bin_sizes = []  # type: List[int]
+    # Bins with room left, as sorted list of (remaining capacity, bin index):
+    open_bins = []  # type: List[Tuple[int, int]]
+    for item_idx in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        size = sizes[item_idx]
+        open_bin_pos = bisect.bisect_left(open_bins, (size, -1))
+        if open_bin_pos < len(open_bins):
+            remaining, bin_idx = open_bins.pop(open_bin_pos)
+        else:
+            remaining, bin_idx = capacity, len(bins)
+            bins.append([])
+            bin_sizes.append(0)
+        bins[bin_idx].append(item_idx)
+        bin_sizes[bin_idx] += size
+        if remaining - size > 0:
+            bisect.insort(open_bins, (remaining - size, bin_idx))
+    return bins, bin_sizes
+
+
+NUM_WORKERS_ENV_VARIABLE = 'TYPILUS_NUM_WORKERS'
+
+
+def get_num_parallel_workers(num_workers: Optional[int] = None) -> int:
+    """
+    Number of worker processes to use: num_workers if set, otherwise the value of the TYPILUS_NUM_WORKERS environment
+    variable if set, otherwise one less than the number of CPUs this process may run on.
+    """
+    if num_workers is None and os.environ.get(NUM_WORKERS_ENV_VARIABLE):
+        num_workers = int(os.environ[NUM_WORKERS_ENV_VARIABLE])
+    if num_workers is None:
+        try:
+            num_cpus = len(os.sched_getaffinity(0))
+        except AttributeError:  # Not available on all platforms
+            num_cpus = multiprocessing.cpu_count()
+        num_workers = num_cpus - 1
+    return max(1, num_workers)
+
+
+class ParallelJobError(Exception):
+    """Raised by run_jobs_in_parallel when a job failed in a worker process."""
+    def __init__(self, job_id: Optional[int], worker_traceback: str):
+        super().__init__('Job %s failed in a worker process:\n%s'
+                         % (job_id if job_id is not None else '(unknown)', worker_traceback))
+        self.job_id = job_id
+        self.worker_traceback = worker_traceback
+
+
+class _SharedArray:
+    """Stand-in for a numpy array that was moved into a shared memory block by a worker process."""
+    def __init__(self, shm_name: str, shape: Tuple[int, ...], dtype: str):
+        self.shm_name = shm_name
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _move_arrays_to_shared_memory(value: Any, min_num_bytes: int) -> Any:
+    if isinstance(value, np.ndarray):
+        if value.nbytes < min_num_bytes or value.dtype.hasobject:
+            return value
+        shm = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        shared_value = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+        shared_value[...] = value
+        del shared_value
+        shm.close()
+        return _SharedArray(shm.name, value.shape, value.dtype.str)
+    elif isinstance(value, dict):
+        return {k: _move_arrays_to_shared_memory(v, min_num_bytes) for k, v in value.items()}
+    elif type(value) in (list, tuple):
+        return type(value)(_move_arrays_to_shared_memory(v, min_num_bytes) for v in value)
+    return value
+
+
+def _restore_arrays_from_shared_memory(value: Any) -> Any:
+    if isinstance(value, _SharedArray):
+        shm = shared_memory.SharedMemory(name=value.shm_name)
+        try:
+            shared_value = np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+            result = shared_value.copy()
+            del shared_value
+        finally:
+            shm.close()
+            shm.unlink()
+        return result
+    elif isinstance(value, dict):
+        return {k: _restore_arrays_from_shared_memory(v) for k, v in value.items()}
+    elif type(value) in (list, tuple):
+        return type(value)(_restore_arrays_from_shared_memory(v) for v in value)
+    return value
+
+
+# Messages from workers in run_jobs_in_parallel:
+_RESULT, _JOB_FAILED, _WORKER_DONE = range(3)
+
+
+def run_jobs_in_parallel(all_jobs: Iterable[JobType],
                          worker_fn: Callable[[int, JobType], Iterable[ResultType]],
                          received_result_callback: Callable[[ResultType], None],
                          finished_callback: Callable[[], None],
-                         result_queue_size: int = 100) -> None:
+                         result_queue_size: int = 100,
+                         num_workers: Optional[int] = None,
+                         max_num_queued_jobs: Optional[int] = None,
+                         shared_memory_min_bytes: Optional[int] = None) -> None:
     """
     Runs jobs in parallel and uses callbacks to collect results.
-    :param all_jobs: Job descriptions; one at a time will be parsed into worker_fn.
+    :param all_jobs: Job descriptions; one at a time will be parsed into worker_fn. These are consumed lazily, as
+      workers become free.
     :param worker_fn: Worker function receiving a job; many copies may run in parallel.
       Can yield results, which will be processed (one at a time) by received_result_callback.
     :param received_result_callback: Called when a result was produced by any worker. Only one will run at a time.
     :param finished_callback: Called when all jobs have been processed.
+    :param num_workers: Number of worker processes; see get_num_parallel_workers for the default.
+    :param max_num_queued_jobs: Maximal number of jobs waiting for a worker. Defaults to twice the number of workers.
+    :param shared_memory_min_bytes: If set, numpy arrays of at least this size in results (possibly nested in dicts,
+      lists and tuples) are passed back in shared memory instead of being pickled through the result queue.
+    :raises ParallelJobError: If a job raised an exception (or a worker process died). The remaining workers are
+      stopped, and neither further results nor finished_callback are received.
     """
-    job_queue = multiprocessing.Queue(len(all_jobs) + 1)
-    for job in all_jobs:
-        job_queue.put(job)
-    job_queue.put(None)  # Marker that we are done
+    num_workers = get_num_parallel_workers(num_workers)
+    if max_num_queued_jobs is None:
+        max_num_queued_jobs = 2 * num_workers
+    if shared_memory_min_bytes is not None:
+        # Workers need to share the resource tracker of this process, which otherwise unlinks their shared memory
+        # blocks when they exit:
+        resource_tracker.ensure_running()
 
+    job_queue = multiprocessing.Queue(max_num_queued_jobs)
     # This will hold the actual results:
     result_queue = multiprocessing.Queue(result_queue_size)
+    stop_feeding = threading.Event()
+    feeding_errors = []  # type: List[BaseException]
 
     def __parallel_queue_worker(worker_id: int,
                                 job_queue: multiprocessing.Queue,
@@ -104,33 +231,201 @@ def run_jobs_in_parallel(all_jobs: List[JobType],
         while True:
             job = job_queue.get()
 
-            # "None" is the signal for last job, put that back in for other workers and stop:
+            # "None" is the signal that there are no more jobs:
             if job is None:
-                job_queue.put(job)
                 break
 
-            for result in worker_fn(worker_id, job):
-                result_queue.put(result)
-        result_queue.put(None)
+            job_id, job = job
+            try:
+                for result in worker_fn(worker_id, job):
+                    if shared_memory_min_bytes is not None:
+                        result = _move_arrays_to_shared_memory(result, shared_memory_min_bytes)
+                    result_queue.put((_RESULT, result))
+            except BaseException:
+                result_queue.put((_JOB_FAILED, (job_id, traceback.format_exc())))
+                break
+        result_queue.put((_WORKER_DONE, worker_id))
+
+    def feed_jobs() -> None:
+        def put_job(job) -> bool:
+            while not stop_feeding.is_set():
+                try:
+                    job_queue.put(job, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for job_id, job in enumerate(all_jobs):
+                if not put_job((job_id, job)):
+                    return
+        except BaseException as e:
+            feeding_errors.append(e)  # Re-raised on the main thread
+            return
+        for _ in range(num_workers):
+            put_job(None)  # Marker that we are done
 
     # Create workers:
-    num_workers = multiprocessing.cpu_count() - 1
     workers = [multiprocessing.Process(target=__parallel_queue_worker,
                                        args=(worker_id, job_queue, result_queue, worker_fn))
                for worker_id in range(num_workers)]
     for worker in workers:
         worker.start()
+    feeder = threading.Thread(target=feed_jobs, daemon=True)
+    feeder.start()
+
+    all_jobs_done = False
+    try:
+        num_workers_finished = 0
+        while num_workers_finished < len(workers):
+            try:
+                message_type, payload = result_queue.get(timeout=1)
+            except queue.Empty:
+                if len(feeding_errors) > 0:
+                    raise feeding_errors[0]
+                # Workers killed from the outside (e.g., by the OOM killer) cannot report that:
+                for worker in workers:
+                    if worker.exitcode is not None and worker.exitcode != 0:
+                        raise ParallelJobError(None, 'Worker process %s exited with code %s.'
+                                               % (worker.pid, worker.exitcode))
+                continue
+            if message_type == _WORKER_DONE:
+                num_workers_finished += 1
+            elif message_type == _JOB_FAILED:
+                raise ParallelJobError(*payload)
+            else:
+                if shared_memory_min_bytes is not None:
+                    payload = _restore_arrays_from_shared_memory(payload)
+                received_result_callback(payload)
+        all_jobs_done = True
+    finally:
+        stop_feeding.set()
+        feeder.join()
+        if not all_jobs_done:
+            for worker in workers:
+                worker.terminate()
+            job_queue.cancel_join_thread()
+        for worker in workers:
+            worker.join()
+        if not all_jobs_done and shared_memory_min_bytes is not None:
+            # Free the shared memory of results that were not received:
+            while True:
+                try:
+                    message_type, payload = result_queue.get(timeout=0.1)
+                except (queue.Empty, OSError, EOFError):
+                    break
+                if message_type == _RESULT:
+                    _restore_arrays_from_shared_memory(payload)
+    finished_callback()
+
+
+class _ConsumerStopped(Exception):
+    pass
+
+
+def iterate_jobs_in_parallel(all_jobs: Iterable[JobType],
+                             worker_fn: Callable[[int, JobType], Iterable[ResultType]],
+                             max_num_pending_results: int = 100,
+                             **options: Any) -> Iterator[ResultType]:
+    """
+    Like run_jobs_in_parallel (to which options are passed), but returns an iterator over the results, in the order
+    in which they are received. The workers are stopped if the iterator is closed early.
+    :param max_num_pending_results: Maximal number of received results waiting for the consumer.
+    """
+    pending_results = queue.Queue(max_num_pending_results)
+    stop_receiving = threading.Event()
+    all_results_received = object()
+    errors = []  # type: List[BaseException]
+
+    def put_pending(item) -> None:
+        while not stop_receiving.is_set():
+            try:
+                pending_results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise _ConsumerStopped()  # Stops run_jobs_in_parallel, which terminates its workers
 
-    num_workers_finished = 0
-    while True:
-        result = result_queue.get()
-        if result is None:
-            num_workers_finished += 1
-            if num_workers_finished == len(workers):
-                finished_callback()
+    def run() -> None:
+        try:
+            run_jobs_in_parallel(all_jobs, worker_fn, put_pending, lambda: None, **options)
+            put_pending(all_results_received)
+        except _ConsumerStopped:
+            pass
+        except BaseException as e:
+            errors.append(e)  # Re-raised on the consumer's thread
+            try:
+                put_pending(all_results_received)
+            except _ConsumerStopped:
+                pass
+
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    try:
+        while True:
+            result = pending_results.get()
+            if result is all_results_received:
                 break
-        else:
-            received_result_callback(result)
+            yield result
+        if len(errors) > 0:
+            raise errors[0]
+    finally:
+        stop_receiving.set()
+        runner.join()
 
-    for worker in workers:
-        worker.join()
+
+def map_in_background(inputs: Iterable[JobType],
+                      worker_fn: Callable[[JobType], ResultType],
+                      num_workers: int,
+                      max_num_prefetched: int) -> Iterator[ResultType]:
+    """
+    Lazily maps worker_fn over inputs in background threads, keeping results ready ahead of the consumer.
+    :param inputs: Inputs to process. These are consumed in a separate background thread.
+    :param worker_fn: Function to apply to each input; num_workers copies may run in parallel.
+    :param num_workers: Number of threads running worker_fn.
+    :param max_num_prefetched: Maximal number of results computed ahead of the consumer. If 0, everything is
+      computed on the calling thread instead.
+    :return: Iterator over the results, in the order of inputs.
+    """
+    if max_num_prefetched <= 0:
+        yield from map(worker_fn, inputs)
+        return
+
+    pending_results = queue.Queue(max_num_prefetched)
+    stop_feeding = threading.Event()
+
+    def put_pending(item) -> bool:
+        while not stop_feeding.is_set():
+            try:
+                pending_results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        def feed() -> None:
+            try:
+                for job in inputs:
+                    if not put_pending(executor.submit(worker_fn, job)):
+                        return
+            except BaseException as e:
+                # Forward errors from the input iterator to the consumer:
+                failed = Future()
+                failed.set_exception(e)
+                put_pending(failed)
+                return
+            put_pending(None)  # Marker that we are done
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                result = pending_results.get()
+                if result is None:
+                    break
+                yield result.result()
+        finally:
+            stop_feeding.set()
+            feeder.join()
@@ -16,6 +16,7 @@ from docopt import docopt
 from dpu_utils.utils import RichPath, run_and_debug
 
 from typilus.model import model_restore_helper
+from data_preparation.scripts.graph_generator.compactgraphs import FILE_SUFFIX as COMPACT_GRAPHS_FILE_SUFFIX
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
@@ -31,7 +32,7 @@ def run_export(model_path: RichPath, test_data_path: RichPath, output_folder: st
         "dropout_keep_rate": 1.0,
     }
 
-    data_chunks = test_data_path.get_filtered_files_in_dir('*gz')
+    data_chunks = test_data_path.get_filtered_files_in_dir('*gz') + test_data_path.get_filtered_files_in_dir('*' + COMPACT_GRAPHS_FILE_SUFFIX)
 
     # Restore model
     model = model_restore_helper.restore(
@@ -6,34 +6,46 @@ Usage:
 Options:
     -h --help                  Show this screen.
     --azure-info=<path>        Azure authentication information file (JSON). Used to load data from Azure storage.
+    --index-type=<type>        Type of the type map index: annoy, exact or ivfpq. [default: annoy]
+    --index-options=<json>     Options of the index (JSON), e.g. '{"num_lists": 4096, "num_probes": 32}' for ivfpq.
+    --append                   Add DATA_PATH to the existing index of the model, instead of replacing it. The existing
+                               index is kept as is, and the new data is stored in additional segments.
+    --num-workers NUM          Number of worker processes loading the data. Defaults to $TYPILUS_NUM_WORKERS, or one
+                               less than the number of available CPUs.
     --debug                    Enable debug routines. [default: False]
 """
 
+import json
 import os
 import sys
+from typing import Any, Dict, Optional
 
 from docopt import docopt
 from dpu_utils.utils import RichPath, run_and_debug
 
 from typilus.model import model_restore_helper
+from data_preparation.scripts.graph_generator.compactgraphs import FILE_SUFFIX as COMPACT_GRAPHS_FILE_SUFFIX
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
 
-def run_indexing(model_path: RichPath, index_data_path: RichPath):
+def run_indexing(model_path: RichPath, index_data_path: RichPath, index_type: str, index_options: Dict[str, Any],
+                 append: bool = False, num_workers: Optional[int] = None):
     test_hyper_overrides = {
         'run_id': 'indexing',
         "dropout_keep_rate": 1.0,
+        'type_index': index_type,
+        'type_index_options': index_options,
     }
 
-    data_chunks = index_data_path.get_filtered_files_in_dir('*.jsonl.gz')
+    data_chunks = index_data_path.get_filtered_files_in_dir('*.jsonl.gz') + index_data_path.get_filtered_files_in_dir('*' + COMPACT_GRAPHS_FILE_SUFFIX)
 
     # Restore model
     print("Restoring model...")
     model = model_restore_helper.restore(
         model_path, is_train=False, hyper_overrides=test_hyper_overrides)
 
-    model.create_index(data_chunks)
+    model.create_index(data_chunks, append=append, num_workers=num_workers)
 
     print("Saving model...")
     model.save(model_path)
@@ -43,7 +55,10 @@ def run(arguments):
     azure_info_path = arguments.get('--azure-info', None)
     data_folder = RichPath.create(arguments['DATA_PATH'], azure_info_path)
     model_path = RichPath.create(arguments['MODEL_PATH'])
-    run_indexing(model_path, data_folder)
+    index_options = json.loads(arguments['--index-options']) if arguments.get('--index-options') else {}
+    num_workers = int(arguments['--num-workers']) if arguments.get('--num-workers') else None
+    run_indexing(model_path, data_folder, arguments['--index-type'], index_options, arguments.get('--append', False),
+                 num_workers)
 
 
 if __name__ == '__main__':
@@ -6,17 +6,23 @@ Usage:
 Options:
     -h --help                  Show this screen.
     --azure-info=<path>        Azure authentication information file (JSON). Used to load data from Azure storage.
+    --cache-dir=<path>         Cache the model outputs for each graph in this directory, and reuse them when predicting
+                               on the same graphs again with the same model.
+    --cache-size-mb=<int>      Maximum size of the cache; the least recently used entries are evicted. [default: 1024]
     --debug                    Enable debug routines. [default: False]
 """
 import os
 import sys
 import time
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from docopt import docopt
 from dpu_utils.utils import RichPath, run_and_debug
 
 from typilus.model import model_restore_helper
+from typilus.model.model import Model
+from data_preparation.scripts.graph_generator.compactgraphs import FILE_SUFFIX as COMPACT_GRAPHS_FILE_SUFFIX
+from typilus.model.fetchcache import FetchCache
 from typilus.model.utils import ignore_type_annotation
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
@@ -28,7 +34,32 @@ def ignore_annotation(annotation_str: Optional[str]) -> bool:
     return ignore_type_annotation(annotation_str)
 
 
-def run_predict(model_path: RichPath, test_data_path: RichPath, output_file: RichPath):
+def annotation_to_dict(annotation: Model.Annotation, num_predictions: int=10) -> Dict[str, Any]:
+    """Convert an annotation into its output record, keeping only its num_predictions most likely types."""
+    ordered_annotation_predictions = sorted(annotation.predicted_annotation_logprob_dist,
+                            key=lambda x: -annotation.predicted_annotation_logprob_dist[x])[:num_predictions]
+
+    annotation_dict = annotation._asdict()
+    logprobs = annotation_dict['predicted_annotation_logprob_dist']
+    filtered_logprobs = []
+    for annot in ordered_annotation_predictions:
+        logprob = float(logprobs[annot])
+        if annot == '%UNK%' or annot == '%UNKNOWN%':
+            annot = 'typing.Any'
+        filtered_logprobs.append((annot, logprob))
+    annotation_dict['predicted_annotation_logprob_dist'] = filtered_logprobs
+    return annotation_dict
+
+
+def annotation_to_record(annotation: Model.Annotation) -> Optional[Dict[str, Any]]:
+    """The output record of annotation, or None if it should not be reported (its original annotation is ignored)."""
+    if ignore_annotation(annotation.original_annotation):
+        return None
+    return annotation_to_dict(annotation)
+
+
+def run_predict(model_path: RichPath, test_data_path: RichPath, output_file: RichPath,
+                fetch_cache: Optional[FetchCache]=None):
     test_run_id = "_".join(
         [time.strftime("%Y-%m-%d-%H-%M-%S"), str(os.getpid())])
 
@@ -37,32 +68,22 @@ def run_predict(model_path: RichPath, test_data_path: RichPath, output_file: Ric
         "dropout_keep_rate": 1.0,
     }
 
-    test_data_chunks = test_data_path.get_filtered_files_in_dir('*.jsonl.gz')
+    test_data_chunks = test_data_path.get_filtered_files_in_dir('*.jsonl.gz') + test_data_path.get_filtered_files_in_dir('*' + COMPACT_GRAPHS_FILE_SUFFIX)
 
     # Restore model
     model = model_restore_helper.restore(model_path, is_train=False, hyper_overrides=test_hyper_overrides)
+    model.set_fetch_cache(fetch_cache)
 
     def predictions():
         for annotation in model.annotate(test_data_chunks):
-            if ignore_annotation(annotation.original_annotation):
-                continue
-            ordered_annotation_predictions = sorted(annotation.predicted_annotation_logprob_dist,
-                                    key=lambda x: -annotation.predicted_annotation_logprob_dist[x])[:10]
-
-            annotation_dict = annotation._asdict()
-            logprobs = annotation_dict['predicted_annotation_logprob_dist']
-            filtered_logprobs = []
-            for annot in ordered_annotation_predictions:
-                logprob = float(logprobs[annot])
-                if annot == '%UNK%' or annot == '%UNKNOWN%':
-                    annot = 'typing.Any'
-                filtered_logprobs.append((annot, logprob))
-            annotation_dict['predicted_annotation_logprob_dist'] = filtered_logprobs
-
-            yield annotation_dict
+            record = annotation_to_record(annotation)
+            if record is not None:
+                yield record
 
 
     output_file.save_as_compressed_file(predictions())
+    if fetch_cache is not None:
+        print('Cache hits: %i, misses: %i.' % (fetch_cache.num_hits, fetch_cache.num_misses))
 
 
 def run(arguments):
@@ -70,7 +91,10 @@ def run(arguments):
     test_folder = RichPath.create(arguments['TEST_DATA_PATH'], azure_info_path)
     model_path = RichPath.create(arguments['MODEL_PATH'])
     output_file = RichPath.create(arguments['OUTPUT_JSON_PATH'])
-    run_predict(model_path, test_folder, output_file)
+    fetch_cache = None
+    if arguments.get('--cache-dir') is not None:
+        fetch_cache = FetchCache(arguments['--cache-dir'], int(arguments['--cache-size-mb']) * 1024 * 1024)
+    run_predict(model_path, test_folder, output_file, fetch_cache)
 
 if __name__ == '__main__':
     args = docopt(__doc__)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Usage:
+    benchmarkindex.py [options] INPUT_VECTORS
+
+Compare the type map indices on the representations in INPUT_VECTORS (the vectors.tsv written by exportreps.py).
+A random sample of the vectors is held out as queries; all others are indexed. For each index type, report the
+build time, size on disk, queries per second and recall@k against the exact nearest neighbours.
+
+Options:
+    -h --help                  Show this screen.
+    --index-types=<types>      Comma-separated index types to benchmark. [default: annoy,ivfpq]
+    --index-options=<json>     Options per index type (JSON), e.g. '{"ivfpq": {"num_probes": 32}}'. [default: {}]
+    --num-queries=<int>        Number of vectors to hold out as queries. [default: 1000]
+    --k=<int>                  Number of nearest neighbours to retrieve. [default: 10]
+    --seed=<int>               Random seed for the choice of queries. [default: 0]
+    --debug                    Enable debug routines. [default: False]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from docopt import docopt
+from dpu_utils.utils import run_and_debug
+
+from typilus.model.typeindex import create_type_index
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def run_benchmark(input_vectors_path: str, index_types, index_options, num_queries: int, k: int, seed: int):
+    vectors = np.loadtxt(input_vectors_path, delimiter='\t', dtype=np.float32, ndmin=2)
+    rng = np.random.RandomState(seed)
+    permutation = rng.permutation(len(vectors))
+    queries, indexed_vectors = vectors[permutation[:num_queries]], vectors[permutation[num_queries:]]
+    print('Indexing %s vectors of dimension %s, querying %s.' % (len(indexed_vectors), vectors.shape[1], len(queries)))
+
+    exact_index = create_type_index('exact', vectors.shape[1])
+    exact_index.add_items(indexed_vectors)
+    exact_index.build()
+    start = time.time()
+    exact_ids, _ = exact_index.query(queries, k)
+    exact_qps = len(queries) / max(time.time() - start, 1e-9)
+
+    print('%-8s %10s %10s %12s %10s' % ('index', 'build (s)', 'size (MB)', 'queries/s', 'recall@%s' % k))
+    print('%-8s %10s %10.1f %12.1f %10.4f' % ('exact', '-', indexed_vectors.nbytes / 2 ** 20, exact_qps, 1.0))
+    for index_type in index_types:
+        index = create_type_index(index_type, vectors.shape[1], **index_options.get(index_type, {}))
+        start = time.time()
+        index.add_items(indexed_vectors)
+        index.build()
+        build_time = time.time() - start
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index.save(os.path.join(tmp_dir, 'index'))
+            size = os.path.getsize(os.path.join(tmp_dir, 'index'))
+
+        start = time.time()
+        ids, _ = index.query(queries, k)
+        qps = len(queries) / max(time.time() - start, 1e-9)
+
+        num_found = sum(len(np.intersect1d(found[found >= 0], expected[expected >= 0]))
+                        for found, expected in zip(ids, exact_ids))
+        recall = num_found / max(1, int(np.sum(exact_ids >= 0)))
+        print('%-8s %10.1f %10.1f %12.1f %10.4f' % (index_type, build_time, size / 2 ** 20, qps, recall))
+
+
+def run(arguments):
+    run_benchmark(arguments['INPUT_VECTORS'],
+                  index_types=arguments['--index-types'].split(','),
+                  index_options=json.loads(arguments['--index-options']),
+                  num_queries=int(arguments['--num-queries']),
+                  k=int(arguments['--k']),
+                  seed=int(arguments['--seed']))
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args.get('--debug', False))
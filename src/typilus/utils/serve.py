@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Usage:
+    serve.py [options] MODEL_PATH
+
+Serve type predictions of a trained model over HTTP on localhost. The model (and, for metric models, its type
+index) is loaded once, and concurrent requests are answered in shared minibatches.
+
+Requests are POSTed to /predict as JSON objects, with either of
+    {"graphs": [<graph>, ...]}     graphs as produced by the graph extractor (in the JSON format), or
+    {"files": [{"filename": <str>, "source": <str>}, ...]}    Python source code, extracted on the fly.
+The response is {"annotations": [<prediction record>, ...]}, with the records of predict.py, in request order.
+
+Options:
+    -h --help                  Show this screen.
+    --port=<int>               Port to listen on (on 127.0.0.1 only). [default: 8330]
+    --max-batch-wait-ms=<int>  How long to wait for more requests to batch with a received one. [default: 5]
+    --typing-rules=<path>      Typing rules used to extract graphs from source code. Defaults to the rules in
+                               data_preparation/metadata of this repository.
+    --debug                    Enable debug routines. [default: False]
+"""
+import copy
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Dict, List, Tuple
+
+from docopt import docopt
+from dpu_utils.utils import RichPath, run_and_debug
+
+from typilus.model import model_restore_helper
+from typilus.model.model import Model
+from typilus.utils.predict import annotation_to_record
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+GRAPH_EXTRACTOR_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'data_preparation', 'scripts')
+
+
+class BatchingPredictor:
+    """
+    Runs the model on a single thread, annotating the graphs of all requests that are waiting at the same time in
+    one call to Model.annotate_samples (and thus in shared minibatches).
+    """
+    def __init__(self, model: Model, max_batch_wait_time: float):
+        self.__model = model
+        self.__max_batch_wait_time = max_batch_wait_time
+        self.__requests = queue.Queue()  # type: queue.Queue
+        self.__worker = threading.Thread(target=self.__run, daemon=True)
+        self.__worker.start()
+
+    def predict(self, graphs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        result = Future()
+        self.__requests.put((graphs, result))
+        return result.result()
+
+    def __run(self) -> None:
+        while True:
+            batch = [self.__requests.get()]  # type: List[Tuple[List[Dict[str, Any]], Future]]
+            deadline = time.time() + self.__max_batch_wait_time
+            while True:
+                try:
+                    batch.append(self.__requests.get(timeout=max(0., deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            all_graphs = [graph for graphs, _ in batch for graph in graphs]
+            request_starts, num_graphs_so_far = [], 0
+            for graphs, _ in batch:
+                request_starts.append(num_graphs_so_far)
+                num_graphs_so_far += len(graphs)
+            try:
+                results = [[] for _ in batch]  # type: List[List[Dict[str, Any]]]
+                request_idx = 0
+                for sample_idx, annotation in self.__model.annotate_samples(all_graphs):
+                    while request_idx + 1 < len(batch) and request_starts[request_idx + 1] <= sample_idx:
+                        request_idx += 1
+                    record = annotation_to_record(annotation)
+                    if record is not None:
+                        results[request_idx].append(record)
+            except Exception as e:
+                for _, result in batch:
+                    result.set_exception(e)
+                continue
+            for (_, result), request_results in zip(batch, results):
+                result.set_result(request_results)
+
+
+class GraphExtractor:
+    """Extracts graphs from source code, using the graph extractor of the data preparation scripts."""
+    def __init__(self, typing_rules_path: str):
+        from data_preparation.scripts.graph_generator.graphgenerator import AstGraphGenerator
+        from data_preparation.scripts.graph_generator.type_lattice_generator import TypeLatticeGenerator
+        self.__graph_generator_class = AstGraphGenerator
+        # Parsed once. Each request is treated as a project of its own and gets a copy, so that project-specific
+        # type aliases (and the types seen) of one request do not affect others, and nothing accumulates.
+        self.__rules_type_lattice = TypeLatticeGenerator(typing_rules_path)
+
+    def extract(self, files: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Extract the graphs of the (filename, source) records in files, skipping files without any symbols."""
+        type_lattice = copy.deepcopy(self.__rules_type_lattice)
+        graphs = []
+        for f in files:
+            graph = self.__graph_generator_class(f['source'], type_lattice).build()
+            if graph is None or len(graph['supernodes']) == 0:
+                continue
+            graph['filename'] = f.get('filename', '?')
+            # Use the same (string) node keys as graphs read from the extracted data:
+            graphs.append(json.loads(json.dumps(graph)))
+        return graphs
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_request_handler(predictor: BatchingPredictor, typing_rules_path: str):
+    graph_extractor = []  # type: List[GraphExtractor]  (created on first use)
+    graph_extractor_lock = threading.Lock()
+
+    class PredictionRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if 'graphs' in request:
+                    graphs = request['graphs']
+                elif 'files' in request:
+                    with graph_extractor_lock:
+                        if len(graph_extractor) == 0:
+                            graph_extractor.append(GraphExtractor(typing_rules_path))
+                    graphs = graph_extractor[0].extract(request['files'])
+                else:
+                    raise ValueError('Request needs either "graphs" or "files".')
+            except Exception as e:
+                # Malformed requests and source code that cannot be parsed
+                self.send_error(400, explain=str(e))
+                return
+
+            try:
+                response = json.dumps({'annotations': predictor.predict(graphs)}).encode()
+            except Exception as e:
+                self.send_error(500, explain=str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    return PredictionRequestHandler
+
+
+def run(arguments):
+    test_hyper_overrides = {
+        'run_id': "_".join([time.strftime("%Y-%m-%d-%H-%M-%S"), str(os.getpid())]),
+        "dropout_keep_rate": 1.0,
+    }
+    model = model_restore_helper.restore(RichPath.create(arguments['MODEL_PATH']), is_train=False,
+                                         hyper_overrides=test_hyper_overrides)
+    predictor = BatchingPredictor(model, int(arguments['--max-batch-wait-ms']) / 1000)
+
+    typing_rules_path = arguments.get('--typing-rules') or \
+                        os.path.join(GRAPH_EXTRACTOR_PATH, '..', 'metadata', 'typingRules.json')
+
+    server = ThreadingHTTPServer(('127.0.0.1', int(arguments['--port'])),
+                                 make_request_handler(predictor, typing_rules_path))
+    print('Serving predictions on http://127.0.0.1:%s/predict' % arguments['--port'])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    run_and_debug(lambda: run(args), args.get('--debug', False))
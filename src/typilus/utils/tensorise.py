@@ -13,6 +13,8 @@ Options:
     --model MODELNAME          Choose model type. [default: graph2annotation]
     --metadata-to-use PATH     Select metadata to use.
     --for-test                 Flag indicating if the data should be tensorised as test data. [default: False]
+    --num-workers NUM          Number of worker processes. Defaults to $TYPILUS_NUM_WORKERS, or one less than the
+                               number of available CPUs.
     --debug                    Enable debug routines. [default: False]
     --azure-info=<path>        Azure authentication information file (JSON). Used to load data from Azure storage.
 """
@@ -53,12 +55,13 @@ def run(arguments):
         hyperparameters.update(json.loads(hypers_override))
 
     model = model_class(hyperparameters, run_name=arguments.get('--run-name'))  # pytype: disable=not-instantiable
+    num_workers = int(arguments['--num-workers']) if arguments.get('--num-workers') else None
 
     metadata_to_use = arguments.get('--metadata-to-use', None)
     if metadata_to_use is None:
         train_folder = input_folders[0]
         model.load_metadata(train_folder, max_num_files=int(
-            arguments['--max-num-files']))
+            arguments['--max-num-files']), num_workers=num_workers)
     else:
         metadata_path = RichPath.create(metadata_to_use, azure_info_path)
         model.load_existing_metadata(metadata_path)
@@ -72,7 +75,8 @@ def run(arguments):
         model.tensorise_data_in_dir(input_folder,
                                     this_output_folder,
                                     for_test=for_test,
-                                    max_num_files=int(arguments['--max-num-files']))
+                                    max_num_files=int(arguments['--max-num-files']),
+                                    num_workers=num_workers)
 
 
 if __name__ == '__main__':
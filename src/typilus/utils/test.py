@@ -21,6 +21,7 @@ from docopt import docopt
 from dpu_utils.utils import RichPath, run_and_debug
 
 from typilus.model import model_restore_helper
+from data_preparation.scripts.graph_generator.compactgraphs import FILE_SUFFIX as COMPACT_GRAPHS_FILE_SUFFIX
 from typilus.model.typelattice import TypeLattice
 from typilus.model.utils import ignore_type_annotation
 
@@ -186,7 +187,7 @@ def run_test(model_path: RichPath, test_data_path: RichPath, type_lattice_path:
         "dropout_keep_rate": 1.0,
     }
 
-    test_data_chunks = test_data_path.get_filtered_files_in_dir('*gz')
+    test_data_chunks = test_data_path.get_filtered_files_in_dir('*gz') + test_data_path.get_filtered_files_in_dir('*' + COMPACT_GRAPHS_FILE_SUFFIX)
 
     # Restore model
     model = model_restore_helper.restore(
@@ -0,0 +1,54 @@
+import os
+from typing import Any, Dict
+
+import pytest
+
+TYPING_RULES_PATH = os.path.join(os.path.dirname(__file__), '..', 'src', 'data_preparation', 'metadata',
+                                 'typingRules.json')
+
+SAMPLE_SOURCE = '''
+from typing import Dict, List, Optional
+
+class Foo:
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def items(self, prefix: str = "x") -> List[str]:
+        result = []  # type: List[str]
+        for i in range(self.size):
+            if i % 2 == 0:
+                result.append(prefix + str(i))
+            else:
+                prefix = prefix * 2
+        return result
+
+class Bar(Foo):
+    def lookup(self, table: Dict[str, int], key: Optional[str]) -> int:
+        while key is not None and key not in table:
+            key = key[:-1] or None
+        total = 0
+        with open(key) as f:
+            for line in f:
+                total += len(line)
+        try:
+            total += table[key]
+        except KeyError as e:
+            total = -1
+        return total
+
+def compute(x: float, y=2.5):
+    z = lambda a: a * x
+    values = [z(v) for v in range(10) if v > y]
+    return sum(values), 1.0e3, "literal"
+'''
+
+
+@pytest.fixture
+def extract_graph():
+    """Extract the code graph of a source string, as done by extract_graphs.py."""
+    from data_preparation.scripts.graph_generator.graphgenerator import AstGraphGenerator
+    from data_preparation.scripts.graph_generator.type_lattice_generator import TypeLatticeGenerator
+
+    def extract(source: str = SAMPLE_SOURCE) -> Dict[str, Any]:
+        return AstGraphGenerator(source, TypeLatticeGenerator(TYPING_RULES_PATH)).build()
+    return extract
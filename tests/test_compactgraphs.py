@@ -0,0 +1,67 @@
+import json
+import os
+
+import numpy as np
+
+from data_preparation.scripts.graph_generator.compactgraphs import CompactGraphChunkWriter, FILE_SUFFIX, \
+    get_adjacency_dict, load_compact_graph_chunk, save_compact_graph_chunk
+
+
+def _assert_same_graph(graph, compact_graph):
+    """Check that a graph read from a compact chunk matches the graph as it would be stored in a JSON chunk."""
+    json_graph = json.loads(json.dumps(graph))
+    assert compact_graph['nodes'] == json_graph['nodes']
+    assert compact_graph['token-sequence'] == json_graph['token-sequence']
+    assert compact_graph['supernodes'] == json_graph['supernodes']
+    assert compact_graph.get('filename') == json_graph.get('filename')
+    assert set(compact_graph['edges']) >= set(json_graph['edges'])
+    for edge_type, edges in compact_graph['edges'].items():
+        assert isinstance(edges, np.ndarray) and edges.dtype == np.int32 and edges.shape[1:] == (2,)
+        assert get_adjacency_dict(edges) == json_graph['edges'].get(edge_type, {})
+
+
+def test_round_trip_of_extracted_graphs(tmp_path, extract_graph):
+    graphs = [extract_graph(), extract_graph('def f(a: int) -> int:\n    return a\n')]
+    graphs[0]['filename'] = 'repo/foo.py'
+    path = str(tmp_path / ('chunk' + FILE_SUFFIX))
+    save_compact_graph_chunk(graphs, path)
+
+    loaded_graphs = list(load_compact_graph_chunk(path))
+    assert len(loaded_graphs) == len(graphs)
+    for graph, loaded_graph in zip(graphs, loaded_graphs):
+        _assert_same_graph(graph, loaded_graph)
+
+
+def test_round_trip_of_loaded_graphs(tmp_path, extract_graph):
+    graph = extract_graph()
+    save_compact_graph_chunk([graph], str(tmp_path / 'first.npz'))
+    loaded_graph = next(load_compact_graph_chunk(str(tmp_path / 'first.npz')))
+    save_compact_graph_chunk([loaded_graph], str(tmp_path / 'second.npz'))
+    _assert_same_graph(graph, next(load_compact_graph_chunk(str(tmp_path / 'second.npz'))))
+
+
+def test_graphs_with_different_edge_types_and_missing_strings(tmp_path):
+    graphs = [
+        {'nodes': ['a', 'b', 'é\udcff'], 'edges': {'CHILD': {'0': [1, 2]}}, 'token-sequence': [1, 2],
+         'supernodes': {'1': {'name': 'b', 'annotation': None, 'location': [3, 4], 'type': 'variable'}}},
+        {'nodes': ['c'], 'edges': {'NEXT': {}}, 'token-sequence': [], 'supernodes': {}},
+        {'nodes': [], 'edges': {}, 'token-sequence': [], 'supernodes': {}},
+    ]
+    path = str(tmp_path / ('chunk' + FILE_SUFFIX))
+    save_compact_graph_chunk(graphs, path)
+    loaded_graphs = list(load_compact_graph_chunk(path))
+    for graph, loaded_graph in zip(graphs, loaded_graphs):
+        _assert_same_graph(graph, loaded_graph)
+    assert loaded_graphs[1]['edges']['CHILD'].shape == (0, 2)
+
+
+def test_chunk_writer_splits_chunks(tmp_path):
+    graphs = [{'nodes': [str(i)], 'edges': {}, 'token-sequence': [0], 'supernodes': {}} for i in range(5)]
+    with CompactGraphChunkWriter(out_folder=str(tmp_path), file_prefix='graphs', max_chunk_size=2) as writer:
+        for graph in graphs:
+            writer.add(graph)
+
+    chunk_files = sorted(os.listdir(str(tmp_path)))
+    assert chunk_files == ['graphs%03d%s' % (i, FILE_SUFFIX) for i in range(3)]
+    loaded_graphs = [g for f in chunk_files for g in load_compact_graph_chunk(str(tmp_path / f))]
+    assert [g['nodes'] for g in loaded_graphs] == [g['nodes'] for g in graphs]
@@ -0,0 +1,103 @@
+import random
+from collections import Counter
+
+import pytest
+
+from typilus.model.countsketch import SpaceSavingCounter, fold_sketches, make_counter, merge_counters, \
+    most_common_counter, sketch_accuracy
+
+
+def _zipf_stream(num_keys, length, seed):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(num_keys)]
+    return ['key%i' % k for k in rng.choices(range(num_keys), weights=weights, k=length)]
+
+
+def _assert_within_error_bound(sketch, exact_counter):
+    assert sketch.total == sum(exact_counter.values())
+    assert len(sketch) < 2 * sketch.capacity
+    for key, count in exact_counter.items():
+        if key in sketch:
+            assert count <= sketch[key] <= count + sketch.error_bound
+        else:
+            # Untracked keys occurred at most error_bound times.
+            assert sketch[key] == 0 and count <= sketch.error_bound
+
+
+@pytest.mark.parametrize('capacity', [1, 10, 100])
+def test_space_saving_error_bound(capacity):
+    keys = _zipf_stream(num_keys=2000, length=20000, seed=capacity)
+    sketch = SpaceSavingCounter(capacity)
+    sketch.update(keys)
+    exact_counter = Counter(keys)
+
+    _assert_within_error_bound(sketch, exact_counter)
+    assert sketch.error_bound <= sketch.total / capacity
+    # All keys occurring more often than the error bound are retained, so the most common keys are found.
+    top_keys = set(key for key, _ in sketch.most_common(capacity))
+    for key, count in exact_counter.most_common(capacity):
+        if count > 2 * sketch.error_bound:
+            assert key in top_keys
+
+
+def test_sketch_is_exact_below_capacity():
+    keys = _zipf_stream(num_keys=50, length=1000, seed=0)
+    sketch = SpaceSavingCounter(100)
+    sketch.update(Counter(keys[:500]))  # From a mapping
+    sketch.update(keys[500:])
+    assert sketch.error_bound == 0
+    assert dict(sketch.most_common()) == Counter(keys)
+    assert sketch.most_common(3) == Counter(keys).most_common(3)
+    assert sketch_accuracy(sketch, Counter(keys), 10)['recall'] == 1.0
+
+
+@pytest.mark.parametrize('num_parts', [2, 5])
+def test_merged_sketches_are_within_error_bound(num_parts):
+    keys = _zipf_stream(num_keys=3000, length=30000, seed=num_parts)
+    parts = [keys[i::num_parts] for i in range(num_parts)]
+    sketches = []
+    for part in parts:
+        sketch = SpaceSavingCounter(50)
+        sketch.update(part)
+        _assert_within_error_bound(sketch, Counter(part))
+        sketches.append(sketch)
+
+    merged = merge_counters(sketches)
+    _assert_within_error_bound(merged, Counter(keys))
+    assert merged.error_bound <= sum(s.error_bound for s in sketches) + merged.total / merged.capacity
+    assert sketch_accuracy(merged, Counter(keys), 10)['recall'] >= 0.9
+
+
+def test_merging_exact_counters():
+    parts = [_zipf_stream(num_keys=100, length=500, seed=i) for i in range(3)]
+    counters = []
+    for part in parts:
+        counter = make_counter({})
+        counter.update(part)
+        counters.append(counter)
+    merged = merge_counters(counters)
+    assert isinstance(merged, Counter) and merged == Counter(k for part in parts for k in part)
+    assert most_common_counter(merged, 5) is merged
+    assert merge_counters([]) == Counter()
+
+
+def test_fold_sketches():
+    parts = [_zipf_stream(num_keys=500, length=2000, seed=i) for i in range(4)]
+    raw_metadata_list = []
+    for part in parts:
+        raw_metadata = {'counts': make_counter({'metadata_sketch_size': 20}), 'num_files': 1}
+        raw_metadata['counts'].update(part)
+        if len(raw_metadata_list) > 0:
+            fold_sketches(raw_metadata_list[0], raw_metadata)
+            assert len(raw_metadata['counts']) == 0 and raw_metadata['num_files'] == 1
+        raw_metadata_list.append(raw_metadata)
+
+    merged = merge_counters(raw_metadata['counts'] for raw_metadata in raw_metadata_list)
+    _assert_within_error_bound(merged, Counter(k for part in parts for k in part))
+    most_common = most_common_counter(merged, 10)
+    assert isinstance(most_common, Counter) and len(most_common) == 10
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        SpaceSavingCounter(0)
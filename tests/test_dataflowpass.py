@@ -0,0 +1,80 @@
+import random
+from collections import defaultdict
+
+import pytest
+
+from data_preparation.scripts.graph_generator.dataflowpass import LastUses
+
+
+def _merge_dicts_of_sets(uses1, uses2):
+    """How DataflowPass merged last uses, as dicts of sets, before LastUses."""
+    merged = defaultdict(set)
+    for uses in (uses1, uses2):
+        for symbol, nodes in uses.items():
+            merged[symbol] |= nodes
+    return merged
+
+
+def _clone_dict_of_sets(uses):
+    return defaultdict(set, {symbol: set(nodes) for symbol, nodes in uses.items()})
+
+
+def _assert_equivalent(last_uses, expected, all_symbols):
+    for symbol in all_symbols:
+        assert last_uses[symbol] == expected.get(symbol, set())
+    items = list(last_uses.items())
+    assert len(items) == len(dict(items))
+    assert {s: n for s, n in items if len(n) > 0} == {s: n for s, n in expected.items() if len(n) > 0}
+    assert last_uses.is_empty() == (len(expected) == 0)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_last_uses_match_dicts_of_sets(seed):
+    rng = random.Random(seed)
+    symbols = ['s%i' % i for i in range(12)]
+    # Pairs of a LastUses and the dict of sets it replaces, updated in the same way.
+    states = [(LastUses(), defaultdict(set))]
+    for step in range(3000):
+        i = rng.randrange(len(states))
+        last_uses, expected = states[i]
+        operation = rng.random()
+        if operation < 0.5:
+            symbol = rng.choice(symbols)
+            last_uses[symbol] = frozenset([step])
+            expected[symbol] = {step}
+        elif operation < 0.7:
+            states.append((last_uses.snapshot(), _clone_dict_of_sets(expected)))
+        elif operation < 0.9:
+            other_last_uses, other_expected = states[rng.randrange(len(states))]
+            states.append((LastUses.merge(last_uses, other_last_uses), _merge_dicts_of_sets(expected, other_expected)))
+        else:
+            states[i] = (LastUses(), defaultdict(set))
+        if len(states) > 20:
+            states.pop(rng.randrange(len(states)))
+
+        for last_uses, expected in states:
+            _assert_equivalent(last_uses, expected, symbols)
+
+
+def test_snapshots_are_independent():
+    last_uses = LastUses()
+    last_uses['a'] = frozenset([1])
+    snapshot = last_uses.snapshot()
+    last_uses['a'] = frozenset([2])
+    snapshot['b'] = frozenset([3])
+    assert last_uses['a'] == {2} and last_uses['b'] == frozenset()
+    assert snapshot['a'] == {1} and snapshot['b'] == {3}
+    assert dict(LastUses.merge(last_uses, snapshot).items()) == {'a': {1, 2}, 'b': {3}}
+
+
+def test_long_chains_of_snapshots_are_collapsed():
+    last_uses = LastUses()
+    snapshots = []
+    for i in range(5 * LastUses.MAX_NUM_LAYERS):
+        last_uses['s%i' % (i % 7)] = frozenset([i])
+        snapshots.append(last_uses.snapshot())
+    for i, snapshot in enumerate(snapshots):
+        expected = {}
+        for j in range(i + 1):
+            expected['s%i' % (j % 7)] = {j}
+        assert dict(snapshot.items()) == expected
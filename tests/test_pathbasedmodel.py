@@ -0,0 +1,88 @@
+import random
+from collections import Counter
+from itertools import product
+
+import pytest
+
+from data_preparation.scripts.graph_generator.compactgraphs import get_adjacency_dict
+from typilus.model.pathbasedmodel import AncestorIndex
+from typilus.model.samplingiter import sample_increasing_pairs
+
+
+def _get_path_with_ancestor_sets(node_to_parent, node1_idx, node2_idx):
+    """The path extraction that AncestorIndex replaced."""
+    def get_all_ancestors(node_idx):
+        parents = set()
+        while node_idx is not None:
+            parents.add(node_idx)
+            node_idx = node_to_parent.get(node_idx)
+        return parents
+
+    common_ancestors = get_all_ancestors(node1_idx) & get_all_ancestors(node2_idx)
+    if len(common_ancestors) == 0:
+        return None
+    path_node1_to_join_node = [node1_idx]
+    while path_node1_to_join_node[-1] not in common_ancestors:
+        path_node1_to_join_node.append(node_to_parent[path_node1_to_join_node[-1]])
+    path_node2_to_join_node = [node2_idx]
+    while path_node2_to_join_node[-1] not in common_ancestors:
+        path_node2_to_join_node.append(node_to_parent[path_node2_to_join_node[-1]])
+    return path_node1_to_join_node + path_node2_to_join_node[:-1][::-1]
+
+
+def _random_forest(num_nodes, num_trees, seed):
+    rng = random.Random(seed)
+    node_ids = list(range(num_nodes))
+    rng.shuffle(node_ids)
+    node_to_children, node_to_parent = {}, {}
+    for i, node_idx in enumerate(node_ids[num_trees:], start=num_trees):
+        parent = node_ids[rng.randrange(i)]
+        node_to_parent[node_idx] = parent
+        node_to_children.setdefault(parent, set()).add(node_idx)
+    return node_to_parent, node_to_children
+
+
+def _assert_same_paths(num_nodes, node_to_parent, node_to_children, max_path_size=1000):
+    ancestor_index = AncestorIndex(num_nodes, node_to_parent, node_to_children)
+    for node1_idx, node2_idx in product(range(num_nodes), repeat=2):
+        expected_path = _get_path_with_ancestor_sets(node_to_parent, node1_idx, node2_idx)
+        if expected_path is not None and len(expected_path) > max_path_size:
+            expected_path = None
+        assert ancestor_index.get_path(node1_idx, node2_idx, max_path_size) == expected_path
+        if expected_path is not None and node1_idx != node2_idx:
+            lca = ancestor_index.lowest_common_ancestor(node1_idx, node2_idx)
+            assert ancestor_index.depth(lca) == min(ancestor_index.depth(n) for n in expected_path)
+
+
+@pytest.mark.parametrize('num_nodes, num_trees, seed', [(1, 1, 0), (2, 1, 0), (40, 1, 1), (60, 3, 2), (100, 1, 3)])
+def test_ancestor_index_matches_ancestor_sets(num_nodes, num_trees, seed):
+    node_to_parent, node_to_children = _random_forest(num_nodes, num_trees, seed)
+    _assert_same_paths(num_nodes, node_to_parent, node_to_children)
+    _assert_same_paths(num_nodes, node_to_parent, node_to_children, max_path_size=4)
+
+
+def test_ancestor_index_on_a_code_graph(extract_graph):
+    graph = extract_graph()
+    child_edges = {int(k): set(v) for k, v in get_adjacency_dict(graph['edges']['CHILD']).items()}
+    node_to_parent = {to_idx: from_idx for from_idx, to_idxs in child_edges.items() for to_idx in to_idxs}
+    _assert_same_paths(len(graph['nodes']), node_to_parent, child_edges, max_path_size=10)
+
+
+@pytest.mark.parametrize('sample_size', [0, 5, 1000])
+def test_sample_increasing_pairs(sample_size):
+    firsts, sorted_seconds = {3, 8, 1, 15, 20}, [0, 2, 4, 5, 9, 16, 17]
+    all_pairs = {(f, s) for f, s in product(firsts, sorted_seconds) if f < s}
+    pairs = sample_increasing_pairs(firsts, sorted_seconds, sample_size)
+    assert len(pairs) == len(set(pairs)) == min(sample_size, len(all_pairs))
+    assert set(pairs) <= all_pairs
+
+
+def test_sample_increasing_pairs_is_uniform():
+    random.seed(0)
+    firsts, sorted_seconds = [1, 5, 7], list(range(10))
+    all_pairs = {(f, s) for f, s in product(firsts, sorted_seconds) if f < s}
+    num_samples = 3000
+    counts = Counter(p for _ in range(num_samples) for p in sample_increasing_pairs(firsts, sorted_seconds, 4))
+    assert set(counts) == all_pairs
+    expected_count = num_samples * 4 / len(all_pairs)
+    assert all(abs(c - expected_count) < 0.2 * expected_count for c in counts.values())
@@ -0,0 +1,128 @@
+from symtable import symtable
+
+import pytest
+
+from data_preparation.scripts.graph_generator.symboltableindex import SymbolTableIndex
+
+SOURCE = '''
+import os
+counter = 0
+
+def f(a, b=lambda x: x):
+    global counter
+    g = lambda: lambda y: y + a
+    values = [v for v in range(a) if v], {k: v for k, v in os.environ.items()}, (w for w in [1] for z in [w])
+    def inner(c):
+        nonlocal g
+        return [lambda: c for _ in range(c)], [lambda: c * 2]
+    return inner
+
+class C:
+    __private = 1
+    def f(self, x):
+        return [self.__private for _ in range(x)]
+    def g(self):
+        class D:
+            def f(self): return lambda q: q
+        return D
+
+def f():
+    return 1
+
+def f(): return [x for x in []], [x for x in [1]]
+
+fs = [lambda: 1, lambda: lambda: 2], [lambda z: z
+                                     for _ in []]
+'''
+
+
+def _all_scope_stacks(module_table):
+    stacks = [[module_table]]
+    i = 0
+    while i < len(stacks):
+        stacks.extend(stacks[i] + [child] for child in stacks[i][-1].get_children())
+        i += 1
+    return stacks
+
+
+def _resolve_by_lookup(scope_stack, name):
+    """The name resolution that SymbolTableIndex.resolve replaced."""
+    current_idx = len(scope_stack) - 1
+    while current_idx >= 0:
+        try:
+            return scope_stack[current_idx].lookup(name)
+        except KeyError:
+            current_idx -= 1
+    return None
+
+
+def _describe_symbol(symbol):
+    if symbol is None:
+        return None
+    return (symbol.get_name(), symbol.is_local(), symbol.is_global(), symbol.is_free(), symbol.is_parameter(),
+            symbol.is_imported(), symbol.is_assigned(), symbol.is_referenced(), symbol.is_namespace())
+
+
+def _closest_children_by_scanning(table, child_type, child_name, lineno, search_backwards):
+    """The selection of child tables that SymbolTableIndex.get_closest_children replaced."""
+    occurrences = [t for t in table.get_children() if t.get_type() == child_type and t.get_name() == child_name]
+    occurrences.sort(key=lambda t: t.get_lineno(), reverse=search_backwards)
+    closest_matching = []
+    for child_table in occurrences:
+        if (not search_backwards and child_table.get_lineno() >= lineno) or \
+                (search_backwards and child_table.get_lineno() <= lineno):
+            if len(closest_matching) == 0 or closest_matching[0].get_lineno() == child_table.get_lineno():
+                closest_matching.append(child_table)
+    return occurrences, closest_matching
+
+
+@pytest.fixture
+def module_table():
+    return symtable(SOURCE, 'file.py', 'exec')
+
+
+def test_resolve_matches_lookup(module_table):
+    index = SymbolTableIndex(module_table)
+    all_names = {n for stack in _all_scope_stacks(module_table) for n in stack[-1].get_identifiers()}
+    all_names.update(['undefined', '_C__private', '__private'])
+    for scope_stack in _all_scope_stacks(module_table):
+        for name in sorted(all_names):
+            expected = _resolve_by_lookup(scope_stack, name)
+            for _ in range(2):  # Resolved, and then memoised
+                assert _describe_symbol(index.resolve(scope_stack, name)) == _describe_symbol(expected)
+
+
+def test_children_match_scanning(module_table):
+    index = SymbolTableIndex(module_table)
+    max_lineno = SOURCE.count('\n') + 2
+    for scope_stack in _all_scope_stacks(module_table):
+        table = scope_stack[-1]
+        kinds = {(t.get_type(), t.get_name()) for t in table.get_children()} | {('function', 'missing')}
+        for child_type, child_name in kinds:
+            children = index.get_children(table, child_type, child_name)
+            assert [t.get_id() for t in children] == \
+                [t.get_id() for t in sorted((t for t in table.get_children()
+                                             if t.get_type() == child_type and t.get_name() == child_name),
+                                            key=lambda t: t.get_lineno())]
+            for search_backwards in (False, True):
+                for lineno in range(max_lineno):
+                    occurrences, expected = _closest_children_by_scanning(table, child_type, child_name, lineno,
+                                                                          search_backwards)
+                    closest = index.get_closest_children(table, child_type, child_name, lineno, search_backwards)
+                    assert [t.get_id() for t in closest] == [t.get_id() for t in expected]
+                if len(occurrences) > 0:
+                    # The fallback of AstGraphGenerator when no table is found in the search direction.
+                    fallback = children[-1]
+                    if search_backwards:
+                        fallback = index.get_closest_children(table, child_type, child_name,
+                                                              children[0].get_lineno(), search_backwards=True)[-1]
+                    assert fallback.get_id() == occurrences[-1].get_id()
+
+
+def test_same_scope_yields_same_tables(module_table):
+    index = SymbolTableIndex(module_table)
+    functions = index.get_children(module_table, 'function', 'f')
+    assert [t.get_lineno() for t in functions] == [5, 23, 26]
+    assert index.get_children(module_table, 'function', 'f')[0] is functions[0]
+    assert index.get_closest_children(functions[2], 'function', 'listcomp', 26, search_backwards=True) == \
+        index.get_children(functions[2], 'function', 'listcomp')
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from typilus.model.tensorisedchunks import FILE_SUFFIX, TensorisedChunk, save_tensorised_chunk
+
+
+def _assert_same_sample(sample, loaded_sample):
+    assert set(loaded_sample) == set(sample)
+    for key, value in sample.items():
+        loaded_value = loaded_sample[key]
+        if isinstance(value, np.ndarray):
+            assert loaded_value.dtype == value.dtype
+            np.testing.assert_array_equal(loaded_value, value)
+        elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], np.ndarray):
+            assert len(loaded_value) == len(value)
+            for v, loaded_v in zip(value, loaded_value):
+                assert loaded_v.dtype == v.dtype
+                np.testing.assert_array_equal(loaded_v, v)
+        else:
+            assert loaded_value == value
+
+
+def _make_samples(num_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    samples = []
+    for i in range(num_samples):
+        num_nodes = rng.randint(0, 20)
+        samples.append({
+            'node_labels': rng.randint(0, 1000, size=(num_nodes, 5)).astype(np.int32),
+            'node_features': rng.normal(size=(num_nodes, 3, 2)).astype(np.float32),
+            'adjacency_lists': [rng.randint(0, 20, size=(rng.randint(0, 30), 2)).astype(np.int64) for _ in range(3)],
+            'targets': rng.randint(0, 10, size=rng.randint(0, 4)).astype(np.uint16),
+            'num_targets': np.int32(i),  # A 0-d array, stored in the header
+            'names': np.array(['a', None], dtype=object),  # Object arrays are pickled
+            'provenance': 'file%i.py' % i,
+        })
+    return samples
+
+
+def test_round_trip(tmp_path):
+    samples = _make_samples(10)
+    path = str(tmp_path / ('chunk' + FILE_SUFFIX))
+    save_tensorised_chunk(samples, path)
+
+    chunk = TensorisedChunk(path)
+    assert len(chunk) == len(samples)
+    for sample, loaded_sample in zip(samples, chunk):
+        _assert_same_sample(sample, loaded_sample)
+    _assert_same_sample(samples[-1], chunk[-1])
+    with pytest.raises(IndexError):
+        chunk[len(samples)]
+
+
+def test_fields_with_different_layouts_are_pickled(tmp_path):
+    samples = [
+        {'values': np.arange(3, dtype=np.int32), 'mixed': np.zeros((2, 2), dtype=np.float32), 'optional': [1]},
+        {'values': np.arange(0, dtype=np.int32), 'mixed': np.zeros((2, 3), dtype=np.float32)},
+        {'values': np.arange(5, dtype=np.int32), 'mixed': [1, 2]},
+    ]
+    path = str(tmp_path / ('chunk' + FILE_SUFFIX))
+    save_tensorised_chunk(samples, path)
+    chunk = TensorisedChunk(path)
+    for sample, loaded_sample in zip(samples, chunk):
+        _assert_same_sample(sample, loaded_sample)
+    assert isinstance(chunk[0]['values'], np.memmap)
+    assert not isinstance(chunk[0]['mixed'], np.memmap)
+
+
+def test_empty_chunks_and_columns(tmp_path):
+    path = str(tmp_path / ('empty' + FILE_SUFFIX))
+    save_tensorised_chunk([], path)
+    assert len(TensorisedChunk(path)) == 0
+
+    samples = [{'values': np.zeros((0, 4), dtype=np.float64)}] * 3
+    save_tensorised_chunk(samples, path)
+    chunk = TensorisedChunk(path)
+    for sample, loaded_sample in zip(samples, chunk):
+        _assert_same_sample(sample, loaded_sample)
+
+
+def test_modifying_samples_does_not_change_the_file(tmp_path):
+    samples = _make_samples(3)
+    path = str(tmp_path / ('chunk' + FILE_SUFFIX))
+    save_tensorised_chunk(samples, path)
+
+    chunk = TensorisedChunk(path)
+    chunk[1]['node_labels'][:] = -1
+    chunk[1]['adjacency_lists'][0][:] = -1
+    del chunk
+
+    for sample, loaded_sample in zip(samples, TensorisedChunk(path)):
+        _assert_same_sample(sample, loaded_sample)
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / ('chunk' + FILE_SUFFIX)
+    path.write_bytes(b'not a chunk')
+    with pytest.raises(ValueError):
+        TensorisedChunk(str(path))
@@ -0,0 +1,233 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import typilus.model.typeindex as typeindex
+from typilus.model.typeindex import AnnoyTypeIndex, ExactTypeIndex, IVFPQTypeIndex, SegmentedTypeIndex, \
+    create_type_index, find_exact_nearest_neighbours, load_type_index
+
+DIMENSION = 16
+
+
+def _make_vectors(num_vectors, seed=0, num_clusters=50):
+    """Clustered vectors, like type representations."""
+    rng = np.random.RandomState(seed)
+    centers = np.random.RandomState(1234).normal(size=(num_clusters, DIMENSION)) * 5
+    return (centers[rng.randint(0, num_clusters, num_vectors)] + rng.normal(size=(num_vectors, DIMENSION))) \
+        .astype(np.float32)
+
+
+def _brute_force_distances(vectors, queries):
+    return np.abs(queries[:, None, :] - vectors[None, :, :]).sum(axis=-1)
+
+
+def _recall(nn_ids, exact_nn_ids):
+    k = exact_nn_ids.shape[1]
+    return np.mean([len(set(ids) & set(exact_ids)) / k for ids, exact_ids in zip(nn_ids, exact_nn_ids)])
+
+
+@pytest.mark.parametrize('block_size', [64 * 1024 * 1024, 1000, 37, 1])
+def test_exact_search_matches_brute_force(monkeypatch, block_size):
+    monkeypatch.setattr(typeindex, 'EXACT_SEARCH_BLOCK_SIZE', block_size)
+    vectors, queries = _make_vectors(500), _make_vectors(40, seed=1)
+    nn_ids, nn_distances = find_exact_nearest_neighbours(vectors, queries, 7)
+
+    distances = _brute_force_distances(vectors, queries)
+    expected_distances = np.sort(distances, axis=1)[:, :7]
+    np.testing.assert_allclose(nn_distances, expected_distances, rtol=1e-5)
+    np.testing.assert_allclose(np.take_along_axis(distances, nn_ids, axis=1), expected_distances, rtol=1e-5)
+
+
+@pytest.mark.parametrize('index_type', ['exact', 'annoy', 'segmented'])
+def test_queries_are_padded_to_k_neighbours(index_type):
+    index = create_type_index(index_type, DIMENSION)
+    index.add_items(_make_vectors(3))
+    index.build()
+    nn_ids, nn_distances = index.query(_make_vectors(2, seed=1), 5)
+    assert nn_ids.shape == nn_distances.shape == (2, 5)
+    assert (nn_ids[:, 3:] == -1).all() and np.isinf(nn_distances[:, 3:]).all()
+    assert sorted(nn_ids[0, :3]) == [0, 1, 2]
+
+
+@pytest.mark.parametrize('index_type, options, min_recall', [
+    ('exact', {}, 1.0),
+    ('annoy', {'num_trees': 10}, 0.9),
+    ('ivfpq', {'num_lists': 16, 'num_subspaces': 8, 'num_probes': 16}, 0.6),
+])
+def test_recall_against_exact_search(tmp_path, index_type, options, min_recall):
+    vectors, queries = _make_vectors(3000), _make_vectors(100, seed=1)
+    exact_nn_ids, _ = find_exact_nearest_neighbours(vectors, queries, 10)
+
+    index = create_type_index(index_type, DIMENSION, **options)
+    for block in np.array_split(vectors, 3):
+        index.add_items(block)
+    index.build()
+    assert len(index) == len(vectors)
+    nn_ids, nn_distances = index.query(queries, 10)
+    assert nn_ids.shape == nn_distances.shape == (len(queries), 10)
+    assert (np.diff(nn_distances, axis=1) >= 0).all()
+    assert _recall(nn_ids, exact_nn_ids) >= min_recall
+
+    path = str(tmp_path / ('index' + type(index).FILE_SUFFIX))
+    index.save(path)
+    loaded_nn_ids, loaded_nn_distances = load_type_index(index_type, path, DIMENSION).query(queries, 10)
+    np.testing.assert_array_equal(loaded_nn_ids, nn_ids)
+    np.testing.assert_allclose(loaded_nn_distances, nn_distances, rtol=1e-5)
+
+
+def test_annoy_recall_with_approximate_search(monkeypatch):
+    # Small indices are searched exactly, so lower the threshold to test Annoy's own search.
+    monkeypatch.setattr(AnnoyTypeIndex, 'MAX_EXACT_SEARCH_INDEX_SIZE', 0)
+    vectors, queries = _make_vectors(3000), _make_vectors(100, seed=1)
+    exact_nn_ids, exact_nn_distances = find_exact_nearest_neighbours(vectors, queries, 10)
+
+    for build_on_disk in (True, False):
+        index = AnnoyTypeIndex(DIMENSION, num_trees=20, build_on_disk=build_on_disk)
+        index.add_items(vectors)
+        index.build()
+        nn_ids, nn_distances = index.query(queries, 10)
+        assert _recall(nn_ids, exact_nn_ids) >= 0.8
+        # Distances are those of the ids returned.
+        np.testing.assert_allclose(nn_distances, np.abs(queries[:, None] - vectors[nn_ids]).sum(-1), rtol=1e-4)
+
+
+def test_ivfpq_finds_indexed_vectors():
+    vectors = _make_vectors(2000)
+    index = IVFPQTypeIndex(DIMENSION, num_lists=16, num_subspaces=8, num_probes=4)
+    index.add_items(vectors)
+    index.build()
+    nn_ids, _ = index.query(vectors[:100], 5)
+    assert np.mean([i in ids for i, ids in enumerate(nn_ids)]) >= 0.9
+    with pytest.raises(ValueError):
+        index.add_items(vectors)
+        index.build()
+
+
+def test_exact_index_keeps_a_single_added_array():
+    vectors = _make_vectors(100)
+    index = ExactTypeIndex(DIMENSION)
+    index.add_items(vectors)
+    index.build()
+    assert np.shares_memory(index.vectors, vectors)
+
+
+def _assert_same_neighbours(index, vectors, queries, k=10):
+    """Check that index (in which vectors were added) finds the same neighbours as an exact search."""
+    exact_nn_ids, exact_nn_distances = find_exact_nearest_neighbours(vectors, queries, k)
+    nn_ids, nn_distances = index.query(queries, k)
+    np.testing.assert_allclose(nn_distances, exact_nn_distances, rtol=1e-5)
+    np.testing.assert_allclose(np.abs(queries[:, None] - vectors[nn_ids]).sum(-1), exact_nn_distances, rtol=1e-5)
+
+
+@pytest.mark.parametrize('base_type', ['exact', 'annoy'])
+def test_segmented_index_merges_segments(base_type):
+    vectors, queries = _make_vectors(1000), _make_vectors(50, seed=1)
+    index = SegmentedTypeIndex(DIMENSION, base_type=base_type, max_delta_segments=1, compaction_ratio=1.0)
+    index.add_items(vectors[:400])
+    index.build()
+    assert index.num_segments == 1
+
+    num_added = 400
+    for num_new_vectors in [10, 20, 5, 100, 1, 200, 3, 50, 30, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]:
+        index.add_items(vectors[num_added:num_added + num_new_vectors])
+        index.build()
+        num_added += num_new_vectors
+        assert len(index) == num_added
+        # At most the base segment, one compacted segment and max_delta_segments delta segments.
+        assert index.num_segments <= 3
+        _assert_same_neighbours(index, vectors[:num_added], queries)
+
+
+def test_segmented_index_compacts_large_deltas():
+    vectors = _make_vectors(200)
+    index = SegmentedTypeIndex(DIMENSION, base_type='exact', max_delta_segments=10, compaction_ratio=0.1)
+    index.add_items(vectors[:100])
+    index.build()
+    index.add_items(vectors[100:105])
+    index.build()
+    assert index.num_segments == 2  # A delta segment
+    index.add_items(vectors[105:200])
+    index.build()
+    assert index.num_segments == 2  # Both deltas compacted into one segment
+    _assert_same_neighbours(index, vectors, _make_vectors(20, seed=1))
+
+
+def test_segmented_index_from_existing_index(tmp_path):
+    vectors = _make_vectors(600)
+    base_index = AnnoyTypeIndex(DIMENSION)
+    base_index.add_items(vectors[:400])
+    base_index.build()
+    base_path = str(tmp_path / ('base' + AnnoyTypeIndex.FILE_SUFFIX))
+    base_index.save(base_path)
+
+    index = SegmentedTypeIndex.from_index(DIMENSION, 'annoy', load_type_index('annoy', base_path, DIMENSION),
+                                          base_path, max_delta_segments=1)
+    for start in range(400, 600, 50):
+        index.add_items(vectors[start:start + 50])
+        index.build()
+    assert len(index) == 600 and index.num_segments <= 3
+    _assert_same_neighbours(index, vectors, _make_vectors(20, seed=1))
+
+
+def _segment_files(directory):
+    return {f for f in os.listdir(str(directory)) if f.startswith(SegmentedTypeIndex.SEGMENT_FILE_PREFIX)}
+
+
+def test_segmented_index_save_load_and_file_cleanup(tmp_path):
+    vectors, queries = _make_vectors(800), _make_vectors(30, seed=1)
+    path = str(tmp_path / ('model' + SegmentedTypeIndex.FILE_SUFFIX))
+    index = SegmentedTypeIndex(DIMENSION, base_type='annoy', max_delta_segments=2, compaction_ratio=0.5, num_trees=5)
+    index.add_items(vectors[:400])
+    index.build()
+    index.save(path)
+
+    num_added = 400
+    while num_added < len(vectors):
+        index = SegmentedTypeIndex.load(path, DIMENSION)
+        index.add_items(vectors[num_added:num_added + 50])
+        index.build()
+        num_added += 50
+        index.save(path)
+
+        with open(path) as f:
+            manifest = json.load(f)
+        referenced_files = {s['file'] for s in manifest['segments']}
+        if manifest['compacted_vectors'] is not None:
+            referenced_files.add(manifest['compacted_vectors']['file'])
+        # Segments that were compacted away were removed.
+        assert _segment_files(tmp_path) == referenced_files
+        assert sum(s['num_items'] for s in manifest['segments']) == num_added
+
+        loaded_index = SegmentedTypeIndex.load(path, DIMENSION)
+        assert len(loaded_index) == num_added and loaded_index.num_segments == index.num_segments
+        _assert_same_neighbours(loaded_index, vectors[:num_added], queries)
+
+
+def test_segmented_index_keeps_files_of_other_manifests(tmp_path):
+    vectors = _make_vectors(300)
+    path = str(tmp_path / ('model' + SegmentedTypeIndex.FILE_SUFFIX))
+    index = SegmentedTypeIndex(DIMENSION, base_type='exact', max_delta_segments=0)
+    index.add_items(vectors[:100])
+    index.build()
+    index.save(path)
+    files_of_first_version = _segment_files(tmp_path)
+
+    # A new version is written next to the current one (as done when saving a model), which stays in use until the
+    # new version replaces it.
+    index.add_items(vectors[100:300])
+    index.build()
+    index.save(path + '.tmp')
+    assert _segment_files(tmp_path) >= files_of_first_version
+    os.replace(path + '.tmp', path)
+    SegmentedTypeIndex.remove_unreferenced_files(path)
+    files_of_second_version = _segment_files(tmp_path)
+    assert len(files_of_second_version) == 3  # The base segment, and the compacted segment and its vectors
+    _assert_same_neighbours(SegmentedTypeIndex.load(path, DIMENSION), vectors, _make_vectors(20, seed=1))
+
+    # Copies to another directory include all files.
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    SegmentedTypeIndex.copy_files(path, str(other_dir / 'copy.index.seg'))
+    assert _segment_files(other_dir) == files_of_second_version